@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import time
+
+import discord
+
+DISCORD_EPOCH_MS = 1420070400000
+_seq = itertools.count()
+
+
+def snowflake(at: float | None = None) -> int:
+    # unique, time-ordered IDs so horizon checks behave like the real thing
+    ms = int((time.time() if at is None else at) * 1000) - DISCORD_EPOCH_MS
+    return (ms << 22) | (next(_seq) & 0x3FFFFF)
+
+
+class FakeRole:
+    def __init__(self, id: int, name: str, permissions: discord.Permissions | None = None, default: bool = False):
+        self.id = id
+        self.name = name
+        self.permissions = permissions or discord.Permissions.none()
+        self.default = default
+
+    def is_default(self) -> bool:
+        return self.default
+
+
+class FakeMember:
+    def __init__(self, id: int, name: str, roles=(), guild=None, bot: bool = False):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.roles = list(roles)
+        self.guild = guild
+        self.bot = bot
+        self.mention = f"<@{id}>"
+
+    def mentioned_in(self, message) -> bool:
+        return any(m.id == self.id for m in message.mentions)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeMessage:
+    _state = None  # read by commands.Context; set to the bot's ConnectionState
+
+    def __init__(self, content: str, author, channel, mentions=(), reference=None, id: int | None = None):
+        self.id = id or snowflake()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = list(mentions)
+        self.reference = reference
+        self.edits = 0
+        self.dispatched = 0.0
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        self.edits += 1
+        return self
+
+
+class FakeReference:
+    def __init__(self, message_id: int, resolved=None):
+        self.message_id = message_id
+        self.resolved = resolved
+
+
+class FakeChannel:
+    # Records what the bot sends; fetch_message simulates a REST round trip.
+
+    def __init__(self, id: int, guild, rest_latency: float = 0.05):
+        self.id = id
+        self.guild = guild
+        self.name = f"chan-{id}"
+        self.rest_latency = rest_latency
+        self.history: dict[int, FakeMessage] = {}
+        self.sent: list[FakeMessage] = []
+        self.fetches = 0
+        self.last_message_id = None
+
+    async def send(self, content=None, **kwargs):
+        msg = FakeMessage(content, self.guild.bot_member, self)
+        self.history[msg.id] = msg
+        self.sent.append(msg)
+        return msg
+
+    async def fetch_message(self, message_id: int):
+        self.fetches += 1
+        await asyncio.sleep(self.rest_latency)
+        msg = self.history.get(message_id)
+        if msg is None:
+            raise LookupError(message_id)
+        return msg
+
+    def typing(self):
+        return FakeTyping()
+
+
+class FakeGuild:
+    # chunked=False mimics lean mode: guild.members starts empty and the bot
+    # has to fetch_member/query_members what it needs (all_members is the
+    # real population the traffic is drawn from)
+
+    def __init__(self, id: int, name: str, member_count: int, channel_count: int, bot_member, rest_latency: float = 0.05, chunked: bool = True):
+        self.id = id
+        self.name = name
+        self.bot_member = bot_member
+        everyone = FakeRole(id, "@everyone", default=True)
+        staff = FakeRole(id + 1, "Moderator", discord.Permissions(manage_messages=True, kick_members=True))
+        admin = FakeRole(id + 2, "Admin", discord.Permissions(administrator=True))
+        regular = [FakeRole(id + 10 + i, f"role-{i}") for i in range(8)]
+        self.roles = [everyone, staff, admin, *regular]
+
+        self.all_members = []
+        for i in range(member_count):
+            roles = [everyone, regular[i % len(regular)]]
+            if i % 500 == 1:
+                roles.append(staff)
+            if i == 0:
+                roles.append(admin)
+            self.all_members.append(FakeMember(id * 1_000_000 + i, f"user{i}", roles, self))
+        self._members = {m.id: m for m in self.all_members}
+        self.members = self.all_members if chunked else []
+        self.rest_latency = rest_latency
+        self.member_fetches = 0
+        self.member_count = member_count
+        self.me = bot_member
+        self.text_channels = [FakeChannel(id * 1000 + c, self, rest_latency) for c in range(channel_count)]
+
+    def get_member(self, member_id: int):
+        return self._members.get(member_id)
+
+    async def fetch_member(self, member_id: int):
+        self.member_fetches += 1
+        await asyncio.sleep(self.rest_latency)
+        member = self._members.get(member_id)
+        if member is None:
+            raise LookupError(member_id)
+        return member
+
+    async def query_members(self, user_ids=(), cache: bool = True):
+        self.member_fetches += 1
+        await asyncio.sleep(self.rest_latency)
+        return [self._members[mid] for mid in user_ids if mid in self._members]
+
+
+def make_bot_user(user_id: int = 999_000_000_001) -> FakeMember:
+    return FakeMember(user_id, "Ardunot-v2", bot=True)
@@ -0,0 +1,266 @@
+"""Replay a recorded gateway trace against the fakes and the stub LLM.
+
+A trace comes from running a bot with TRACE_PATH set (see trace_recorder.py).
+Every recorded user message is rebuilt with the same shape (length, bot
+mention, reply target, code, shush request) and fed through the bot's real
+on_message at the recorded pace, N times faster, or as fast as possible.
+Replies to messages the trace never saw become replies to old bot messages,
+so they cost a fetch_message like they did live. Prefix commands are
+skipped. The report gives reply latency percentiles and drop counts next
+to what the trace recorded.
+
+    TRACE_PATH=trace.jsonl python bot.py                 # record
+    python -m bench.replay trace.jsonl                   # recorded pace
+    python -m bench.replay trace.jsonl --speed 10        # 10x
+    python -m bench.replay trace.jsonl --speed 0 --bot p # max speed, p.py
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from bench.fakes import FakeGuild, FakeMessage, FakeReference, snowflake
+from bench.run import git_commit, load_bot, start_background, summarize, wait_idle
+from bench.stub_llm import StubLLM
+
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+def read_trace(path: str):
+    messages, outcomes = [], {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("ev") == "msg":
+                messages.append(event)
+            elif event.get("ev") == "out":
+                outcomes.setdefault(event["id"], []).append(event)
+    messages.sort(key=lambda e: e["t"])
+    return messages, outcomes
+
+
+def recorded_summary(messages, outcomes) -> dict:
+    counts, latencies = {}, []
+    for events in outcomes.values():
+        for event in events:
+            counts[event["o"]] = counts.get(event["o"], 0) + 1
+            if event["o"] == "replied" and "ms" in event:
+                latencies.append(event["ms"] / 1000)
+    span = messages[-1]["t"] - messages[0]["t"] if messages else 0.0
+    return {
+        "messages": sum(1 for m in messages if not m["bot"]),
+        "span_s": span,
+        "outcomes": counts,
+        "reply_latency_ms": summarize(latencies),
+    }
+
+
+class World:
+    # Fake guilds, channels and members standing in for the trace's aliases,
+    # in order of first appearance.
+
+    def __init__(self, messages, bot_user, chunked: bool):
+        self.bot_user = bot_user
+        channels, authors = {}, {}
+        for m in messages:
+            if m["g"] is None:
+                continue
+            # dicts as ordered sets
+            channels.setdefault(m["g"], {})[m["c"]] = None
+            if not m["bot"]:
+                authors.setdefault(m["g"], {})[m["a"]] = None
+
+        self.guilds, self.channels, self.members = {}, {}, {}
+        for i, (g, chans) in enumerate(sorted(channels.items())):
+            people = list(authors.get(g, ()))
+            guild = FakeGuild(20_000 + i, f"replay-{g}", max(len(people), 10), len(chans), bot_user, chunked=chunked)
+            self.guilds[g] = guild
+            for c, channel in zip(chans, guild.text_channels):
+                self.channels[c] = channel
+            for a, member in zip(people, guild.all_members):
+                self.members[a] = member
+
+        self.replayed: dict[int, FakeMessage] = {}  # trace id -> message fed in
+        self.bot_aliases = {m["id"] for m in messages if m["bot"]}
+
+    def content(self, event, mentions) -> str:
+        parts = [m.mention for m in mentions]
+        if event["stop"]:
+            parts.append("stop")
+        if event["raw"]:
+            parts.append(f"<{mentions[-1].id if mentions else self.bot_user.id}>")
+        if event["code"]:
+            parts.append("```\nx = 1\n```")
+        i = 0
+        while len(" ".join(parts)) < event["len"] - (1 if event["q"] else 0):
+            parts.append(FILLER[i % len(FILLER)])
+            i += 1
+        return " ".join(parts) + ("?" if event["q"] else "")
+
+    def reference(self, event, channel, addressed: bool):
+        ref = event["ref"]
+        if ref is None:
+            return None
+        if ref in self.replayed:
+            return FakeReference(self.replayed[ref].id)
+        if ref in self.bot_aliases and channel.sent:
+            # the bot's reply in this run stands in for the recorded one
+            return FakeReference(channel.sent[-1].id)
+        # from before the trace started: an old message only a fetch can identify
+        author = self.bot_user if addressed or ref in self.bot_aliases else self.members.get(event["a"], self.bot_user)
+        old = FakeMessage("old message", author, channel, id=snowflake(time.time() - 7 * 86400))
+        channel.history[old.id] = old
+        return FakeReference(old.id)
+
+    def build(self, event, addressed: bool) -> FakeMessage | None:
+        channel = self.channels.get(event["c"])
+        author = self.members.get(event["a"])
+        if channel is None or author is None:
+            return None
+        guild = channel.guild
+        mentions = [self.bot_user] if event["mb"] else []
+        others = [m for m in guild.all_members if m.id != author.id]
+        mentions += others[:max(0, event["mn"] - len(mentions))]
+        msg = FakeMessage(self.content(event, mentions), author, channel, mentions, self.reference(event, channel, addressed))
+        self.replayed[event["id"]] = msg
+        return msg
+
+
+def counter(metrics, name: str, **labels) -> float:
+    return metrics.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+async def replay(mod, world: World, messages, outcomes, speed: float) -> dict:
+    from metrics import METRICS
+
+    latencies = []
+    original = mod.coalescer.handler
+
+    async def timed(channel_id, batch):
+        channel = batch[-1].channel
+        before = len(channel.sent)
+        await original(channel_id, batch)
+        if len(channel.sent) > before:
+            done = time.perf_counter()
+            latencies.extend(done - m.dispatched for m in batch)
+
+    watched = {
+        "rate_dropped": ("rate_limited_total", {"outcome": "dropped"}),
+        "rate_delayed": ("rate_limited_total", {"outcome": "delayed"}),
+        "queue_dropped": ("queue_dropped_total", {}),
+        "shushed": ("shush_suppressed_total", {}),
+        "replies": ("replies_total", {}),
+        "reference_fetches": ("reference_fetches_total", {}),
+    }
+    before = {k: counter(METRICS, name, **labels) for k, (name, labels) in watched.items()}
+    fetches = sum(c.fetches for c in world.channels.values())
+
+    fed = skipped = 0
+    mod.coalescer.handler = timed
+    try:
+        first = messages[0]["t"] if messages else 0.0
+        started = time.perf_counter()
+        tasks = []
+        for event in messages:
+            if event["bot"]:
+                continue
+            if event["cmd"]:
+                skipped += 1
+                continue
+            addressed = any(o["o"] == "addressed" for o in outcomes.get(event["id"], ()))
+            msg = world.build(event, addressed)
+            if msg is None:
+                skipped += 1
+                continue
+            if speed > 0:
+                delay = (event["t"] - first) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            msg.dispatched = time.perf_counter()
+            tasks.append(asyncio.create_task(mod.on_message(msg)))
+            fed += 1
+        await asyncio.gather(*tasks)
+        await wait_idle(mod)
+        wall = time.perf_counter() - started
+    finally:
+        mod.coalescer.handler = original
+
+    result = {
+        "messages": fed,
+        "skipped": skipped,
+        "wall_s": wall,
+        "reply_latency_ms": summarize(latencies),
+        "fetches": sum(c.fetches for c in world.channels.values()) - fetches,
+    }
+    for key, (name, labels) in watched.items():
+        result[key] = counter(METRICS, name, **labels) - before[key]
+    return result
+
+
+async def main(args):
+    messages, outcomes = read_trace(args.trace)
+    if not messages:
+        print(f"No messages in {args.trace}", file=sys.stderr)
+        return {}
+
+    os.environ.pop("TRACE_PATH", None)
+    stub = StubLLM(args.latency_ms, args.jitter_ms, args.rate_429, chunk_delay_ms=args.chunk_delay_ms)
+    url = await stub.start()
+    mod, _, bot_user = load_bot(args, url)
+    start_background(mod)
+    world = World(messages, bot_user, chunked=not args.lean)
+
+    try:
+        stub.reset()
+        replayed = await replay(mod, world, messages, outcomes, args.speed)
+        replayed["llm_requests"] = stub.requests
+        replayed["llm_429s"] = stub.throttled
+    finally:
+        await stub.stop()
+        from llm_client import close_providers
+        await close_providers()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "trace": args.trace,
+            "timestamp": time.time(),
+            "config": {k: v for k, v in vars(args).items() if k != "out"},
+        },
+        "recorded": recorded_summary(messages, outcomes),
+        "replayed": replayed,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded trace through the bot offline.")
+    parser.add_argument("trace", help="JSONL trace written with TRACE_PATH")
+    parser.add_argument("--bot", default="bot", choices=["bot", "p"])
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = recorded pace, N = N times faster, 0 = max speed")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--chunk-delay-ms", type=float, default=15)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--coalesce-window", type=float, default=None)
+    parser.add_argument("--lean", action="store_true")
+    parser.add_argument("--keep-rate-limits", action=argparse.BooleanOptionalAction, default=True,
+                        help="apply the real limits, so drops match production (default on)")
+    parser.add_argument("--out", default="replay_results.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: results.get(k) for k in ("recorded", "replayed")}, indent=2))
+    print(f"Wrote {args.out}", file=sys.stderr)
@@ -0,0 +1,417 @@
+"""Offline benchmark for the bots.
+
+Drives on_message, is_addressed, fetch_ai_response, can_send_in_guild and
+call_openrouter with synthetic guilds against a local stub LLM, then writes
+the numbers to JSON. No Discord token or provider key is needed.
+
+    python -m bench.run                          # bot.py, guilds of 10 / 1k / 50k
+    python -m bench.run --bot p --sizes 10,1000  # p.py
+    python -m bench.run --compare old.json       # print deltas against an earlier run
+    python -m bench.run --lean                   # lean intents mode (members fetched on demand)
+
+Each guild size also gets a "startup" section comparing full and lean
+intents mode (see bench/startup.py), whichever mode the rest runs in.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.fakes import FakeGuild, FakeMessage, FakeReference, make_bot_user, snowflake
+from bench.stub_llm import StubLLM
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def summarize(values, scale=1000.0):
+    # seconds -> milliseconds by default
+    return {
+        "n": len(values),
+        "p50": pct(values, 0.50) * scale,
+        "p95": pct(values, 0.95) * scale,
+        "p99": pct(values, 0.99) * scale,
+        "max": (max(values) if values else 0.0) * scale,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# ---------------- SETUP -------------------------
+
+def load_bot(args, stub_url):
+    os.environ.pop("DISCORD_TOKEN", None)
+    os.environ["OPENROUTER_API_KEY"] = "bench"
+    os.environ["OPENROUTER_URL"] = stub_url
+    os.environ["HF_URL"] = stub_url
+    os.environ["STATE_DB"] = os.path.join(tempfile.mkdtemp(prefix="ardunot-bench-"), "state.db")
+    os.environ["STREAM_REPLIES"] = "1" if args.stream else "0"
+    os.environ["LEAN_INTENTS"] = "1" if args.lean else "0"
+    os.environ["RESPONSE_CACHE_SIZE"] = os.environ.get("RESPONSE_CACHE_SIZE", "512") if args.cache else "0"
+    if args.coalesce_window is not None:
+        os.environ["COALESCE_WINDOW"] = str(args.coalesce_window)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        mod = importlib.import_module(args.bot)
+        client = importlib.import_module("openrouter_client")
+
+    bot_user = make_bot_user()
+    mod.bot._connection.user = bot_user
+    FakeMessage._state = mod.bot._connection
+
+    if not args.keep_rate_limits:
+        # measure the pipeline, not the 6/min policy
+        mod.RATE_LIMITS = {mode: 1_000_000 for mode in mod.RATE_LIMITS}
+        for name in ("CHANNEL_RATE_LIMIT", "USER_RATE_LIMIT"):
+            if hasattr(mod, name):
+                setattr(mod, name, 1_000_000)
+    return mod, client, bot_user
+
+
+def start_background(mod):
+    # the parts of on_ready that don't need a gateway
+    for name in ("state_store", "rate_limiter", "shush_timer"):
+        obj = getattr(mod, name, None)
+        if obj is not None and hasattr(obj, "start"):
+            obj.start()
+
+
+async def wait_idle(mod, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = bool(getattr(mod, "coalescer", None) and mod.coalescer.tasks)
+        scheduler = getattr(mod, "llm_scheduler", None)
+        if scheduler is not None:
+            busy = busy or scheduler.depth() > 0 or scheduler.running > 0
+        if not busy:
+            return
+        await asyncio.sleep(0.01)
+
+
+# ---------------- MICRO -------------------------
+
+def bench_rate_limit(mod, n=50_000):
+    started = time.perf_counter()
+    for i in range(n):
+        mod.can_send_in_guild(i % 1000, "serious", i % 5000)
+    return {"ops": n, "ns_per_op": (time.perf_counter() - started) / n * 1e9}
+
+
+async def bench_is_addressed(mod, guild, bot_user, n=200):
+    channel = guild.text_channels[0]
+    author = guild.all_members[min(5, len(guild.all_members) - 1)]
+    results = {}
+
+    async def run(name, make):
+        durations = []
+        fetches = channel.fetches
+        for _ in range(n):
+            msg = await make()
+            started = time.perf_counter()
+            await mod.is_addressed(msg)
+            durations.append(time.perf_counter() - started)
+        results[name] = {**summarize(durations, 1e6), "unit": "us", "fetches": channel.fetches - fetches}
+
+    async def mention():
+        return FakeMessage(f"<@{bot_user.id}> hi", author, channel, [bot_user])
+
+    async def reply_recent():
+        sent = await channel.send("earlier bot reply")
+        await mod.on_message(sent)  # gateway echo of our own message
+        return FakeMessage("thanks", author, channel, [], FakeReference(sent.id))
+
+    async def reply_old():
+        # bot message from before startup, not in any cache
+        old = FakeMessage("old bot reply", bot_user, channel, id=snowflake(time.time() - 30 * 86400))
+        channel.history[old.id] = old
+        return FakeMessage("replying to something old", author, channel, [], FakeReference(old.id))
+
+    await run("mention", mention)
+    await run("reply_recent", reply_recent)
+    await run("reply_old", reply_old)
+    return results
+
+
+async def bench_fetch(mod, guild, bot_user, stub, n=20):
+    channel = guild.text_channels[0]
+    author = guild.all_members[min(5, len(guild.all_members) - 1)]
+    for i in range(10):
+        mod.channel_memory.append(channel.id, guild.all_members[i % len(guild.all_members)].id,
+                                  f"user{i}", "user", f"history line {i}")
+
+    build = []
+    builder = getattr(mod, "build_prompt", None) or getattr(mod, "build_messages", None)
+    if builder is not None:
+        for _ in range(n):
+            started = time.perf_counter()
+            builder("how do I fix this?", guild, channel, author, [])
+            build.append(time.perf_counter() - started)
+
+    stub.reset()
+    total = []
+    for i in range(n):
+        started = time.perf_counter()
+        await mod.fetch_ai_response(f"how do I fix this? #{i}", guild, channel, author, [])
+        total.append(time.perf_counter() - started)
+
+    result = {"total_ms": summarize(total), "prompt_chars": pct(stub.prompt_chars, 0.5), "cached_token_share": cached_share(stub)}
+    if build:
+        result["build_us"] = summarize(build, 1e6)
+    return result
+
+
+async def bench_call_openrouter(client, stub, n=30):
+    stub.reset()
+    durations = []
+    for i in range(n):
+        started = time.perf_counter()
+        await client.call_openrouter(prompt=f"ping {i}", model="bench/model", use_cache=False)
+        durations.append(time.perf_counter() - started)
+    return {"total_ms": summarize(durations), "stub_latency_ms": stub.latency * 1000, "requests": stub.requests}
+
+
+# ---------------- END TO END --------------------
+
+def make_traffic(guild, bot_user, count, channels, seed=7):
+    rng = random.Random(seed)
+    chans = guild.text_channels[:channels]
+    bot_msgs = {}
+    msgs = []
+    for i in range(count):
+        channel = rng.choice(chans)
+        author = guild.all_members[rng.randrange(len(guild.all_members))]
+        roll = rng.random()
+        if roll < 0.7:
+            msgs.append(FakeMessage(f"<@{bot_user.id}> question {i}?", author, channel, [bot_user]))
+        elif roll < 0.9 and channel.id in bot_msgs:
+            msgs.append(FakeMessage(f"follow-up {i}", author, channel, [], FakeReference(bot_msgs[channel.id])))
+        else:
+            msgs.append(FakeMessage(f"just chatting {i}", author, channel))
+        if channel.id not in bot_msgs:
+            # a bot message from before startup, so the first reply to it has to be fetched
+            seed_msg = FakeMessage("seed", bot_user, channel, id=snowflake(time.time() - 86400))
+            channel.history[seed_msg.id] = seed_msg
+            bot_msgs[channel.id] = seed_msg.id
+    return msgs
+
+
+async def run_traffic(mod, msgs, rate):
+    latencies = []
+    original = mod.coalescer.handler
+
+    async def timed(channel_id, batch):
+        await original(channel_id, batch)
+        done = time.perf_counter()
+        latencies.extend(done - m.dispatched for m in batch)
+
+    mod.coalescer.handler = timed
+    try:
+        started = time.perf_counter()
+        tasks = []
+        for msg in msgs:
+            msg.dispatched = time.perf_counter()
+            tasks.append(asyncio.create_task(mod.on_message(msg)))
+            if rate:
+                await asyncio.sleep(1.0 / rate)
+        await asyncio.gather(*tasks)
+        await wait_idle(mod)
+        wall = time.perf_counter() - started
+    finally:
+        mod.coalescer.handler = original
+    return latencies, wall
+
+
+def cached_share(stub) -> float:
+    # fraction of prompt tokens the stub served from its prefix cache
+    return stub.cached_tokens / stub.prompt_tokens if stub.prompt_tokens else 0.0
+
+
+def counters(mod, stub, guild):
+    scheduler = getattr(mod, "llm_scheduler", None)
+    limiter = getattr(mod, "rate_limiter", None)
+    return {
+        "llm_requests": stub.requests,
+        "llm_429s": stub.throttled,
+        "batches": mod.coalescer.batches,
+        "rate_denied": limiter.denied if limiter else 0,
+        "queue_dropped": scheduler.dropped if scheduler else 0,
+        "sends": sum(len(c.sent) for c in guild.text_channels),
+        "fetches": sum(c.fetches for c in guild.text_channels),
+        "member_fetches": guild.member_fetches,
+    }
+
+
+async def bench_end_to_end(mod, guild, bot_user, stub, args):
+    stub.reset()
+    msgs = make_traffic(guild, bot_user, args.messages, args.channels)
+    before = counters(mod, stub, guild)
+    latencies, wall = await run_traffic(mod, msgs, args.rate)
+    after = counters(mod, stub, guild)
+    delta = {k: after[k] - before[k] for k in after}
+
+    result = {
+        "messages": len(msgs),
+        "wall_s": wall,
+        "throughput_msgs_per_s": len(msgs) / wall if wall else 0.0,
+        "reply_latency_ms": summarize(latencies),
+        "prompt_chars": {"p50": pct(stub.prompt_chars, 0.5), "max": max(stub.prompt_chars, default=0)},
+        "cached_token_share": cached_share(stub),
+        **delta,
+    }
+    if scheduler := getattr(mod, "llm_scheduler", None):
+        result["queue_wait_p95_ms"] = scheduler.stats()["wait_p95"] * 1000
+    return result
+
+
+async def bench_allocations(mod, guild, bot_user, args):
+    msgs = make_traffic(guild, bot_user, max(50, args.messages // 4), args.channels, seed=11)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        await run_traffic(mod, msgs, 0)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    retained = sum(s.size_diff for s in diff)
+    blocks = sum(s.count_diff for s in diff)
+    return {
+        "messages": len(msgs),
+        "retained_bytes_per_msg": retained / len(msgs),
+        "retained_blocks_per_msg": blocks / len(msgs),
+        "peak_traced_bytes": peak,
+    }
+
+
+def bench_startup(bot, size):
+    # one fresh process per mode, so each RSS delta stands alone
+    out = {}
+    for mode in ("full", "lean"):
+        try:
+            raw = subprocess.check_output(
+                [sys.executable, "-m", "bench.startup", "--bot", bot, "--mode", mode, "--size", str(size)],
+                stderr=subprocess.DEVNULL
+            )
+            out[mode] = json.loads(raw.decode().strip().splitlines()[-1])
+        except Exception as e:
+            out[mode] = {"error": str(e)}
+    return out
+
+
+# ---------------- MAIN --------------------------
+
+async def main(args):
+    stub = StubLLM(args.latency_ms, args.jitter_ms, args.rate_429, chunk_delay_ms=args.chunk_delay_ms)
+    url = await stub.start()
+    mod, client, bot_user = load_bot(args, url)
+    start_background(mod)
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "bot": args.bot,
+            "python": platform.python_version(),
+            "timestamp": time.time(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "micro": {"can_send_in_guild": bench_rate_limit(mod)},
+        "guilds": {},
+    }
+
+    try:
+        results["micro"]["call_openrouter"] = await bench_call_openrouter(client, stub)
+        for gi, size in enumerate(args.sizes):
+            started = time.perf_counter()
+            guild = FakeGuild(10_000 + gi * 100, f"bench-{size}", size, max(args.channels, 1), bot_user, chunked=not args.lean)
+            setup_s = time.perf_counter() - started
+            print(f"guild of {size} members ...", file=sys.stderr)
+            results["guilds"][str(size)] = {
+                "setup_s": setup_s,
+                "startup": bench_startup(args.bot, size),
+                "is_addressed": await bench_is_addressed(mod, guild, bot_user),
+                "fetch_ai_response": await bench_fetch(mod, guild, bot_user, stub),
+                "end_to_end": await bench_end_to_end(mod, guild, bot_user, stub, args),
+                "allocations": await bench_allocations(mod, guild, bot_user, args),
+            }
+    finally:
+        await stub.stop()
+        closer = getattr(importlib.import_module("llm_client"), "close_providers", None)
+        if closer:
+            await closer()
+    return results
+
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def compare(old, new):
+    a, b = flatten(old), flatten(new)
+    for key in sorted(b):
+        if key.startswith("meta.") or key not in a:
+            continue
+        before, after = a[key], b[key]
+        change = ((after - before) / before * 100) if before else 0.0
+        flag = "  <--" if abs(change) >= 20 else ""
+        print(f"{key:70s} {before:14.3f} -> {after:14.3f} ({change:+6.1f}%){flag}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Discord bots.")
+    parser.add_argument("--bot", default="bot", choices=["bot", "p"], help="which bot module to drive")
+    parser.add_argument("--sizes", default="10,1000,50000", type=lambda s: [int(x) for x in s.split(",")])
+    parser.add_argument("--messages", type=int, default=300, help="end-to-end messages per guild")
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=0, help="messages/s to dispatch (0 = one burst)")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--chunk-delay-ms", type=float, default=15)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of stub replies that are 429")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--coalesce-window", type=float, default=None)
+    parser.add_argument("--lean", action="store_true", help="run the bot in lean intents mode")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="apply the real per-guild limits")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results JSON to diff against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,108 @@
+"""Startup cost of one guild in full vs lean intents mode.
+
+Builds a real discord.Guild from a synthetic GUILD_CREATE payload using the
+bot's own ConnectionState (so its intents and member cache flags apply),
+then the member index, and reports the time taken and the RSS it adds.
+Full mode gets every member plus presences, as after chunking; lean mode
+gets only the bot's own member, as Discord sends for an unchunked guild.
+Run in a fresh process per mode so RSS numbers don't bleed together:
+
+    python -m bench.startup --bot bot --mode lean --size 50000
+"""
+
+import argparse
+import contextlib
+import gc
+import importlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+
+CHUNK_SIZE = 1000  # members per GUILD_MEMBERS_CHUNK
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * (os.sysconf("SC_PAGE_SIZE") // 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def role(role_id: int, name: str, permissions: int = 0, position: int = 0) -> dict:
+    return {
+        "id": str(role_id), "name": name, "permissions": str(permissions), "position": position,
+        "color": 0, "hoist": False, "managed": False, "mentionable": False,
+    }
+
+
+def member(user_id: int, name: str, roles: list[int]) -> dict:
+    return {
+        "user": {"id": str(user_id), "username": name, "discriminator": "0", "avatar": None, "global_name": None},
+        "roles": [str(r) for r in roles], "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False, "mute": False, "nick": None, "flags": 0,
+    }
+
+
+def guild_payload(guild_id: int, size: int, bot_id: int, full: bool) -> dict:
+    roles = [role(guild_id, "@everyone"), role(guild_id + 1, "Moderator", 1 << 13, 9), role(guild_id + 2, "Admin", 1 << 3, 10)]
+    roles += [role(guild_id + 10 + i, f"role-{i}", 0, i + 1) for i in range(8)]
+    members = [member(bot_id, "Ardunot-v2", [])]
+    presences = []
+    if full:
+        for i in range(size):
+            uid = guild_id * 1_000_000 + i
+            extra = [guild_id + 1] if i % 500 == 1 else []
+            members.append(member(uid, f"user{i}", [guild_id + 10 + i % 8, *extra]))
+            presences.append({"user": {"id": str(uid)}, "status": "online", "activities": [], "client_status": {"desktop": "online"}})
+    return {
+        "id": str(guild_id), "name": f"bench-{size}", "owner_id": str(bot_id), "roles": roles,
+        "members": members, "presences": presences, "channels": [], "emojis": [], "stickers": [],
+        "features": [], "member_count": size, "large": size > 250,
+    }
+
+
+def measure(bot: str, mode: str, size: int) -> dict:
+    os.environ.pop("DISCORD_TOKEN", None)
+    os.environ["LEAN_INTENTS"] = "1" if mode == "lean" else "0"
+    os.environ["STATE_DB"] = os.path.join(tempfile.mkdtemp(prefix="ardunot-bench-"), "state.db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        mod = importlib.import_module(bot)
+    from bench.fakes import make_bot_user
+
+    state = mod.bot._connection
+    bot_user = make_bot_user()
+    state.user = bot_user
+    import discord
+
+    payload = guild_payload(42_000, size, bot_user.id, full=mode == "full")
+    gc.collect()
+    rss_before = rss_kb()
+    started = time.perf_counter()
+    guild = discord.Guild(data=payload, state=state)
+    index = mod.get_member_index(guild)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+
+    return {
+        "mode": mode,
+        "intents": state._intents.value,
+        "chunk_at_startup": state._chunk_guilds,
+        "chunk_requests": -(-size // CHUNK_SIZE) if mode == "full" else 0,
+        "parse_and_index_s": elapsed,
+        "members_cached": len(guild.members),
+        "members_indexed": len(index),
+        "rss_delta_kb": rss_kb() - rss_before,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure per-guild startup cost in one intents mode.")
+    parser.add_argument("--bot", default="bot", choices=["bot", "p"])
+    parser.add_argument("--mode", default="full", choices=["full", "lean"])
+    parser.add_argument("--size", type=int, default=1000)
+    args = parser.parse_args()
+    print(json.dumps(measure(args.bot, args.mode, args.size)))
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+from prompt_budget import MESSAGE_OVERHEAD, estimate_tokens
+
+# provider-side prompt caching works on whole prefix blocks; ~128 tokens
+CACHE_BLOCK_CHARS = 512
+
+
+class StubLLM:
+    # Local OpenAI-compatible /chat/completions endpoint with configurable
+    # latency, 429 rate and SSE streaming. Records what it was sent. Like the
+    # real providers it caches prompt prefixes in blocks and reports
+    # usage.prompt_tokens_details.cached_tokens.
+
+    def __init__(self, latency_ms: float = 50, jitter_ms: float = 10, rate_429: float = 0.0,
+                 chunks: int = 8, chunk_delay_ms: float = 15, reply: str = "Sure, here is a short answer for you.",
+                 seed: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay_ms / 1000
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.streams = 0
+        self.throttled = 0
+        self.prompt_chars: list[int] = []
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.prefixes: set[int] = set()
+        self.runner: web.AppRunner | None = None
+        self.url = None
+
+    def reset(self):
+        self.requests = self.streams = self.throttled = 0
+        self.prompt_chars = []
+        self.prompt_tokens = self.cached_tokens = 0
+
+    def usage(self, messages: list[dict]) -> dict:
+        text = "".join(f"{m.get('role')}\n{m.get('content') or ''}\n" for m in messages)
+        total = sum(estimate_tokens(m.get("content") or "") + MESSAGE_OVERHEAD for m in messages)
+        cached_chars = 0
+        for end in range(CACHE_BLOCK_CHARS, len(text) + 1, CACHE_BLOCK_CHARS):
+            key = hash(text[:end])
+            if key in self.prefixes:
+                cached_chars = end
+            else:
+                self.prefixes.add(key)
+        cached = total * cached_chars // len(text) if text else 0
+        self.prompt_tokens += total
+        self.cached_tokens += cached
+        return {"prompt_tokens": total, "prompt_tokens_details": {"cached_tokens": cached}}
+
+    async def handle(self, request: web.Request):
+        body = await request.json()
+        self.requests += 1
+        self.prompt_chars.append(sum(len(m.get("content") or "") for m in body.get("messages", [])))
+
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        usage = self.usage(body.get("messages", []))
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": self.reply}}], "usage": usage})
+
+        self.streams += 1
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        words = self.reply.split(" ")
+        step = max(1, len(words) // self.chunks)
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+            event = {"choices": [{"delta": {"content": piece}}]}
+            await resp.write(f"data: {json.dumps(event)}\n\n".encode())
+            await asyncio.sleep(self.chunk_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/v1/chat/completions"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def serve(args):
+    stub = StubLLM(args.latency_ms, args.jitter_ms, args.rate_429)
+    url = await stub.start(port=args.port)
+    print(f"Stub LLM listening on {url}")
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stub LLM server on its own.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    asyncio.run(serve(parser.parse_args()))
@@ -1,28 +1,157 @@
 import os
 import discord
 from discord.ext import commands
-from collections import deque
-import aiohttp
 import asyncio
 import re
+import time
 from datetime import datetime, timedelta, timezone
 
 # --- CONFIGURATION ---
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-from openrouter_client import call_openrouter
+from openrouter_client import openrouter_provider, stream_openrouter
+from llm_client import CACHE, LLMFailure, ProviderChain, failure_message, register_provider, use_shared_cache
+from streaming import relay_stream
+from coalescer import ChannelCoalescer
+from scheduler import LLMScheduler, QueueFull
+from memory import ChannelMemory
+from retrieval import RetrievalIndex
+from state_store import StateStore, PersistentDict, encode_datetime, decode_datetime
+from rate_limiter import RateLimiter, ShushTimer
+from member_index import get_member_index, drop_member_index, MemberTTLCache
+from sent_cache import SentMessageCache
+from metrics import METRICS, stage
+from prompt_budget import PromptAssembler
+from cluster import ClusterClient, shard_state_path
+from router import ModelRouter, Tier
+from outbound import OutboundDispatcher
+from trace_recorder import TraceRecorder
+from prompt_prefix import PrefixCache
+
+# lean mode: no presences and no member chunking at startup; the members a
+# prompt needs are fetched on demand and held for MEMBER_TTL_SECONDS
+LEAN_INTENTS = os.getenv("LEAN_INTENTS", "0") == "1"
+MEMBER_TTL_SECONDS = float(os.getenv("MEMBER_TTL_SECONDS", 1800))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 20000))
+
+if LEAN_INTENTS:
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    bot_options = {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags.none()}
+else:
+    intents = discord.Intents.all()
+    bot_options = {}
+
+member_cache = MemberTTLCache(MEMBER_TTL_SECONDS, MEMBER_CACHE_SIZE)
+
+# cluster mode: cluster.py starts each worker with its shards and the
+# coordinator socket (shared provider slots, rate limits and response cache)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0))
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s]
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET")
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None, **bot_options)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, **bot_options)
+
+cluster = ClusterClient(CLUSTER_SOCKET) if CLUSTER_SOCKET else None
+if cluster is not None:
+    use_shared_cache(cluster)
+
+MODEL = os.getenv("MODEL", "openai/gpt-3.5-turbo")
+TEMPERATURE = 0.6
+
+# small talk and banter go to a cheaper, faster model (see MODEL_ROUTER)
+FAST_MODEL = os.getenv("FAST_MODEL", "meta-llama/llama-3.2-3b-instruct")
+
+# this bot's own key, looked up now so host.py personas don't share one
+OPENROUTER = openrouter_provider()
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+# secondary provider for hedging/failover, skipped when HF_API_KEY is unset
+HF_URL = os.getenv("HF_URL", "https://router.huggingface.co/v1/chat/completions")
+HF_MODEL = "meta-llama/Llama-3.2-3B-Instruct"
+HF = register_provider("hf", HF_URL, os.getenv("HF_API_KEY"))
+
+LLM_CHAIN = ProviderChain([(OPENROUTER, MODEL), (HF, HF_MODEL)], hedge=os.getenv("LLM_HEDGE", "1") == "1")
+FAST_CHAIN = ProviderChain([(OPENROUTER, FAST_MODEL), (HF, HF_MODEL)], hedge=os.getenv("LLM_HEDGE", "1") == "1")
+
+# edit a placeholder message as tokens stream in instead of waiting for the full reply
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
 
 CREATOR_ID = 1020353220641558598
 OWNER_IDS = {1020353220641558598, 1167443519070290051}
 
-# unlimited memory per channel
-channel_memory = {}
+# bounded memory per channel, idle channels evicted LRU-first
+MEMORY_PER_CHANNEL = int(os.getenv("MEMORY_PER_CHANNEL", 40))
+MEMORY_GLOBAL_CAP = int(os.getenv("MEMORY_GLOBAL_CAP", 20000))
+MEMORY_IDLE_SECONDS = int(os.getenv("MEMORY_IDLE_SECONDS", 6 * 3600))
+MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", 12))
+
+# max members described in the prompt (author, mentions, recent speakers), and
+# max staff in the cached prompt prefix
+MEMBER_SLICE_LIMIT = int(os.getenv("MEMBER_SLICE_LIMIT", 40))
+
+# input-side token budget per model; members and history are trimmed to fit
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1500))
+PROMPT_FAST_TOKEN_BUDGET = int(os.getenv("PROMPT_FAST_TOKEN_BUDGET", 900))
+PROMPT_BUDGETS = {MODEL: PROMPT_TOKEN_BUDGET, FAST_MODEL: PROMPT_FAST_TOKEN_BUDGET}
+# the user's own message is cut beyond this many tokens
+PROMPT_USER_CAP = int(os.getenv("PROMPT_USER_CAP", 400))
+# the cached prefix (staff roster included) stays within this many tokens,
+# so it fits the smallest budget next to a full-length user message
+PROMPT_PREFIX_CAP = int(os.getenv("PROMPT_PREFIX_CAP", 400))
+# newest history lines that outrank the wider member list
+PROMPT_RECENT_HISTORY = int(os.getenv("PROMPT_RECENT_HISTORY", 4))
+
+# route each request to the fast or strong chain by a local complexity score,
+# adjusted by the models' recent latency and errors; MODEL_ROUTER=0 sends
+# everything to the strong chain
+MODEL_ROUTER = os.getenv("MODEL_ROUTER", "1") == "1"
+ROUTER_STRONG_SCORE = int(os.getenv("ROUTER_STRONG_SCORE", 3))
+ROUTER_BORDERLINE_P50 = float(os.getenv("ROUTER_BORDERLINE_P50", 6.0))
+
+router = ModelRouter(
+    Tier("fast", FAST_CHAIN),
+    Tier("strong", LLM_CHAIN),
+    ROUTER_STRONG_SCORE,
+    ROUTER_BORDERLINE_P50,
+    enabled=MODEL_ROUTER
+)
+
+# IDs of messages the bot sent, so reply detection rarely needs fetch_message
+SENT_CACHE_SIZE = int(os.getenv("SENT_CACHE_SIZE", 5000))
+BACKFILL_CHANNELS = int(os.getenv("BACKFILL_CHANNELS", 50))
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", 100))
+
+sent_cache = SentMessageCache(SENT_CACHE_SIZE)
+
+# modes, shushes and memory survive restarts (lazy-loaded, write-behind)
+STATE_DB = os.getenv("STATE_DB", "ardunot_state.db")
+if CLUSTER_SOCKET and SHARD_IDS:
+    # cluster worker: its own file for the guilds its shards own
+    STATE_DB = shard_state_path(STATE_DB, SHARD_IDS)
+state_store = StateStore(STATE_DB, float(os.getenv("STATE_FLUSH_SECONDS", 2.0)))
+
+# long history per channel, searched (BM25) for messages related to the question;
+# the top hits from outside the live window go into the prompt. 0 turns it off
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 4))
+# sized against channel memory: twice MEMORY_GLOBAL_CAP in all, or the same
+# in lean mode, so the index can't outgrow the memory ceiling by default
+RETRIEVAL_PER_CHANNEL = int(os.getenv("RETRIEVAL_PER_CHANNEL", 200 if LEAN_INTENTS else 500))
+RETRIEVAL_GLOBAL_CAP = int(os.getenv("RETRIEVAL_GLOBAL_CAP", MEMORY_GLOBAL_CAP * (1 if LEAN_INTENTS else 2)))
+
+retrieval_index = RetrievalIndex(RETRIEVAL_PER_CHANNEL, RETRIEVAL_GLOBAL_CAP, MEMORY_IDLE_SECONDS, state_store)
+
+channel_memory = ChannelMemory(
+    MEMORY_PER_CHANNEL, MEMORY_GLOBAL_CAP, MEMORY_IDLE_SECONDS, state_store,
+    retrieval_index if RETRIEVAL_TOP_K else None
+)
 
-shushed_channels = {}
-server_modes = {}
+shushed_channels = PersistentDict(state_store, "shush", encode_datetime, decode_datetime)
+shush_timer = ShushTimer(shushed_channels)
+server_modes = PersistentDict(state_store, "mode")
 GLOBAL_DEFAULT_MODE = "serious"
 
 RATE_WINDOW_SECONDS = 60
@@ -32,7 +161,39 @@ RATE_LIMITS = {
     "funny": 6
 }
 
-rate_buckets = {}
+# per-channel and per-user tiers on top of the per-guild mode limit
+CHANNEL_RATE_LIMIT = int(os.getenv("CHANNEL_RATE_LIMIT", 6))
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", 4))
+# a reply over budget by less than this waits for room instead of being dropped
+RATE_MAX_WAIT = float(os.getenv("RATE_MAX_WAIT", 10))
+
+rate_limiter = RateLimiter()
+
+# outgoing replies are queued per channel and paced to Discord's send buckets
+# (5 per 5s per channel, ~50/s per bot) so bursts never hit a 429
+OUTBOUND_CHANNEL_LIMIT = int(os.getenv("OUTBOUND_CHANNEL_LIMIT", 5))
+OUTBOUND_CHANNEL_PERIOD = float(os.getenv("OUTBOUND_CHANNEL_PERIOD", 5.0))
+OUTBOUND_GLOBAL_PER_SECOND = int(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", 45))
+
+outbound = OutboundDispatcher(
+    rate_limiter,
+    OUTBOUND_CHANNEL_LIMIT,
+    OUTBOUND_CHANNEL_PERIOD,
+    OUTBOUND_GLOBAL_PER_SECOND,
+    on_sent=lambda m: sent_cache.add(m.id),
+    # cluster mode: the bot-wide send bucket is shared by every worker
+    shared=cluster.rate if cluster is not None else None
+)
+
+# local Prometheus endpoint, off unless METRICS_PORT is set
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_TOP_CHANNELS = int(os.getenv("METRICS_TOP_CHANNELS", 20))
+
+# optional JSONL trace of incoming traffic and reply outcomes, for bench/replay.py
+TRACE_PATH = os.getenv("TRACE_PATH")
+trace = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+
 current_mode_global = GLOBAL_DEFAULT_MODE
 
 # ORIGINAL DEFAULT FI (no roasting)
@@ -79,66 +240,283 @@ def extract_time(text: str):
 
 # -------------------- OPENROUTER AI RESPONSE ------------------------
 
-async def fetch_ai_response(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member):
-
-    mem = channel_memory.get(channel.id, [])
-    history_text = "\n".join(mem)
-
+def build_prefix(guild: discord.Guild, mode: str) -> str:
+    # Same for every request in the guild until prefix_cache rebuilds it
+    personality = SERIOUS_INSTRUCTIONS if mode == "serious" else FUNNY_INSTRUCTIONS
     try:
-        member_info_list = [
-            {
-                "id": m.id,
-                "name": m.display_name,
-                "roles": [r.name for r in m.roles if r.name != "@everyone"]
-            }
-            for m in guild.members
-        ]
+        staff = get_member_index(guild).staff_roster(MEMBER_SLICE_LIMIT)
     except:
-        member_info_list = []
-
-    mode = server_modes.get(guild.id, current_mode_global)
-    personality = SERIOUS_INSTRUCTIONS if mode == "serious" else FUNNY_INSTRUCTIONS
-
-    system_prompt = (
+        staff = []
+    head = (
         f"You are Ardunot-v2 in server '{guild.name}'.\n\n"
         f"Call Realboy9000 'mate'. Never reveal IDs or creators.\n"
-        f"Members: {member_info_list}\n"
         f"Never mention @.\n"
         f"{personality}\n"
         f"Talk even when chat is dead.\n"
         f"Moderators: aarav-2022, Supratsa, Gleb momot. "
         f"Admins: Realboy9000, theolego.\n"
+        f"Staff: "
     )
+    # the roster is cut by tokens, not just count, so it can't crowd out the user
+    prompt = PromptAssembler(PROMPT_PREFIX_CAP)
+    head = prompt.fixed("prefix", head)
+    staff = prompt.fill("staff", staff, separator_tokens=2)
+    return head + f"{staff}\n"
+
+prefix_cache = PrefixCache(build_prefix)
+
+def build_prompt(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=(), model: str = MODEL) -> str:
+    # The cached guild prefix comes first and unchanged, so provider prompt
+    # caching can reuse it; everything per-request follows. Sections are
+    # budgeted in priority order: prefix, the user's message, author and
+    # mentions, newest history, related older messages, other members, older
+    # history.
+
+    line = lambda e: f"BOT: {e.text}" if e.role == "assistant" else f"{e.name}: {e.text}"
+    mem = channel_memory.window(channel.id, MEMORY_WINDOW)
+    newest_first = [line(e) for e in reversed(mem)]
+    related = []
+    if RETRIEVAL_TOP_K:
+        with stage("retrieval"):
+            related = [line(e) for e in retrieval_index.search(channel.id, user_msg, RETRIEVAL_TOP_K, mem[0].ts if mem else None)]
+
+    relevant_ids = [author.id, *(m.id for m in mentioned), *(e.author_id for e in reversed(mem) if e.role == "user")]
+    core_ids = {author.id, *(m.id for m in mentioned)}
+    try:
+        # staff in the prefix's roster are described there already
+        member_info_list = get_member_index(guild).relevant_slice(relevant_ids, MEMBER_SLICE_LIMIT, MEMBER_SLICE_LIMIT, core_ids)
+    except:
+        member_info_list = []
 
-    prompt = (
-        system_prompt
+    prefix = prefix_cache.get(guild, server_modes.get(guild.id, current_mode_global))
+
+    frame = "Members: []\n" + "\n\n--- Recent Messages ---\n\n\n--- User Message ---\n"
+    prompt = PromptAssembler(PROMPT_BUDGETS.get(model, PROMPT_TOKEN_BUDGET), model)
+    # the user's message (up to PROMPT_USER_CAP) is set aside before the
+    # prefix is spent, so the prefix is what gets cut on a small budget
+    reserve = min(PROMPT_USER_CAP, prompt.counter.count(user_msg, model)) + prompt.counter.count(frame, model)
+    prefix = prompt.fixed("system", prefix, max(0, prompt.left - reserve))
+    prompt.fixed("system", frame)
+    user_msg = prompt.fixed("user", user_msg, PROMPT_USER_CAP)
+
+    members = prompt.fill("members", [m for m in member_info_list if m["id"] in core_ids], separator_tokens=2)
+    history = prompt.fill("history", newest_first[:PROMPT_RECENT_HISTORY])
+    if related:
+        related_head = prompt.fixed("related", "\n\n--- Earlier, Related ---\n")
+        related = prompt.fill("related", related)
+    members += prompt.fill("members", [m for m in member_info_list if m["id"] not in core_ids], separator_tokens=2)
+    if len(history) == len(newest_first[:PROMPT_RECENT_HISTORY]):
+        history += prompt.fill("history", newest_first[PROMPT_RECENT_HISTORY:])
+    prompt.record()
+
+    return (
+        prefix
+        + f"Members: {members}\n"
+        + (related_head + "\n".join(related) if related else "")
         + "\n\n--- Recent Messages ---\n"
-        + history_text
+        + "\n".join(reversed(history))
         + "\n\n--- User Message ---\n"
         + user_msg
     )
 
-    return await call_openrouter(
-        prompt=prompt,
-        model="openai/gpt-3.5-turbo",
-        temperature=0.6
-    )
+async def load_prompt_members(guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=()):
+    # lean mode: index the author and mentions from the message itself, and
+    # fetch any recent speakers that aren't held any more
+    for member in (author, *mentioned):
+        if hasattr(member, "roles"):
+            member_cache.touch(guild, member)
+    speakers = [e.author_id for e in channel_memory.window(channel.id, MEMORY_WINDOW) if e.role == "user"]
+    await member_cache.ensure(guild, speakers)
+
+def route_request(user_msg: str, guild: discord.Guild) -> Tier:
+    return router.route(user_msg, server_modes.get(guild.id, current_mode_global))
+
+async def fetch_ai_response(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=()):
+    tier = route_request(user_msg, guild)
+    if LEAN_INTENTS:
+        with stage("member_load"):
+            await load_prompt_members(guild, channel, author, mentioned)
+    with stage("prompt_build"):
+        prompt = build_prompt(user_msg, guild, channel, author, mentioned, tier.model or MODEL)
+    with stage("llm"):
+        return await complete_prompt(prompt, tier)
+
+FAILED_REPLY = "⚠️ I'm having trouble responding right now."
+
+async def generate_reply(prompt: str, tier: Tier | None = None) -> str:
+    # raises LLMFailure; complete_prompt() turns that into a message
+    chain = LLM_CHAIN if tier is None else tier.chain
+    if not chain.entries:
+        raise LLMFailure("no_provider", "OpenRouter API key missing")
+    return await chain.complete([{"role": "user", "content": prompt}], temperature=TEMPERATURE)
+
+async def complete_prompt(prompt: str, tier: Tier | None = None) -> str:
+    try:
+        return await generate_reply(prompt, tier)
+    except LLMFailure as e:
+        print("LLM call failed:", e)
+        return failure_message(e, FAILED_REPLY)
+
+async def stream_ai_response(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=()):
+    # Placeholder message edited as tokens arrive; falls back to a plain call
+    # if nothing streams.
+    # Returns (text, complete), see relay_stream.
+    tier = route_request(user_msg, guild)
+    # streaming is OpenRouter-only, so use the tier's OpenRouter model
+    model = next((m for p, m in tier.chain.entries if p is OPENROUTER), MODEL)
+    if LEAN_INTENTS:
+        with stage("member_load"):
+            await load_prompt_members(guild, channel, author, mentioned)
+    with stage("prompt_build"):
+        prompt = build_prompt(user_msg, guild, channel, author, mentioned, model)
+    with stage("llm_stream"):
+        return await relay_stream(
+            channel,
+            stream_openrouter(prompt=prompt, model=model, temperature=TEMPERATURE, provider=OPENROUTER),
+            lambda: generate_reply(prompt, tier),
+            outbound.send,
+            lambda e: failure_message(e, FAILED_REPLY) if isinstance(e, LLMFailure) else FAILED_REPLY
+        )
 
 # ---------------- RATE LIMIT ---------------------
 
-def can_send_in_guild(guild_id: int, mode: str, channel_id: int) -> bool:
-    now = datetime.now(timezone.utc)
-    bucket = rate_buckets.setdefault(guild_id, deque())
+def rate_rules(guild_id: int, mode: str, channel_id: int, user_id: int | None = None):
+    rules = [
+        ("guild", guild_id, RATE_LIMITS.get(mode, RATE_LIMITS["serious"]), RATE_WINDOW_SECONDS),
+        ("channel", channel_id, CHANNEL_RATE_LIMIT, RATE_WINDOW_SECONDS),
+    ]
+    if user_id is not None:
+        rules.append(("user", user_id, USER_RATE_LIMIT, RATE_WINDOW_SECONDS))
+    return rules
+
+def rate_check(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> float:
+    # 0.0 when allowed (budget consumed), else seconds until there is room
+    return rate_limiter.acquire(rate_rules(guild_id, mode, channel_id, user_id))
+
+def can_send_in_guild(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> bool:
+    return rate_check(guild_id, mode, channel_id, user_id) == 0.0
+
+async def shared_rate_check(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> float:
+    # in cluster mode the coordinator holds the buckets, so a user's budget is
+    # shared across shards; local buckets are the fallback
+    if cluster is not None:
+        try:
+            return await cluster.rate(rate_rules(guild_id, mode, channel_id, user_id))
+        except Exception as e:
+            print("Cluster rate check failed:", e)
+    return rate_check(guild_id, mode, channel_id, user_id)
+
+# ---------------- COALESCING ----------------------
+
+# addressed messages landing in one channel within the window share one reply
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0.8))
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 3.0))
+
+# shared LLM worker pool: guilds served round-robin, bounded queue per guild
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", 4))
+LLM_QUEUE_DEPTH = int(os.getenv("LLM_QUEUE_DEPTH", 8))
+LLM_QUEUE_POLICY = os.getenv("LLM_QUEUE_POLICY", "drop_oldest")
+
+llm_scheduler = LLMScheduler(LLM_WORKERS, LLM_QUEUE_DEPTH, LLM_QUEUE_POLICY)
+
+def combine_batch(batch: list[discord.Message]):
+    if len(batch) == 1:
+        return batch[0].content.strip(), batch[0].mentions
+
+    lines = [f"{m.author.display_name}: {m.content.strip()}" for m in batch]
+    mentioned = list({u.id: u for m in batch for u in m.mentions}.values())
+    user_msg = (
+        "Several messages arrived together. Answer all of them in one reply:\n"
+        + "\n".join(lines)
+    )
+    return user_msg, mentioned
+
+async def reply_to_batch(channel_id: int, batch: list[discord.Message]):
+    message = batch[-1]
+    mode = server_modes.get(message.guild.id, current_mode_global)
 
-    while bucket and (now - bucket[0]).total_seconds() > RATE_WINDOW_SECONDS:
-        bucket.popleft()
+    wait = await shared_rate_check(message.guild.id, mode, channel_id, message.author.id)
+    if 0 < wait <= RATE_MAX_WAIT:
+        METRICS.inc("rate_limited_total", outcome="delayed")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "rate_delayed")
+        with stage("rate_wait"):
+            await asyncio.sleep(wait)
+        wait = await shared_rate_check(message.guild.id, mode, channel_id, message.author.id)
+    if wait:
+        METRICS.inc("rate_limited_total", outcome="dropped")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "rate_dropped")
+        return
 
-    limit = RATE_LIMITS.get(mode, RATE_LIMITS["serious"])
+    user_msg, mentioned = combine_batch(batch)
 
-    if len(bucket) < limit:
-        bucket.append(now)
-        return True
-    return False
+    generate = stream_ai_response if STREAM_REPLIES else fetch_ai_response
+    queued = time.perf_counter()
+
+    async def job():
+        METRICS.observe("stage_seconds", time.perf_counter() - queued, stage="queue_wait")
+        if cluster is None:
+            return await generate(user_msg, message.guild, message.channel, message.author, mentioned)
+        async with cluster.slot():
+            return await generate(user_msg, message.guild, message.channel, message.author, mentioned)
+
+    try:
+        if STREAM_REPLIES:
+            reply = await llm_scheduler.submit(message.guild.id, job)
+        else:
+            async with outbound.typing(message.channel):
+                reply = await llm_scheduler.submit(message.guild.id, job)
+    except QueueFull:
+        METRICS.inc("queue_dropped_total")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "queue_dropped")
+        return
+    METRICS.inc("replies_total")
+
+    if STREAM_REPLIES:
+        reply, complete = reply
+        # a cut-off or error reply isn't something the bot said
+        if complete:
+            channel_memory.append(channel_id, bot.user.id, bot.user.display_name, "assistant", reply)
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "replied")
+        return
+
+    channel_memory.append(channel_id, bot.user.id, bot.user.display_name, "assistant", reply)
+
+    with stage("send"):
+        await outbound.send(message.channel, reply)
+    if trace is not None:
+        for m in batch:
+            trace.outcome(m.id, "replied")
+
+coalescer = ChannelCoalescer(reply_to_batch, COALESCE_WINDOW, COALESCE_MAX_WAIT)
+
+# ---------------- METRICS -------------------------
+
+def memory_by_channel():
+    # largest channels only, to keep the series count bounded
+    top = sorted(channel_memory.channels.items(), key=lambda kv: len(kv[1]), reverse=True)[:METRICS_TOP_CHANNELS]
+    return {(("channel", channel_id),): len(buf) for channel_id, buf in top}
+
+METRICS.gauge("memory_entries", lambda: len(channel_memory), "Chat memory entries across all channels")
+METRICS.gauge("memory_channels", lambda: len(channel_memory.channels), "Channels with chat memory loaded")
+METRICS.gauge("memory_channel_entries", memory_by_channel, "Chat memory entries in the largest channels")
+METRICS.gauge("llm_queue_depth", lambda: llm_scheduler.depth(), "Jobs waiting for an LLM worker")
+METRICS.gauge("llm_running", lambda: llm_scheduler.running, "Jobs running on LLM workers")
+METRICS.gauge("response_cache_hit_rate", lambda: CACHE.stats()["hit_rate"], "Response cache hit rate")
+METRICS.gauge("sent_cache_hit_rate", lambda: sent_cache.stats()["hit_rate"], "Reply checks answered without fetch_message")
+METRICS.gauge("shushed_channels", lambda: len(shushed_channels), "Channels currently shushed")
+METRICS.gauge("member_cache_size", lambda: len(member_cache), "Members held by the lean-mode TTL cache")
+METRICS.gauge("retrieval_documents", lambda: len(retrieval_index), "Messages held by the retrieval index")
+METRICS.gauge("retrieval_hit_rate", lambda: retrieval_index.stats()["hit_rate"], "Retrieval searches that found a related message")
+METRICS.gauge("outbound_queued", lambda: sum(len(q) for q in outbound.queues.values()), "Replies waiting in per-channel send queues")
+METRICS.gauge("prompt_prefixes", lambda: len(prefix_cache), "Guilds with a cached prompt prefix")
 
 # ---------------- ADDRESS CHECK -------------------
 
@@ -151,12 +529,19 @@ async def is_addressed(message: discord.Message) -> bool:
             ref = message.reference
             if isinstance(ref.resolved, discord.Message):
                 return ref.resolved.author.id == bot.user.id
-            else:
-                try:
-                    fetched = await message.channel.fetch_message(ref.message_id)
-                    return fetched.author.id == bot.user.id
-                except:
-                    pass
+            if isinstance(ref.resolved, discord.DeletedReferencedMessage):
+                return False
+            known = sent_cache.lookup(ref.message_id, message.channel.id)
+            if known is not None:
+                return known
+            try:
+                METRICS.inc("reference_fetches_total")
+                fetched = await message.channel.fetch_message(ref.message_id)
+                ours = fetched.author.id == bot.user.id
+                sent_cache.remember(ref.message_id, ours)
+                return ours
+            except:
+                pass
         return False
     except:
         return False
@@ -198,9 +583,20 @@ async def shush_bot(ctx, *args):
 
     resume = datetime.now(timezone.utc) + timedelta(seconds=duration_seconds)
     shushed_channels[ctx.channel.id] = resume
+    shush_timer.schedule(ctx.channel.id, resume)
 
     await ctx.send(f"🔇 Muted until **{discord.utils.format_dt(resume, 'T')}** ({duration_display}).")
 
+@bot.command(name='stats')
+@commands.check(check_if_admin)
+async def show_stats(ctx):
+    lines = METRICS.summary()
+    text = "\n".join(lines)
+    while len(text) > 1900:
+        lines.pop()
+        text = "\n".join(lines) + "\n..."
+    await ctx.send(f"```\n{text}\n```")
+
 @bot.command(name='rshush')
 async def resume_shush(ctx):
     if ctx.channel.id in shushed_channels:
@@ -211,18 +607,90 @@ async def resume_shush(ctx):
 
 # ---------------- EVENTS --------------------------
 
+async def backfill_sent_cache():
+    # Most active readable channels first; each one fetched is then covered
+    # down to its oldest message so older replies resolve locally too.
+    channels = [
+        ch for g in bot.guilds for ch in g.text_channels
+        if ch.permissions_for(g.me).read_message_history
+    ]
+    channels.sort(key=lambda ch: ch.last_message_id or 0, reverse=True)
+    for ch in channels[:BACKFILL_CHANNELS]:
+        oldest = None
+        try:
+            async for msg in ch.history(limit=BACKFILL_LIMIT):
+                oldest = msg.id
+                if msg.author.id == bot.user.id:
+                    sent_cache.add(msg.id)
+        except Exception as e:
+            print(f"Backfill skipped {ch.id}:", e)
+            continue
+        if oldest is not None:
+            sent_cache.mark_backfilled(ch.id, oldest)
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user}")
+    state_store.start()
+    rate_limiter.start()
+    # shushes from before a restart expire on time too, not on the next message
+    shushed_channels.load_all()
+    for channel_id, resume in list(shushed_channels.items()):
+        shush_timer.schedule(channel_id, resume)
+    shush_timer.start()
+    if METRICS_PORT:
+        try:
+            await METRICS.serve(METRICS_PORT, METRICS_HOST)
+        except Exception as e:
+            print("Metrics server error:", e)
+    if not sent_cache.horizons:
+        asyncio.create_task(backfill_sent_cache())
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} slash commands.")
     except Exception as e:
         print("Sync error:", e)
 
+@bot.event
+async def on_member_join(member):
+    if not LEAN_INTENTS:
+        get_member_index(member.guild).upsert_member(member)
+
+@bot.event
+async def on_member_remove(member):
+    get_member_index(member.guild).remove_member(member.id)
+    member_cache.forget(member.guild.id, member.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if LEAN_INTENTS:
+        member_cache.refresh(after)
+    else:
+        get_member_index(after.guild).upsert_member(after)
+
+@bot.event
+async def on_guild_role_create(role):
+    get_member_index(role.guild).upsert_role(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    get_member_index(after.guild).upsert_role(after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    get_member_index(role.guild).remove_role(role.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    drop_member_index(guild.id)
+    prefix_cache.invalidate(guild.id)
+
 @bot.event
 async def on_message(message):
+    if trace is not None:
+        trace.message(message, bot.user)
     if message.author == bot.user:
+        sent_cache.add(message.id)
         return
 
     await bot.process_commands(message)
@@ -236,40 +704,41 @@ async def on_message(message):
     if bot.user.mentioned_in(message) and any(w in clean.lower() for w in ["stop", "plz stop"]):
         resume = datetime.now(timezone.utc) + timedelta(seconds=180)
         shushed_channels[channel_id] = resume
-        return await message.channel.send(
-            f"🤐 Ok, quiet for 3 min (until {discord.utils.format_dt(resume, 'T')})."
+        shush_timer.schedule(channel_id, resume)
+        await outbound.send(
+            message.channel,
+            f"🤐 Ok, quiet for 3 min (until {discord.utils.format_dt(resume, 'T')}).",
+            merge=False
         )
+        return
 
     if channel_id in shushed_channels:
         if datetime.now(timezone.utc) < shushed_channels[channel_id]:
+            METRICS.inc("shush_suppressed_total")
+            if trace is not None:
+                trace.outcome(message.id, "shushed")
             return
         else:
             del shushed_channels[channel_id]
 
-    if channel_id not in channel_memory:
-        channel_memory[channel_id] = []
-
-    addressed = await is_addressed(message)
+    with stage("is_addressed"):
+        addressed = await is_addressed(message)
+    if trace is not None:
+        trace.outcome(message.id, "addressed" if addressed else "ignored")
 
     if addressed:
-        channel_memory[channel_id].append(f"{message.author.display_name}: {clean}")
+        channel_memory.append(channel_id, message.author.id, message.author.display_name, "user", clean)
     else:
         return
 
-    mode = server_modes.get(message.guild.id, current_mode_global)
-
-    if not can_send_in_guild(message.guild.id, mode, channel_id):
-        return
-
-    reply = await fetch_ai_response(clean, message.guild, message.channel, message.author)
-
-    channel_memory[channel_id].append(f"BOT: {reply}")
-
-    await message.channel.send(reply)
+    coalescer.submit(channel_id, message)
 
 # ---------------- RUN -----------------------------
 
 if TOKEN:
     bot.run(TOKEN)
-else:
+    state_store.flush_sync()
+    if trace is not None:
+        trace.close()
+elif __name__ == "__main__":
     print("Error: DISCORD_TOKEN not set.")
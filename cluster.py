@@ -0,0 +1,349 @@
+# Cluster mode: AutoShardedBot shards spread over worker processes.
+#
+#     python cluster.py [--bot bot.py|p.py] [--workers N] [--shards M]
+#
+# The coordinator (this process) owns what has to be global: the provider
+# concurrency limit, rate-limit buckets and the response cache. Workers are
+# ordinary bot.py/p.py processes started with SHARD_COUNT/SHARD_IDS and
+# CLUSTER_SOCKET set; they reach the coordinator over a Unix socket speaking
+# newline-delimited JSON. Discord routes every guild's events to the shard
+# (guild_id >> 22) % shard_count, so per-guild state (modes, memory, member
+# index) stays in the one worker that owns that guild. Each worker also
+# writes its own state DB (shard_state_path): one SQLite writer per file,
+# no rows clobbered by another worker. Changing --workers regroups the
+# shards, so guilds start over with fresh state files.
+
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+from contextlib import asynccontextmanager
+
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET", "/tmp/ardunot-cluster.sock")
+# provider calls in flight across every worker
+CLUSTER_LLM_CONCURRENCY = int(os.getenv("CLUSTER_LLM_CONCURRENCY", 8))
+# a worker waits this long for the coordinator before falling back to local state
+CLUSTER_CALL_TIMEOUT = float(os.getenv("CLUSTER_CALL_TIMEOUT", 2.0))
+
+API = "https://discord.com/api/v10"
+
+
+def shard_for_guild(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+
+def shard_state_path(path: str, shard_ids: list[int]) -> str:
+    # ardunot_state.db + shards [4, 5, 6, 7] -> ardunot_state.shards-4-7.db
+    root, ext = os.path.splitext(path)
+    return f"{root}.shards-{shard_ids[0]}-{shard_ids[-1]}{ext}"
+
+
+def shard_groups(shard_count: int, workers: int) -> list[list[int]]:
+    # contiguous ranges, so each worker identifies its shards back to back
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    groups, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+# ---------------- COORDINATOR ----------------------
+
+class Coordinator:
+    # One task per request, so a blocked "acquire" never holds up the rest
+    # of a worker's calls. A slot is a lease named by the acquire's id;
+    # releasing a lease that's still waiting cancels the wait, and leases
+    # still held when a worker's connection drops are given back.
+
+    def __init__(self, llm_concurrency: int, cache: ResponseCache):
+        self.slots = asyncio.Semaphore(llm_concurrency)
+        self.llm_concurrency = llm_concurrency
+        self.rate_limiter = RateLimiter()
+        self.cache = cache
+        self.workers = 0
+        self.in_flight = 0
+        self.requests = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.workers += 1
+        leases = set()
+        acquiring: dict[int, asyncio.Task] = {}
+        tasks = set()
+
+        def release(lease):
+            if lease in leases:
+                leases.discard(lease)
+                self.in_flight -= 1
+                self.slots.release()
+            elif lease in acquiring:
+                acquiring[lease].cancel()
+
+        async def answer(req: dict):
+            op = req.get("op")
+            rid = req.get("id")
+            reply = {"id": rid}
+            try:
+                if op == "acquire":
+                    acquiring[rid] = asyncio.current_task()
+                    try:
+                        await self.slots.acquire()
+                    finally:
+                        acquiring.pop(rid, None)
+                    leases.add(rid)
+                    self.in_flight += 1
+                elif op == "release":
+                    release(req.get("lease"))
+                elif op == "rate":
+                    reply["result"] = self.rate_limiter.acquire([tuple(rule) for rule in req["rules"]])
+                elif op == "cache_get":
+                    reply["result"] = self.cache.get(req["key"])
+                elif op == "cache_put":
+                    self.cache.put(req["key"], req["value"])
+                elif op == "stats":
+                    reply["result"] = self.stats()
+                else:
+                    reply["error"] = f"unknown op {op!r}"
+            except Exception as e:
+                reply["error"] = str(e)
+            self.requests += 1
+            if rid is not None:
+                writer.write(json.dumps(reply).encode() + b"\n")
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line)
+                except ValueError:
+                    continue
+                task = asyncio.create_task(answer(req))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for lease in list(leases):
+                release(lease)
+            self.workers -= 1
+            writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "llm_in_flight": self.in_flight,
+            "llm_concurrency": self.llm_concurrency,
+            "rate_buckets": len(self.rate_limiter.tat),
+            "requests": self.requests,
+            "cache": self.cache.stats(),
+        }
+
+
+# ---------------- WORKER CLIENT --------------------
+
+class ClusterClient:
+    # Worker side of the socket. Calls are multiplexed over one connection
+    # by id; a lost connection fails the pending calls and is reopened on
+    # the next one. Callers fall back to local state when a call fails.
+
+    def __init__(self, path: str, timeout: float = CLUSTER_CALL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.writer: asyncio.StreamWriter | None = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        self.connecting: asyncio.Lock | None = None
+
+    async def connect(self):
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.writer is not None:
+                return
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            self.writer = writer
+            asyncio.create_task(self._read(reader, writer))
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                future = self.pending.pop(reply.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(RuntimeError(reply["error"]))
+                else:
+                    future.set_result(reply.get("result"))
+        except Exception as e:
+            print("Cluster connection error:", e)
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("coordinator connection lost"))
+                self.pending.clear()
+
+    async def _send(self, op: str, **fields) -> tuple[int, asyncio.Future]:
+        await self.connect()
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.writer.write(json.dumps({"id": self.next_id, "op": op, **fields}).encode() + b"\n")
+        return self.next_id, future
+
+    def _notify(self, op: str, **fields):
+        # fire-and-forget; nothing to do if the connection is already gone
+        if self.writer is not None:
+            self.writer.write(json.dumps({"op": op, **fields}).encode() + b"\n")
+
+    async def call(self, op: str, **fields):
+        call_id, future = await self._send(op, **fields)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.pending.pop(call_id, None)
+
+    @asynccontextmanager
+    async def slot(self):
+        # Global provider slot. Waits as long as it takes (the scheduler in
+        # front already bounds what can queue here); if the coordinator is
+        # unreachable the call just runs unthrottled.
+        try:
+            lease, granted = await self._send("acquire")
+        except OSError as e:
+            print("Cluster slot unavailable:", e)
+            yield
+            return
+        try:
+            try:
+                await granted
+            except (OSError, RuntimeError) as e:
+                print("Cluster slot unavailable:", e)
+            yield
+        finally:
+            self.pending.pop(lease, None)
+            self._notify("release", lease=lease)
+
+    async def rate(self, rules) -> float:
+        return await self.call("rate", rules=[list(rule) for rule in rules])
+
+    async def cache_get(self, key: str) -> str | None:
+        return await self.call("cache_get", key=key)
+
+    async def cache_put(self, key: str, value: str):
+        self._notify("cache_put", key=key, value=value)
+
+    async def stats(self) -> dict:
+        return await self.call("stats")
+
+
+# ---------------- SUPERVISOR -----------------------
+
+async def recommended_shards(token: str) -> int:
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{API}/gateway/bot", headers={"Authorization": f"Bot {token}"}) as r:
+            r.raise_for_status()
+            return int((await r.json())["shards"])
+
+
+async def supervise(index: int, script: str, env: dict, stopping: asyncio.Event, procs: dict):
+    # restarts a worker that dies, backing off while it keeps crashing
+    backoff = 1
+    while not stopping.is_set():
+        proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+        procs[index] = proc
+        print(f"Worker {index} started (pid {proc.pid}, shards {env['SHARD_IDS']})")
+        code = await proc.wait()
+        if stopping.is_set():
+            break
+        print(f"Worker {index} exited with {code}, restarting in {backoff}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+
+
+async def run_cluster(args):
+    token = os.getenv("DISCORD_TOKEN")
+    if not token:
+        print("Error: DISCORD_TOKEN not set.")
+        return
+
+    shard_count = args.shards or await recommended_shards(token)
+    groups = shard_groups(shard_count, args.workers or os.cpu_count() or 1)
+
+    cache = ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 512)),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", 600)),
+        path=os.getenv("RESPONSE_CACHE_PATH") or None
+    )
+    coordinator = Coordinator(args.llm_concurrency, cache)
+    coordinator.rate_limiter.start()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = await asyncio.start_unix_server(coordinator.handle, args.socket)
+    print(f"Coordinator on {args.socket}: {shard_count} shards over {len(groups)} workers")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    procs: dict[int, asyncio.subprocess.Process] = {}
+    metrics_port = int(os.getenv("METRICS_PORT", 0))
+    supervisors = []
+    for i, shard_ids in enumerate(groups):
+        env = {
+            **os.environ,
+            "SHARD_COUNT": str(shard_count),
+            "SHARD_IDS": ",".join(map(str, shard_ids)),
+            "CLUSTER_SOCKET": args.socket,
+        }
+        if metrics_port:
+            env["METRICS_PORT"] = str(metrics_port + i)
+        supervisors.append(asyncio.create_task(supervise(i, args.bot, env, stopping, procs)))
+
+    await stopping.wait()
+    print("Stopping workers...")
+    for proc in procs.values():
+        if proc.returncode is None:
+            proc.terminate()
+    await asyncio.gather(*supervisors, return_exceptions=True)
+    server.close()
+    await server.wait_closed()
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the bot as sharded worker processes.")
+    parser.add_argument("--bot", default="bot.py", help="worker script (bot.py or p.py)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CLUSTER_WORKERS", 0)),
+                        help="worker processes (default: CPU count, at most one per shard)")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("CLUSTER_SHARDS", 0)),
+                        help="total shards (default: Discord's recommendation)")
+    parser.add_argument("--socket", default=CLUSTER_SOCKET)
+    parser.add_argument("--llm-concurrency", type=int, default=CLUSTER_LLM_CONCURRENCY)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run_cluster(parse_args()))
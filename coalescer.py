@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from metrics import METRICS
+
+
+class ChannelCoalescer:
+    # Collects items per channel until the channel has been quiet for `window`
+    # seconds (or `max_wait` has passed since the first one), then hands the
+    # whole batch to `handler(channel_id, batch)`. A batch that reaches
+    # `max_batch` goes straight away and later items start the next one, so
+    # nothing is dropped. At most one handler runs per channel; anything
+    # arriving meanwhile becomes the next batch.
+
+    def __init__(self, handler, window: float = 0.8, max_wait: float = 3.0, max_batch: int = 8):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.pending: dict[int, list] = {}
+        self.last_seen: dict[int, float] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, channel_id: int, item):
+        self.pending.setdefault(channel_id, []).append(item)
+        self.last_seen[channel_id] = time.monotonic()
+        self.items += 1
+        if channel_id not in self.tasks:
+            self.tasks[channel_id] = asyncio.create_task(self._drain(channel_id))
+
+    def busy(self, channel_id: int) -> bool:
+        return channel_id in self.tasks
+
+    async def _drain(self, channel_id: int):
+        try:
+            while self.pending.get(channel_id):
+                await self._settle(channel_id)
+                batch = self.pending.pop(channel_id, [])
+                if len(batch) >= self.max_batch:
+                    METRICS.inc("coalesce_full_batches_total")
+                if len(batch) > self.max_batch:
+                    # oldest first; the rest is the next batch
+                    self.pending[channel_id] = batch[self.max_batch:]
+                    batch = batch[:self.max_batch]
+                self.batches += 1
+                try:
+                    await self.handler(channel_id, batch)
+                except Exception as e:
+                    print("Coalesced reply error:", e)
+        finally:
+            self.tasks.pop(channel_id, None)
+            self.last_seen.pop(channel_id, None)
+
+    async def _settle(self, channel_id: int):
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            quiet_for = now - self.last_seen.get(channel_id, started)
+            if quiet_for >= self.window or now - started >= self.max_wait:
+                return
+            if len(self.pending.get(channel_id, ())) >= self.max_batch:
+                return
+            await asyncio.sleep(min(self.window - quiet_for, self.max_wait - (now - started)))
@@ -1,60 +1,390 @@
-import requests
-import time
+import aiohttp
+import argparse
+import asyncio
+import json
 import os
+import time
+from datetime import datetime, timezone
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 TARGET_USER = os.getenv("TARGET_USER")
 TARGET_GUILD = os.getenv("TARGET_GUILD")
 
+API = "https://discord.com/api/v10"
+
 headers = {
     "Authorization": f"Bot {TOKEN}"
 }
 
-def get_channels(guild_id):
-    r = requests.get(f"https://discord.com/api/v10/guilds/{guild_id}/channels", headers=headers)
-    try:
-        return r.json()
-    except:
-        return []
+# channels scanned at once; Discord's global cap is 50 requests/s per bot
+CHANNEL_CONCURRENCY = int(os.getenv("PURGE_CONCURRENCY", 8))
+GLOBAL_PER_SECOND = float(os.getenv("PURGE_GLOBAL_PER_SECOND", 45))
+PROGRESS_SECONDS = 10
 
-def delete_message(channel_id, message_id):
-    url = f"https://discord.com/api/v10/channels/{channel_id}/messages/{message_id}"
-    requests.delete(url, headers=headers)
+DISCORD_EPOCH_MS = 1420070400000
+# bulk-delete refuses anything older than 14 days; keep a margin for clock skew
+BULK_MAX_AGE_MS = (14 * 86400 - 300) * 1000
 
-def scan_channel(channel_id):
-    last_id = None
-    while True:
-        url = f"https://discord.com/api/v10/channels/{channel_id}/messages?limit=100"
-        if last_id:
-            url += f"&before={last_id}"
+CHECKPOINT_PATH = os.getenv("PURGE_CHECKPOINT", "purge_checkpoint.json")
+
+# channel types that hold messages directly, and those that can own threads
+MESSAGE_CHANNEL_TYPES = {0, 5}
+THREAD_PARENT_TYPES = {0, 5, 15, 16}
+
+
+def snowflake_ms(snowflake) -> int:
+    return (int(snowflake) >> 22) + DISCORD_EPOCH_MS
+
+
+def snowflake_at(dt: datetime) -> int:
+    return max(0, int(dt.timestamp() * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+def parse_time(text: str) -> datetime:
+    dt = datetime.fromisoformat(text)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+# ---------------- RATE LIMITS ---------------------
+
+class Bucket:
+    def __init__(self):
+        self.remaining = 1
+        self.reset_at = 0.0
+        self.lock = asyncio.Lock()
+
+
+class RateLimiter:
+    # Per-route buckets driven by X-RateLimit-* headers, plus a global pacer
+    # and a global pause when Discord says the 429 was global.
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second
+        self.next_slot = 0.0
+        self.global_until = 0.0
+        self.buckets: dict[str, Bucket] = {}
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def _global_slot(self):
+        now = time.monotonic()
+        wait = max(self.global_until, self.next_slot) - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _update(self, bucket: Bucket, r: aiohttp.ClientResponse):
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        reset_after = r.headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            bucket.remaining = int(remaining)
+        if reset_after is not None:
+            bucket.reset_at = time.monotonic() + float(reset_after)
+
+    async def request(self, session: aiohttp.ClientSession, method: str, route: str, url: str, **kwargs):
+        bucket = self.buckets.setdefault(route, Bucket())
+        async with bucket.lock:
+            while True:
+                if bucket.remaining <= 0:
+                    wait = bucket.reset_at - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    bucket.remaining = 1
+
+                await self._global_slot()
+                self.requests += 1
+                async with session.request(method, url, headers=headers, **kwargs) as r:
+                    self._update(bucket, r)
+
+                    if r.status == 429:
+                        self.rate_limited += 1
+                        try:
+                            body = await r.json()
+                        except Exception:
+                            body = {}
+                        retry_after = float(body.get("retry_after") or r.headers.get("Retry-After") or 1)
+                        if body.get("global") or r.headers.get("X-RateLimit-Global"):
+                            self.global_until = time.monotonic() + retry_after
+                        else:
+                            bucket.remaining = 0
+                            bucket.reset_at = time.monotonic() + retry_after
+                        continue
+
+                    if r.status == 204:
+                        return r.status, None
+                    try:
+                        return r.status, await r.json()
+                    except Exception:
+                        return r.status, None
+
+
+# ---------------- CHECKPOINT --------------------
+
+class Checkpoint:
+    # Per-channel cursors, saved atomically to a JSON file. "high" is the
+    # newest message already handled, "low" the oldest reached so far, and
+    # "done" means the backward scan reached the start of the window. A
+    # different --after/--before window starts a fresh set of cursors.
+
+    def __init__(self, path: str, window: list, reset: bool = False):
+        self.path = path
+        self.window = window
+        self.channels = {}
+        self.dirty = False
+        self.saved_at = 0.0
+        if not reset and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get("window") == window:
+                    self.channels = data.get("channels", {})
+            except (OSError, ValueError):
+                pass
+
+    def get(self, channel_id) -> dict:
+        return self.channels.setdefault(str(channel_id), {"high": None, "low": None, "done": False})
+
+    def update(self, channel_id, **fields):
+        self.get(channel_id).update(fields)
+        self.dirty = True
+        if time.monotonic() - self.saved_at >= 1.0:
+            self.save()
 
-        r = requests.get(url, headers=headers)
-        if r.status_code != 200:
-            print(f"Cannot read channel {channel_id}, skipping.")
-            break
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"window": self.window, "channels": self.channels}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
 
-        messages = r.json()
-        if not messages:
-            break
 
+# ---------------- PURGE -------------------------
+
+class Progress:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.channels_total = 0
+        self.channels_done = 0
+        self.channels_skipped = 0
+        self.scanned = 0
+        self.deleted = 0
+        self.bulk_calls = 0
+        self.failed = 0
+
+    def report(self, limiter: RateLimiter):
+        elapsed = time.monotonic() - self.started
+        rate = self.deleted / elapsed if elapsed else 0.0
+        print(
+            f"[{elapsed:6.0f}s] channels {self.channels_done}/{self.channels_total} "
+            f"({self.channels_skipped} out of range) | "
+            f"scanned {self.scanned} | deleted {self.deleted} ({rate:.1f}/s, {self.bulk_calls} bulk) | "
+            f"failed {self.failed} | requests {limiter.requests} | 429s {limiter.rate_limited}"
+        )
+
+
+class Purger:
+    def __init__(self, session: aiohttp.ClientSession, limiter: RateLimiter, progress: Progress,
+                 checkpoint: Checkpoint, after: int | None = None, before: int | None = None):
+        self.session = session
+        self.limiter = limiter
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.after = after
+        self.before = before
+
+    async def get(self, route: str, url: str):
+        status, data = await self.limiter.request(self.session, "GET", route, url)
+        return data if status == 200 else None
+
+    async def get_channels(self, guild_id):
+        data = await self.get(f"guild:{guild_id}:channels", f"{API}/guilds/{guild_id}/channels")
+        return data if isinstance(data, list) else []
+
+    async def get_threads(self, guild_id, parents):
+        threads = {}
+        data = await self.get(f"guild:{guild_id}:threads", f"{API}/guilds/{guild_id}/threads/active")
+        for t in (data or {}).get("threads", []):
+            threads[t["id"]] = t
+
+        for parent in parents:
+            for kind in ("public", "private"):
+                cursor = None
+                while True:
+                    url = f"{API}/channels/{parent['id']}/threads/archived/{kind}?limit=100"
+                    if cursor:
+                        url += f"&before={cursor}"
+                    data = await self.get(f"channel:{parent['id']}:archived", url)
+                    if not data:
+                        break  # missing permission (private) or nothing archived
+                    for t in data.get("threads", []):
+                        threads[t["id"]] = t
+                    batch = data.get("threads", [])
+                    if not data.get("has_more") or not batch:
+                        break
+                    oldest = batch[-1]["thread_metadata"]["archive_timestamp"]
+                    # archived threads come newest-archived first; stop once
+                    # they were archived before the window even opened
+                    if self.after and snowflake_at(parse_time(oldest)) < self.after:
+                        break
+                    cursor = oldest
+        return list(threads.values())
+
+    def in_window(self, channel) -> bool:
+        # skip channels whose whole history lies outside the window
+        last = channel.get("last_message_id")
+        if self.after and (last is None or int(last) <= self.after):
+            return False
+        if self.before and int(channel["id"]) >= self.before:
+            return False
+        return True
+
+    async def delete_one(self, channel_id, message_id):
+        status, _ = await self.limiter.request(
+            self.session, "DELETE", f"channel:{channel_id}:delete",
+            f"{API}/channels/{channel_id}/messages/{message_id}"
+        )
+        if status in (200, 204, 404):
+            self.progress.deleted += 1
+        else:
+            self.progress.failed += 1
+
+    async def delete_bulk(self, channel_id, message_ids):
+        if len(message_ids) == 1:
+            return await self.delete_one(channel_id, message_ids[0])
+        status, _ = await self.limiter.request(
+            self.session, "POST", f"channel:{channel_id}:bulk-delete",
+            f"{API}/channels/{channel_id}/messages/bulk-delete", json={"messages": message_ids}
+        )
+        self.progress.bulk_calls += 1
+        if status in (200, 204):
+            self.progress.deleted += len(message_ids)
+        else:
+            # fall back to single deletes for this chunk
+            for mid in message_ids:
+                await self.delete_one(channel_id, mid)
+
+    async def purge_page(self, channel_id, messages):
+        bulk_cutoff = time.time() * 1000 - BULK_MAX_AGE_MS
+        young = []
         for msg in messages:
-            last_id = msg["id"]
-            if msg.get("author", {}).get("id") == TARGET_USER:
-                print(f"Deleting {msg['id']} in channel {channel_id}")
-                delete_message(channel_id, msg["id"])
-                time.sleep(0.5)
+            self.progress.scanned += 1
+            mid = int(msg["id"])
+            if (self.after and mid <= self.after) or (self.before and mid >= self.before):
+                continue
+            if msg.get("author", {}).get("id") != TARGET_USER:
+                continue
+            if snowflake_ms(mid) > bulk_cutoff:
+                young.append(msg["id"])
+            else:
+                await self.delete_one(channel_id, msg["id"])
+        if young:
+            await self.delete_bulk(channel_id, young)
+
+    async def scan_channel(self, channel_id):
+        state = self.checkpoint.get(channel_id)
+        route = f"channel:{channel_id}:messages"
+
+        # 1. catch up on anything newer than the last run
+        if state["high"]:
+            high = int(state["high"])
+            while not (self.before and high >= self.before):
+                messages = await self.get(route, f"{API}/channels/{channel_id}/messages?limit=100&after={high}")
+                if not messages:
+                    break
+                await self.purge_page(channel_id, messages)
+                high = max(int(m["id"]) for m in messages)
+                self.checkpoint.update(channel_id, high=str(high))
+                if len(messages) < 100:
+                    break
+
+        # 2. walk backwards from where the last run stopped (or the window top)
+        if state["done"]:
+            return
+        cursor = state["low"] or (str(self.before) if self.before else None)
+        while True:
+            url = f"{API}/channels/{channel_id}/messages?limit=100"
+            if cursor:
+                url += f"&before={cursor}"
 
-        time.sleep(0.3)
+            messages = await self.get(route, url)
+            if messages is None:
+                print(f"Cannot read channel {channel_id}, skipping.")
+                return
+            if not messages:
+                break
+
+            await self.purge_page(channel_id, messages)
+            ids = [int(m["id"]) for m in messages]
+            cursor = str(min(ids))
+            fields = {"low": cursor}
+            if not state["high"] or max(ids) > int(state["high"]):
+                fields["high"] = str(max(ids))
+            self.checkpoint.update(channel_id, **fields)
+            if (self.after and min(ids) <= self.after) or len(messages) < 100:
+                break
+
+        self.checkpoint.update(channel_id, done=True)
+
+    async def purge_guild(self, guild_id):
+        channels = await self.get_channels(guild_id)
+        parents = [ch for ch in channels if ch["type"] in THREAD_PARENT_TYPES]
+        targets = [ch for ch in channels if ch["type"] in MESSAGE_CHANNEL_TYPES]
+        targets += await self.get_threads(guild_id, parents)
+
+        in_range = [ch for ch in targets if self.in_window(ch)]
+        self.progress.channels_total = len(in_range)
+        self.progress.channels_skipped = len(targets) - len(in_range)
+        gate = asyncio.Semaphore(CHANNEL_CONCURRENCY)
+
+        async def run(cid):
+            async with gate:
+                print(f"Scanning channel: {cid}")
+                try:
+                    await self.scan_channel(cid)
+                except Exception as e:
+                    print(f"Channel {cid} failed: {e}")
+                self.progress.channels_done += 1
+
+        try:
+            await asyncio.gather(*(run(ch["id"]) for ch in in_range))
+        finally:
+            self.checkpoint.save()
+
+
+async def report_progress(progress: Progress, limiter: RateLimiter):
+    while True:
+        await asyncio.sleep(PROGRESS_SECONDS)
+        progress.report(limiter)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Delete a user's messages across a guild.")
+    parser.add_argument("--after", type=parse_time, help="only messages after this ISO time (UTC if no offset)")
+    parser.add_argument("--before", type=parse_time, help="only messages before this ISO time")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="cursor file for incremental reruns")
+    parser.add_argument("--reset", action="store_true", help="ignore the saved cursors and rescan")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    after = snowflake_at(args.after) if args.after else None
+    before = snowflake_at(args.before) if args.before else None
 
-def main():
     print(f"Scanning guild: {TARGET_GUILD}")
-    channels = get_channels(TARGET_GUILD)
-    for ch in channels:
-        if ch["type"] == 0:  # text channels
-            cid = ch["id"]
-            print(f"Scanning channel: {cid}")
-            scan_channel(cid)
-            time.sleep(0.5)
+    limiter = RateLimiter(GLOBAL_PER_SECOND)
+    progress = Progress()
+    checkpoint = Checkpoint(args.checkpoint, [after, before], args.reset)
+    reporter = asyncio.create_task(report_progress(progress, limiter))
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+            await Purger(session, limiter, progress, checkpoint, after, before).purge_guild(TARGET_GUILD)
+    finally:
+        reporter.cancel()
+        progress.report(limiter)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
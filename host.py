@@ -0,0 +1,170 @@
+# Multi-persona host: several bot identities on one event loop.
+#
+#     python host.py [--config personas.json]
+#
+# Each persona is bot.py or p.py loaded as its own module, so it keeps its
+# own Discord client, modes, memory and state DB. Anything that doesn't
+# depend on the identity lives in modules imported once and is shared:
+# provider sessions and model stats (llm_client), the response cache, the
+# token counter and METRICS, whose series get a persona label. The host
+# also owns one RateLimiter (each persona gets a scoped view, so its
+# buckets stay its own) and the lean-mode member cache: the member indexes
+# are shared, so their TTL eviction has to be too.
+#
+# The config is a JSON list of personas:
+#
+#     [{"name": "ardunot", "script": "bot.py", "token_env": "DISCORD_TOKEN",
+#       "key_envs": {"OPENROUTER_API_KEY": "OPENROUTER_API_KEY"},
+#       "env": {"MODEL": "openai/gpt-4o-mini"},
+#       "attrs": {"TEMPERATURE": 0.7, "SERIOUS_INSTRUCTIONS": "..."}}]
+#
+# "key_envs" maps the API-key variables the script reads to the host
+# variables holding this persona's keys; a persona whose keys aren't all set
+# is not started rather than run on another persona's key. "env" is applied
+# while the script is imported (anything it reads with os.getenv: models,
+# budgets, STATE_DB, LEAN_INTENTS...); "attrs" replaces module globals
+# afterwards (prompts, temperature). Not for cluster mode.
+
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import signal
+import sys
+
+from llm_client import close_providers
+from member_index import MemberTTLCache
+from metrics import METRICS, labelled
+from rate_limiter import RateLimiter, ScopedRateLimiter
+
+PERSONAS_FILE = os.getenv("PERSONAS_FILE", "personas.json")
+MEMBER_TTL_SECONDS = float(os.getenv("MEMBER_TTL_SECONDS", 1800))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 20000))
+
+rate_limiter = RateLimiter()
+member_cache = MemberTTLCache(MEMBER_TTL_SECONDS, MEMBER_CACHE_SIZE)
+
+# the two-bot deployment, used when there's no config file; p.py reads its
+# (HF router) key from OPENROUTER_API_KEY too, so it needs its own variable
+DEFAULT_PERSONAS = [
+    {"name": "ardunot", "script": "bot.py", "token_env": "DISCORD_TOKEN",
+     "key_envs": {"OPENROUTER_API_KEY": "OPENROUTER_API_KEY"}},
+    {"name": "p", "script": "p.py", "token_env": "DISCORD_TOKEN_P",
+     "key_envs": {"OPENROUTER_API_KEY": "OPENROUTER_API_KEY_P"}},
+]
+
+
+def load_config(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return DEFAULT_PERSONAS
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_persona(persona: dict, scripts_seen: set):
+    name = persona["name"]
+    script = persona.get("script", "bot.py")
+    # the host serves /metrics and starts the bots itself
+    keys = {var: os.environ[source] for var, source in persona.get("key_envs", {}).items()}
+    env = {"DISCORD_TOKEN": "", "METRICS_PORT": "0", **persona.get("env", {}), **keys}
+    if script in scripts_seen and "STATE_DB" not in env:
+        env["STATE_DB"] = f"{name}_state.db"
+    scripts_seen.add(script)
+
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update({key: str(value) for key, value in env.items()})
+    try:
+        spec = importlib.util.spec_from_file_location(f"persona_{name}", script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        # gauges registered at import time are labelled with the persona
+        with labelled(persona=name):
+            spec.loader.exec_module(module)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    for attr, value in persona.get("attrs", {}).items():
+        setattr(module, attr, value)
+
+    # swap in the host's shared pieces before anything has used the module's own
+    limiter = ScopedRateLimiter(rate_limiter, name)
+    module.rate_limiter = limiter
+    module.outbound.limiter = limiter
+    module.member_cache = member_cache
+    return module
+
+
+async def run_persona(name: str, module, token: str):
+    # Every task discord.py spawns for this bot inherits the persona label
+    with labelled(persona=name):
+        try:
+            await module.bot.start(token)
+        except Exception as e:
+            print(f"Persona {name} stopped:", e)
+        finally:
+            if not module.bot.is_closed():
+                await module.bot.close()
+            module.state_store.flush_sync()
+            if module.trace is not None:
+                module.trace.close()
+
+
+async def run_host(args):
+    metrics_port = int(os.getenv("METRICS_PORT", 0))
+
+    personas = []
+    scripts_seen = set()
+    for persona in load_config(args.config):
+        token = os.getenv(persona.get("token_env", "DISCORD_TOKEN"))
+        if not token:
+            print(f"Skipping persona {persona['name']}: {persona.get('token_env', 'DISCORD_TOKEN')} not set.")
+            continue
+        missing = [source for source in persona.get("key_envs", {}).values() if not os.getenv(source)]
+        if missing:
+            print(f"Skipping persona {persona['name']}: {', '.join(missing)} not set.")
+            continue
+        personas.append((persona["name"], load_persona(persona, scripts_seen), token))
+        print(f"Loaded persona {persona['name']} ({persona.get('script', 'bot.py')})")
+
+    if not personas:
+        print("Error: no persona has a token set.")
+        return
+
+    if metrics_port:
+        await METRICS.serve(metrics_port, os.getenv("METRICS_HOST", "127.0.0.1"))
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    tasks = [asyncio.create_task(run_persona(name, module, token)) for name, module, token in personas]
+    everyone_stopped = asyncio.create_task(asyncio.wait(tasks))
+    await asyncio.wait([everyone_stopped, asyncio.create_task(stopping.wait())], return_when=asyncio.FIRST_COMPLETED)
+
+    print("Stopping personas...")
+    for _, module, _ in personas:
+        if not module.bot.is_closed():
+            await module.bot.close()
+    _, stuck = await asyncio.wait(tasks, timeout=10)
+    for task in stuck:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_providers()
+    await METRICS.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run several bot personas in one process.")
+    parser.add_argument("--config", default=PERSONAS_FILE, help="persona list (JSON)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run_host(parse_args()))
@@ -0,0 +1,585 @@
+import aiohttp
+import os
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from response_cache import ResponseCache, make_key
+from metrics import METRICS
+from prompt_budget import TOKENS
+
+# Connection pool tuning, shared by every provider
+POOL_LIMIT = int(os.getenv("LLM_POOL_LIMIT", 32))
+KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", 60))
+DNS_CACHE_SECONDS = int(os.getenv("LLM_DNS_CACHE_SECONDS", 300))
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 25))
+
+# Retries: everything for one request, backoff included, fits in LLM_DEADLINE
+DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE", 45))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", 10))
+RETRY_AFTER_CAP = float(os.getenv("LLM_RETRY_AFTER_CAP", 30))
+
+# Circuit breaker: consecutive failures that open it, and how long it stays open
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", 30))
+
+# RESPONSE_CACHE_SIZE=0 disables caching; RESPONSE_CACHE_PATH adds a SQLite tier
+CACHE = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 512)),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 600)),
+    path=os.getenv("RESPONSE_CACHE_PATH") or None
+)
+
+
+# second tier shared by cluster workers (a cluster.ClusterClient), see use_shared_cache()
+SHARED_CACHE = None
+
+
+def use_shared_cache(client):
+    global SHARED_CACHE
+    SHARED_CACHE = client
+
+
+async def cache_lookup(key: str) -> str | None:
+    cached = CACHE.get(key)
+    if cached is None and SHARED_CACHE is not None:
+        try:
+            cached = await SHARED_CACHE.cache_get(key)
+        except Exception:
+            cached = None
+        if cached is not None:
+            CACHE.put(key, cached)
+    return cached
+
+
+async def cache_store(key: str, value: str):
+    CACHE.put(key, value)
+    if SHARED_CACHE is not None:
+        try:
+            await SHARED_CACHE.cache_put(key, value)
+        except Exception:
+            pass
+
+
+class StreamUnavailable(Exception):
+    pass
+
+
+class LLMFailure(Exception):
+    # Raised once a request has no retries or time left. category is one of
+    # rate_limited, timeout, server_error, network, bad_response, auth,
+    # client_error, circuit_open, deadline, no_provider; retry_after is the
+    # provider's hint in seconds when it sent one.
+
+    def __init__(self, category: str, detail: str = "", retry_after: float | None = None):
+        super().__init__(f"{category}: {detail}" if detail else category)
+        self.category = category
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+# what a bot tells the channel for each category; anything else gets its own default
+FAILURE_MESSAGES = {
+    "rate_limited": "⚠️ I'm being rate limited, try again in a bit.",
+    "circuit_open": "⚠️ The AI provider is down right now, try again shortly.",
+    "timeout": "⚠️ The AI took too long to answer.",
+    "deadline": "⚠️ The AI took too long to answer.",
+    "auth": "⚠️ The AI provider rejected the API key.",
+    "no_provider": "⚠️ No AI provider is configured.",
+}
+
+
+def failure_message(error: LLMFailure, default: str) -> str:
+    return FAILURE_MESSAGES.get(error.category, default)
+
+
+def retry_after_seconds(value: str | None) -> float | None:
+    # Retry-After is either delta-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    # full jitter, so callers that failed together don't retry together;
+    # never earlier than the provider asked
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_AFTER_CAP))
+    return delay
+
+
+class CircuitBreaker:
+    # closed: calls go through, consecutive failures are counted. open: calls
+    # fail fast until cooldown has passed. half_open: one probe goes through;
+    # success closes the breaker, failure opens it again.
+
+    def __init__(self, name: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _move(self, state: str):
+        if state != self.state:
+            self.state = state
+            METRICS.inc("llm_breaker_transitions_total", provider=self.name, state=state)
+            print(f"Circuit {self.name}: {state}")
+
+    def allow(self) -> bool:
+        if self.state == "closed" or self.threshold <= 0:
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._move("half_open")
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def retry_in(self) -> float:
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self._move("closed")
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or (self.threshold > 0 and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self._move("open")
+
+    def release(self):
+        # the probe ended without saying anything about the provider (cancelled,
+        # rate limited, a bad request)
+        self.probing = False
+
+
+class ProviderStats:
+    # Rolling latency window plus a decaying error rate, used to order and
+    # hedge providers.
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.latencies: deque = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.error_rate = 0.0
+        self.successes = 0
+        self.errors = 0
+
+    def record(self, ok: bool, latency: float | None = None):
+        self.error_rate = self.error_rate * 0.9 + (0.0 if ok else 0.1)
+        if ok:
+            self.successes += 1
+            if latency is not None:
+                self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    def percentile(self, p: float) -> float | None:
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+# the same stats per model, across providers; the model router reads these
+MODEL_STATS: dict[str, ProviderStats] = {}
+
+
+def model_stats(model: str) -> ProviderStats:
+    stats = MODEL_STATS.get(model)
+    if stats is None:
+        stats = MODEL_STATS[model] = ProviderStats()
+    return stats
+
+
+# one long-lived session per origin, shared by every provider (and every
+# persona in host.py) that talks to it; keys travel in per-request headers
+SESSIONS: dict[str, aiohttp.ClientSession] = {}
+
+
+def shared_session(url: str) -> aiohttp.ClientSession:
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    session = SESSIONS.get(origin)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT,
+            ttl_dns_cache=DNS_CACHE_SECONDS,
+            keepalive_timeout=KEEPALIVE_SECONDS,
+            enable_cleanup_closed=True
+        )
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        session = SESSIONS[origin] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return session
+
+
+class Provider:
+    # One OpenAI-compatible chat endpoint. Its connections come from the
+    # shared per-origin session, so every call after the first reuses a warm
+    # TCP+TLS connection.
+
+    def __init__(self, name: str, url: str, api_key: str | None, extra_headers: dict | None = None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.extra_headers = extra_headers or {}
+        self.stats = ProviderStats()
+        self.breaker = CircuitBreaker(name)
+
+    async def session(self) -> aiohttp.ClientSession:
+        return shared_session(self.url)
+
+    def headers(self, stream: bool = False) -> dict:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            **self.extra_headers
+        }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
+
+    def payload(self, messages: list[dict], model: str, temperature: float | None, max_tokens: int | None, stream: bool = False) -> dict:
+        payload = {"model": model, "messages": messages}
+        if temperature is not None:
+            payload["temperature"] = temperature
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if stream:
+            payload["stream"] = True
+        return payload
+
+
+# keyed by (name, url, key): the same endpoint under two API keys (two
+# personas, say) is two providers, but they still share one session
+PROVIDERS: dict[tuple[str, str, str | None], Provider] = {}
+
+
+def register_provider(name: str, url: str, api_key: str | None, extra_headers: dict | None = None) -> Provider:
+    key = (name, url, api_key)
+    provider = PROVIDERS.get(key)
+    if provider is None:
+        provider = PROVIDERS[key] = Provider(name, url, api_key, extra_headers)
+    return provider
+
+
+def breaker_states() -> dict:
+    # 0 closed, 1 half-open, 2 open; the worst one per provider name
+    level = {"closed": 0, "half_open": 1, "open": 2}
+    states = {}
+    for provider in PROVIDERS.values():
+        labels = (("provider", provider.name),)
+        states[labels] = max(states.get(labels, 0), level[provider.breaker.state])
+    return states
+
+
+METRICS.gauge("llm_breaker_state", breaker_states, "Circuit breaker per provider: 0 closed, 1 half-open, 2 open")
+
+
+async def close_providers():
+    for session in SESSIONS.values():
+        if not session.closed:
+            await session.close()
+    SESSIONS.clear()
+
+
+def cache_key(messages: list[dict], model: str, temperature: float | None, max_tokens: int | None) -> str:
+    return make_key(messages, f"{model}|{max_tokens}", temperature or 0.0)
+
+
+def status_failure(status: int, retry_after: float | None) -> LLMFailure:
+    if status == 429:
+        return LLMFailure("rate_limited", "HTTP 429", retry_after)
+    if status in (401, 403):
+        return LLMFailure("auth", f"HTTP {status}")
+    if status == 408:
+        return LLMFailure("timeout", "HTTP 408", retry_after)
+    if status >= 500:
+        return LLMFailure("server_error", f"HTTP {status}", retry_after)
+    return LLMFailure("client_error", f"HTTP {status}")
+
+
+# worth another attempt; the rest would fail the same way again
+RETRYABLE = {"rate_limited", "timeout", "server_error", "network", "bad_response"}
+# say something about the provider's health, so they count towards its breaker
+BREAKER_FAILURES = {"timeout", "server_error", "network", "bad_response"}
+
+
+async def complete(
+    provider: Provider,
+    messages: list[dict],
+    model: str,
+    temperature: float | None = None,
+    max_tokens: int | None = None,
+    retries: int = 4,
+    use_cache: bool = True,
+    deadline: float | None = None
+) -> str:
+    # Returns the completion text, or raises LLMFailure once retries or time
+    # run out. deadline is a time.monotonic() value (default DEADLINE_SECONDS
+    # from now); no attempt or backoff sleep runs past it.
+
+    key = cache_key(messages, model, temperature, max_tokens)
+    if use_cache:
+        cached = await cache_lookup(key)
+        if cached is not None:
+            METRICS.inc("llm_cache_hits_total")
+            return cached
+
+    if deadline is None:
+        deadline = time.monotonic() + DEADLINE_SECONDS
+
+    session = await provider.session()
+    payload = provider.payload(messages, model, temperature, max_tokens)
+    headers = provider.headers()
+
+    per_model = model_stats(model)
+    breaker = provider.breaker
+    failure = None
+
+    # whole call including backoff, so retries show up as latency
+    with METRICS.time("llm_call_seconds", provider=provider.name):
+        for attempt in range(retries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                failure = failure or LLMFailure("deadline", f"{provider.name} out of time")
+                break
+            if not breaker.allow():
+                # opened by this call's own failures: report those
+                failure = failure or LLMFailure("circuit_open", provider.name, breaker.retry_in())
+                break
+            if attempt:
+                METRICS.inc("llm_retries_total", provider=provider.name)
+
+            started = time.monotonic()
+            timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+            try:
+                async with session.post(provider.url, headers=headers, json=payload, timeout=timeout) as r:
+                    METRICS.inc("llm_requests_total", provider=provider.name, status=r.status)
+                    if r.status == 200:
+                        data = await r.json(content_type=None)
+                        content = data["choices"][0]["message"]["content"]
+                        if content is None:
+                            raise ValueError("empty content")
+                        provider.stats.record(True, time.monotonic() - started)
+                        per_model.record(True, time.monotonic() - started)
+                        breaker.success()
+                        usage = data.get("usage") or {}
+                        if usage.get("prompt_tokens"):
+                            TOKENS.calibrate(model, messages, usage["prompt_tokens"])
+                            METRICS.inc("llm_prompt_tokens_total", usage["prompt_tokens"], provider=provider.name)
+                            # served from the provider's prompt cache (OpenAI-style usage details)
+                            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+                            if cached:
+                                METRICS.inc("llm_cached_prompt_tokens_total", cached, provider=provider.name)
+                        await cache_store(key, content)
+                        return content
+                    failure = status_failure(r.status, retry_after_seconds(r.headers.get("Retry-After")))
+            except asyncio.TimeoutError:
+                METRICS.inc("llm_requests_total", provider=provider.name, status="timeout")
+                failure = LLMFailure("timeout", f"no answer after {time.monotonic() - started:.1f}s")
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                failure = LLMFailure("bad_response", repr(e))
+            except Exception as e:
+                METRICS.inc("llm_requests_total", provider=provider.name, status="error")
+                failure = LLMFailure("network", repr(e))
+            finally:
+                # frees the half-open probe slot if this attempt was cancelled
+                breaker.release()
+
+            provider.stats.record(False)
+            per_model.record(False)
+            if failure.category == "rate_limited":
+                METRICS.inc("llm_429_total", provider=provider.name)
+            if failure.category in BREAKER_FAILURES:
+                breaker.failure()
+            if failure.category not in RETRYABLE or attempt == retries - 1:
+                break
+
+            delay = backoff_delay(attempt, failure.retry_after)
+            if time.monotonic() + delay >= deadline:
+                # the provider's own Retry-After can't be met in time either
+                break
+            await asyncio.sleep(delay)
+
+    METRICS.inc("llm_failures_total", provider=provider.name, category=failure.category)
+    raise failure
+
+
+class ProviderChain:
+    # Ordered (provider, model) pairs. The healthiest/fastest entry goes
+    # first; if it hasn't answered within its own recent p95 latency, the
+    # next entry is fired too and whichever answers first wins. A failed
+    # entry hands over to the next one immediately. Losers are cancelled.
+
+    def __init__(self, entries: list[tuple[Provider, str]], hedge: bool = True, default_delay: float = 4.0, min_delay: float = 0.5):
+        self.entries = [(p, m) for p, m in entries if p.api_key]
+        self.hedge = hedge
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def ordered(self) -> list[tuple[Provider, str]]:
+        # Config order breaks ties; a provider whose breaker is open or that is
+        # clearly erroring drops behind the healthy ones, then faster p50 goes first.
+        def score(item):
+            i, (provider, _) = item
+            p50 = provider.stats.percentile(0.5)
+            return (provider.breaker.state == "open", provider.stats.error_rate > 0.5, p50 if p50 is not None else float("inf"), i)
+
+        return [e for _, e in sorted(enumerate(self.entries), key=score)]
+
+    def hedge_delay(self, provider: Provider) -> float:
+        p95 = provider.stats.percentile(0.95)
+        if p95 is None:
+            return self.default_delay
+        return max(self.min_delay, p95)
+
+    async def complete(self, messages: list[dict], temperature: float | None = None, max_tokens: int | None = None,
+                       retries: int = 2, use_cache: bool = True, deadline: float | None = None) -> str:
+        # Raises LLMFailure when every entry failed, with the first entry's
+        # reason unless that was only an open breaker.
+        order = self.ordered()
+        if not order:
+            raise LLMFailure("no_provider")
+        if deadline is None:
+            deadline = time.monotonic() + DEADLINE_SECONDS
+
+        pending: dict[asyncio.Task, int] = {}
+        failures: dict[int, LLMFailure] = {}
+        next_index = 0
+
+        def launch():
+            nonlocal next_index
+            provider, model = order[next_index]
+            task = asyncio.create_task(complete(provider, messages, model, temperature, max_tokens, retries, use_cache, deadline))
+            pending[task] = next_index
+            next_index += 1
+            return provider
+
+        current = launch()
+        try:
+            while pending:
+                timeout = None
+                if self.hedge and next_index < len(order):
+                    timeout = self.hedge_delay(current)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # primary is slower than its own p95: hedge
+                    self.hedged += 1
+                    METRICS.inc("llm_hedged_total")
+                    current = launch()
+                    continue
+
+                for task in done:
+                    index = pending.pop(task)
+                    if task.cancelled():
+                        continue
+                    error = task.exception()
+                    if error is not None:
+                        failures[index] = error if isinstance(error, LLMFailure) else LLMFailure("network", repr(error))
+                        continue
+                    if index > 0:
+                        self.hedge_wins += 1
+                        METRICS.inc("llm_hedge_wins_total")
+                    return task.result()
+
+                if not pending and next_index < len(order):
+                    current = launch()
+
+            ranked = [failures[i] for i in sorted(failures)]
+            raise next((f for f in ranked if f.category != "circuit_open"), ranked[0] if ranked else LLMFailure("deadline"))
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def stream_chat(
+    provider: Provider,
+    messages: list[dict],
+    model: str,
+    temperature: float | None = None,
+    max_tokens: int | None = None,
+    use_cache: bool = True
+):
+    # Yields content deltas from the provider's SSE stream. Raises StreamUnavailable
+    # if the stream can't be opened so callers can fall back to complete().
+
+    key = cache_key(messages, model, temperature, max_tokens)
+    if use_cache:
+        cached = await cache_lookup(key)
+        if cached is not None:
+            METRICS.inc("llm_cache_hits_total")
+            yield cached
+            return
+
+    breaker = provider.breaker
+    if not breaker.allow():
+        raise StreamUnavailable("circuit open")
+
+    session = await provider.session()
+    payload = provider.payload(messages, model, temperature, max_tokens, stream=True)
+
+    try:
+        r = await session.post(provider.url, headers=provider.headers(stream=True), json=payload)
+    except Exception as e:
+        breaker.failure()
+        raise StreamUnavailable(str(e)) from e
+    finally:
+        breaker.release()
+
+    METRICS.inc("llm_requests_total", provider=provider.name, status=r.status)
+    async with r:
+        if r.status != 200:
+            if r.status == 429:
+                METRICS.inc("llm_429_total", provider=provider.name)
+            elif r.status >= 500:
+                breaker.failure()
+            raise StreamUnavailable(f"HTTP {r.status}")
+        breaker.success()
+
+        parts = []
+        async for raw in r.content:
+            line = raw.decode("utf-8", "ignore").strip()
+            # blank lines separate events, ":" lines are keep-alive comments
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                if parts:
+                    await cache_store(key, "".join(parts))
+                return
+            try:
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+            except (ValueError, KeyError, IndexError):
+                continue
+            if delta:
+                parts.append(delta)
+                yield delta
+
+    # the connection closed without [DONE]: what arrived is only part of the reply
+    raise StreamUnavailable("stream ended before [DONE]")
@@ -0,0 +1,238 @@
+import time
+from collections import OrderedDict
+
+import discord
+
+# Roles carrying any of these permissions count as staff and are always in the prompt.
+STAFF_PERMISSIONS = ("administrator", "manage_guild", "manage_messages", "kick_members", "ban_members", "moderate_members")
+
+
+def is_staff_role(role: discord.Role) -> bool:
+    perms = role.permissions
+    return any(getattr(perms, p, False) for p in STAFF_PERMISSIONS)
+
+
+class GuildMemberIndex:
+    # Built once from guild.members, then kept current from member/role events.
+    # Everything the prompt needs is an O(1) lookup, so a reply costs the
+    # size of the slice it asks for, not the size of the guild.
+
+    def __init__(self, guild: discord.Guild):
+        self.guild_id = guild.id
+        self.names: dict[int, str] = {}
+        self.member_roles: dict[int, tuple[int, ...]] = {}
+        self.role_names: dict[int, str] = {}
+        self.role_members: dict[int, set[int]] = {}
+        self.staff_roles: set[int] = set()
+        # bumped whenever anything about the staff roster changes (see prompt_prefix)
+        self.staff_version = 0
+        self._roster: tuple[tuple[int, int], list[dict]] | None = None
+
+        for role in guild.roles:
+            self.upsert_role(role)
+        for member in guild.members:
+            self.upsert_member(member)
+
+    # ---------------- MEMBERS -------------------
+
+    def _is_staff(self, role_ids) -> bool:
+        return any(rid in self.staff_roles for rid in role_ids)
+
+    def upsert_member(self, member: discord.Member):
+        role_ids = tuple(r.id for r in member.roles if not r.is_default())
+        old_roles = self.member_roles.get(member.id)
+        if old_roles == role_ids and self.names.get(member.id) == member.display_name:
+            return
+        if self._is_staff(old_roles or ()) or self._is_staff(role_ids):
+            self.staff_version += 1
+        self._unlink(member.id)
+        self.names[member.id] = member.display_name
+        self.member_roles[member.id] = role_ids
+        for rid in role_ids:
+            self.role_members.setdefault(rid, set()).add(member.id)
+
+    def remove_member(self, member_id: int):
+        if self._is_staff(self.member_roles.get(member_id, ())):
+            self.staff_version += 1
+        self._unlink(member_id)
+
+    def _unlink(self, member_id: int):
+        self.names.pop(member_id, None)
+        for rid in self.member_roles.pop(member_id, ()):
+            members = self.role_members.get(rid)
+            if members:
+                members.discard(member_id)
+
+    # ---------------- ROLES ---------------------
+
+    def upsert_role(self, role: discord.Role):
+        if role.is_default():
+            return
+        was_staff = role.id in self.staff_roles
+        if is_staff_role(role):
+            self.staff_roles.add(role.id)
+        else:
+            self.staff_roles.discard(role.id)
+        if was_staff != (role.id in self.staff_roles) or (was_staff and self.role_names.get(role.id) != role.name):
+            self.staff_version += 1
+        self.role_names[role.id] = role.name
+
+    def remove_role(self, role_id: int):
+        if role_id in self.staff_roles:
+            self.staff_version += 1
+        self.role_names.pop(role_id, None)
+        self.staff_roles.discard(role_id)
+        self.role_members.pop(role_id, None)
+
+    # ---------------- LOOKUPS -------------------
+
+    def staff_ids(self) -> set[int]:
+        ids = set()
+        for rid in self.staff_roles:
+            ids |= self.role_members.get(rid, set())
+        return ids
+
+    def describe(self, member_id: int) -> dict | None:
+        name = self.names.get(member_id)
+        if name is None:
+            return None
+        roles = [self.role_names[r] for r in self.member_roles.get(member_id, ()) if r in self.role_names]
+        return {"id": member_id, "name": name, "roles": roles}
+
+    def staff_roster(self, limit: int = 40) -> list[dict]:
+        # staff in a stable order, so a prompt built from it is byte-identical
+        # until the roster changes; memoised per staff_version
+        key = (self.staff_version, limit)
+        if self._roster is not None and self._roster[0] == key:
+            return self._roster[1]
+        out = []
+        for mid in sorted(self.staff_ids()):
+            info = self.describe(mid)
+            if info is not None:
+                out.append(info)
+                if len(out) >= limit:
+                    break
+        self._roster = (key, out)
+        return out
+
+    def relevant_slice(self, member_ids, limit: int = 40, roster_limit: int | None = None, core=()) -> list[dict]:
+        # Callers pass ids in priority order (author, mentions, recent speakers);
+        # staff fill whatever room is left. With roster_limit the prompt carries
+        # staff_roster(roster_limit) already: staff aren't added as filler, and
+        # ids in that roster are skipped unless they're core (author, mentions),
+        # so staff past the roster cap are still described when they speak.
+        out = []
+        if roster_limit is None:
+            seen = set()
+            candidates = list(member_ids) + sorted(self.staff_ids())
+        else:
+            seen = {m["id"] for m in self.staff_roster(roster_limit)} - set(core)
+            candidates = member_ids
+        for mid in candidates:
+            if mid in seen:
+                continue
+            seen.add(mid)
+            info = self.describe(mid)
+            if info is not None:
+                out.append(info)
+                if len(out) >= limit:
+                    break
+        return out
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+member_indexes: dict[int, GuildMemberIndex] = {}
+
+
+def get_member_index(guild: discord.Guild) -> GuildMemberIndex:
+    index = member_indexes.get(guild.id)
+    if index is None:
+        index = member_indexes[guild.id] = GuildMemberIndex(guild)
+    return index
+
+
+def drop_member_index(guild_id: int):
+    member_indexes.pop(guild_id, None)
+
+
+class MemberTTLCache:
+    # Lean mode: nothing is chunked at startup, so the index only holds the
+    # members prompts have needed lately. Authors and mentions arrive with
+    # the message; other ids are fetched (query_members for a batch,
+    # fetch_member for one) and dropped from the index again after ttl.
+    # Ids that fail to resolve are not retried for negative_ttl.
+
+    def __init__(self, ttl: float = 1800, capacity: int = 20000, negative_ttl: float = 600):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.negative_ttl = negative_ttl
+        self.expires: "OrderedDict[tuple[int, int], float]" = OrderedDict()
+        self.missing: dict[tuple[int, int], float] = {}
+        self.hits = 0
+        self.fetched = 0
+        self.failed = 0
+
+    def touch(self, guild: discord.Guild, member: discord.Member):
+        get_member_index(guild).upsert_member(member)
+        key = (guild.id, member.id)
+        self.expires[key] = time.monotonic() + self.ttl
+        self.expires.move_to_end(key)
+        self.evict()
+
+    def refresh(self, member: discord.Member):
+        # member events only update members we're already holding
+        if (member.guild.id, member.id) in self.expires:
+            get_member_index(member.guild).upsert_member(member)
+
+    def forget(self, guild_id: int, member_id: int):
+        self.expires.pop((guild_id, member_id), None)
+
+    async def ensure(self, guild: discord.Guild, member_ids):
+        index = get_member_index(guild)
+        now = time.monotonic()
+        self.evict(now)
+        wanted = []
+        for mid in dict.fromkeys(member_ids):
+            if mid in index.names:
+                self.hits += 1
+            elif self.missing.get((guild.id, mid), 0) < now:
+                wanted.append(mid)
+        if not wanted:
+            return
+
+        members = []
+        try:
+            if len(wanted) == 1:
+                members = [await guild.fetch_member(wanted[0])]
+            else:
+                members = await guild.query_members(user_ids=wanted[:100], cache=False)
+        except Exception as e:
+            print("Member fetch failed:", e)
+
+        found = set()
+        for member in members:
+            self.touch(guild, member)
+            found.add(member.id)
+        self.fetched += len(found)
+        for mid in wanted:
+            if mid not in found:
+                self.failed += 1
+                self.missing[(guild.id, mid)] = now + self.negative_ttl
+        if len(self.missing) > self.capacity:
+            self.missing = {k: t for k, t in self.missing.items() if t > now}
+
+    def evict(self, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        while self.expires:
+            (guild_id, member_id), expires = next(iter(self.expires.items()))
+            if expires > now and len(self.expires) <= self.capacity:
+                break
+            del self.expires[(guild_id, member_id)]
+            index = member_indexes.get(guild_id)
+            if index is not None:
+                index.remove_member(member_id)
+
+    def __len__(self) -> int:
+        return len(self.expires)
@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict, deque
+
+
+class MemoryEntry:
+    __slots__ = ("author_id", "name", "role", "text", "ts")
+
+    def __init__(self, author_id: int, name: str, role: str, text: str, ts: float):
+        self.author_id = author_id
+        self.name = name
+        self.role = role
+        self.text = text
+        self.ts = ts
+
+
+class ChannelMemory:
+    # Ring buffer per channel, channels kept in LRU order (oldest first).
+    # A channel is dropped when it sits idle past idle_seconds, or when the
+    # total number of entries across all channels goes over global_cap.
+    # With a StateStore attached, channels are written behind and reloaded
+    # lazily the first time they're touched again (eviction only frees RAM).
+    # An attached RetrievalIndex gets every entry too, and keeps them long
+    # after they leave the ring buffer.
+
+    def __init__(self, per_channel: int = 40, global_cap: int = 20000, idle_seconds: int = 6 * 3600, store=None, index=None):
+        self.per_channel = per_channel
+        self.global_cap = global_cap
+        self.idle_seconds = idle_seconds
+        self.store = store
+        self.index = index
+        self.channels: "OrderedDict[int, deque]" = OrderedDict()
+        self.total = 0
+
+    def _load(self, channel_id: int):
+        if self.store is None or channel_id in self.channels:
+            return
+        rows = self.store.get("memory", channel_id)
+        if not rows:
+            return
+        buf = deque((MemoryEntry(*row) for row in rows), maxlen=self.per_channel)
+        self.channels[channel_id] = buf
+        self.total += len(buf)
+
+    def _persist(self, channel_id: int, buf: deque):
+        # the buffer itself is captured, so a channel evicted before the next
+        # flush is still written with its final contents
+        if self.store is not None:
+            self.store.mark("memory", channel_id, lambda: [[e.author_id, e.name, e.role, e.text, e.ts] for e in buf])
+
+    def append(self, channel_id: int, author_id: int, name: str, role: str, text: str, ts: float | None = None):
+        now = time.time() if ts is None else ts
+        self._load(channel_id)
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            buf = self.channels[channel_id] = deque(maxlen=self.per_channel)
+        else:
+            self.channels.move_to_end(channel_id)
+
+        if len(buf) < self.per_channel:
+            self.total += 1
+        entry = MemoryEntry(author_id, name, role, text, now)
+        buf.append(entry)
+        self._persist(channel_id, buf)
+        if self.index is not None:
+            self.index.add(channel_id, entry)
+
+        self.evict(now, keep=channel_id)
+
+    def window(self, channel_id: int, size: int) -> list[MemoryEntry]:
+        self._load(channel_id)
+        buf = self.channels.get(channel_id)
+        if not buf:
+            return []
+        if size >= len(buf):
+            return list(buf)
+        return [buf[i] for i in range(len(buf) - size, len(buf))]
+
+    def evict(self, now: float | None = None, keep: int | None = None):
+        now = time.time() if now is None else now
+        cutoff = now - self.idle_seconds
+        while self.channels:
+            channel_id, buf = next(iter(self.channels.items()))
+            if channel_id == keep:
+                break
+            idle = not buf or buf[-1].ts < cutoff
+            if not idle and self.total <= self.global_cap:
+                break
+            self.drop(channel_id)
+
+    def drop(self, channel_id: int):
+        buf = self.channels.pop(channel_id, None)
+        if buf is not None:
+            self.total -= len(buf)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.channels
+
+    def __len__(self) -> int:
+        return self.total
@@ -0,0 +1,238 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# seconds; wide enough for a cache hit and a provider call with backoff
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    # Cumulative-bucket histogram (Prometheus layout). observe() is one
+    # bisect and two adds, so it's cheap enough for every message.
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        # linear interpolation inside the bucket holding the q-th sample
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Timer:
+    __slots__ = ("hist", "started")
+
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started)
+        return False
+
+
+# labels added to everything recorded in the current context; host.py sets
+# persona=... around each bot it runs, and asyncio tasks inherit it
+CONTEXT_LABELS: ContextVar[tuple] = ContextVar("metrics_labels", default=())
+
+
+def _labels(labels: dict) -> tuple:
+    own = tuple(sorted(labels.items())) if labels else ()
+    context = CONTEXT_LABELS.get()
+    return context + own if context else own
+
+
+@contextmanager
+def labelled(**labels):
+    token = CONTEXT_LABELS.set(CONTEXT_LABELS.get() + tuple(sorted(labels.items())))
+    try:
+        yield
+    finally:
+        CONTEXT_LABELS.reset(token)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: tuple, le: str | None = None) -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    # Counters and histograms keyed by (name, labels); gauges are callables
+    # read only when /metrics or !stats asks, so they cost nothing per message.
+    # Names are exported with the "ardunot_" prefix.
+
+    def __init__(self, prefix: str = "ardunot_"):
+        self.prefix = prefix
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.gauges: dict[str, dict[tuple, object]] = {}
+        self.help: dict[str, str] = {
+            "stage_seconds": "Latency of each reply pipeline stage",
+            "llm_call_seconds": "Provider call latency including retries and backoff",
+        }
+        self.started = time.time()
+        self.runner = None
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, _labels(labels))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        return hist
+
+    def observe(self, name: str, value: float, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def time(self, name: str, **labels) -> Timer:
+        return Timer(self.histogram(name, **labels))
+
+    def gauge(self, name: str, fn, text: str = ""):
+        # fn() returns a number, or {((label, value), ...): number} for a labelled series.
+        # Registered once per context labels, so each persona keeps its own.
+        self.gauges.setdefault(name, {})[CONTEXT_LABELS.get()] = fn
+        if text:
+            self.help[name] = text
+
+    @staticmethod
+    def _read_one(context: tuple, fn) -> list[tuple[tuple, float]]:
+        try:
+            value = fn()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [(context + labels, v) for labels, v in value.items()]
+        return [(context, value)]
+
+    def _read_gauge(self, name: str) -> list[tuple[tuple, float]]:
+        return [series for context, fn in self.gauges[name].items() for series in self._read_one(context, fn)]
+
+    # ---------------- EXPORT ------------------------
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        out = []
+
+        def header(name, kind):
+            if name in self.help:
+                out.append(f"# HELP {self.prefix}{name} {self.help[name]}")
+            out.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for name in sorted({n for n, _ in self.counters}):
+            header(name, "counter")
+            for (n, labels), value in self.counters.items():
+                if n == name:
+                    out.append(f"{self.prefix}{name}{_fmt_labels(labels)} {value}")
+
+        for name in sorted({n for n, _ in self.histograms}):
+            header(name, "histogram")
+            for (n, labels), hist in self.histograms.items():
+                if n != name:
+                    continue
+                running = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    running += count
+                    out.append(f"{self.prefix}{name}_bucket{_fmt_labels(labels, str(bound))} {running}")
+                out.append(f"{self.prefix}{name}_bucket{_fmt_labels(labels, '+Inf')} {hist.count}")
+                out.append(f"{self.prefix}{name}_sum{_fmt_labels(labels)} {hist.sum}")
+                out.append(f"{self.prefix}{name}_count{_fmt_labels(labels)} {hist.count}")
+
+        for name in sorted(self.gauges):
+            header(name, "gauge")
+            for labels, value in self._read_gauge(name):
+                out.append(f"{self.prefix}{name}{_fmt_labels(labels)} {value}")
+
+        out.append(f"{self.prefix}uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> list[str]:
+        # short human-readable lines for the !stats command
+        lines = [f"uptime {time.time() - self.started:.0f}s"]
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if not hist.count:
+                continue
+            label = ",".join(str(v) for _, v in labels)
+            p50, p95 = hist.quantile(0.5), hist.quantile(0.95)
+            lines.append(
+                f"{name}[{label}] n={hist.count} avg={hist.sum / hist.count * 1000:.0f}ms "
+                f"p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms"
+            )
+        for (name, labels), value in sorted(self.counters.items()):
+            label = ",".join(str(v) for _, v in labels)
+            lines.append(f"{name}[{label}] {value:g}" if label else f"{name} {value:g}")
+        for name in sorted(self.gauges):
+            for context, fn in self.gauges[name].items():
+                values = self._read_one(context, fn)
+                label = ",".join(str(v) for _, v in context)
+                shown = f"{name}[{label}]" if label else name
+                if len(values) == 1 and values[0][0] == context:
+                    lines.append(f"{shown} {values[0][1]:g}")
+                elif values:
+                    lines.append(f"{shown} ({len(values)} series) max={max(v for _, v in values):g}")
+        return lines
+
+    # ---------------- HTTP --------------------------
+
+    async def serve(self, port: int, host: str = "127.0.0.1"):
+        # optional local scrape endpoint; only started when a port is configured
+        from aiohttp import web
+
+        if self.runner is not None:
+            return
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        print(f"Metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+METRICS = Metrics()
+
+
+def stage(name: str) -> Timer:
+    # per-stage latency of the reply pipeline: `with stage("send"): ...`
+    return METRICS.time("stage_seconds", stage=name)
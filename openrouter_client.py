@@ -1,71 +1,74 @@
-import aiohttp
 import os
-import asyncio
 from dotenv import load_dotenv
 
+from llm_client import LLMFailure, StreamUnavailable, failure_message, register_provider, complete, stream_chat
+
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+
+def openrouter_provider(api_key: str | None = None):
+    # The key is read when this is called, not when the module was first
+    # imported, so each bot host.py loads gets the key from its own env
+    return register_provider(
+        "openrouter",
+        OPENROUTER_URL,
+        api_key if api_key is not None else os.getenv("OPENROUTER_API_KEY"),
+        # REQUIRED by OpenRouter
+        {"HTTP-Referer": "https://discord.com", "X-Title": "Discord Bot"}
+    )
 
-SESSION: aiohttp.ClientSession | None = None
+
+OPENROUTER = openrouter_provider(OPENROUTER_API_KEY)
 
 
 async def get_session():
-    global SESSION
-    if SESSION is None or SESSION.closed:
-        SESSION = aiohttp.ClientSession()
-    return SESSION
+    return await OPENROUTER.session()
 
 
 async def call_openrouter(
-    prompt: str,
-    model: str,
+    prompt: str | None = None,
+    model: str = "openai/gpt-3.5-turbo",
     temperature: float = 0.6,
-    retries: int = 4
+    retries: int = 4,
+    use_cache: bool = True,
+    messages: list[dict] | None = None,
+    provider=None
 ) -> str:
 
-    if not OPENROUTER_API_KEY:
+    provider = provider or OPENROUTER
+    if not provider.api_key:
         return "⚠️ OpenRouter API key missing."
 
-    session = await get_session()
+    if messages is None:
+        messages = [{"role": "user", "content": prompt}]
 
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": temperature
-    }
+    try:
+        return await complete(provider, messages, model, temperature, retries=retries, use_cache=use_cache)
+    except LLMFailure as e:
+        print("OpenRouter call failed:", e)
+        return failure_message(e, "⚠️ I'm having trouble responding right now.")
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
 
-        # REQUIRED by OpenRouter
-        "HTTP-Referer": "https://discord.com",
-        "X-Title": "Discord Bot"
-    }
-
-    backoff = 1
-
-    for _ in range(retries):
-        try:
-            async with session.post(OPENROUTER_URL, headers=headers, json=payload, timeout=25) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    return data["choices"][0]["message"]["content"]
-
-                # Rate limit
-                if r.status == 429:
-                    await asyncio.sleep(backoff)
-                    backoff = min(backoff * 2, 10)
-                    continue
-
-                # Other server errors
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 10)
-
-        except Exception:
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 10)
-
-    return "⚠️ I'm having trouble responding right now."
+async def stream_openrouter(
+    prompt: str | None = None,
+    model: str = "openai/gpt-3.5-turbo",
+    temperature: float = 0.6,
+    use_cache: bool = True,
+    messages: list[dict] | None = None,
+    provider=None
+):
+    # Yields content deltas from OpenRouter's SSE stream. Raises StreamUnavailable
+    # if the stream can't be opened so callers can fall back to call_openrouter.
+
+    provider = provider or OPENROUTER
+    if not provider.api_key:
+        raise StreamUnavailable("missing api key")
+
+    if messages is None:
+        messages = [{"role": "user", "content": prompt}]
+
+    async for delta in stream_chat(provider, messages, model, temperature, use_cache=use_cache):
+        yield delta
@@ -0,0 +1,246 @@
+import asyncio
+from collections import deque
+
+from metrics import METRICS
+
+MAX_LEN = 2000
+FENCE = "```"
+
+
+def _cut_points(window: str, fence: str | None):
+    # Walks the lines of `window` tracking whether we're inside a code block
+    # (starting in `fence`). Returns cut positions by preference: between
+    # code blocks and prose, paragraph breaks outside code, any line end.
+    between, paragraphs, lines = [], [], []
+    pos = 0
+    for line in window.splitlines(keepends=True):
+        end = pos + len(line)
+        is_fence = line.lstrip().startswith(FENCE)
+        if is_fence and fence is None:
+            between.append(pos)  # before a block opens
+            fence = line.strip()
+        elif is_fence:
+            fence = None
+            if line.endswith("\n"):
+                between.append(end)  # after a block closes
+        elif fence is None and line.strip() == "" and pos:
+            paragraphs.append(pos)
+        if line.endswith("\n"):
+            lines.append(end)
+        pos = end
+    return between, paragraphs, lines
+
+
+def _fence_after(text: str, fence: str | None) -> str | None:
+    for line in text.splitlines():
+        if line.lstrip().startswith(FENCE):
+            fence = None if fence is not None else line.strip()
+    return fence
+
+
+def split_message(text: str, limit: int = MAX_LEN) -> list[str]:
+    # Splits a reply into messages of at most `limit` characters, preferring
+    # code-block and paragraph boundaries. A block that has to be cut is
+    # closed at the end of one part and reopened (same language) in the next.
+    if len(text) <= limit:
+        return [text]
+
+    parts = []
+    fence = None
+    rest = text
+    while rest:
+        prefix = fence + "\n" if fence else ""
+        if len(prefix) + len(rest) <= limit:
+            parts.append(prefix + rest)
+            break
+
+        room = limit - len(prefix) - len("\n" + FENCE)
+        window = rest[:room]
+        between, paragraphs, lines = _cut_points(window, fence)
+        floor = room // 3
+        cut = None
+        for candidates in (between, paragraphs, lines):
+            usable = [c for c in candidates if c >= floor]
+            if usable:
+                cut = usable[-1]
+                break
+        if cut is None:
+            space = window.rfind(" ", floor)
+            cut = space + 1 if space > 0 else room
+
+        chunk = rest[:cut]
+        after = _fence_after(chunk, fence)
+        piece = (prefix + chunk).rstrip("\n")
+        if after is not None:
+            piece += "\n" + FENCE
+        if piece.strip():
+            parts.append(piece)
+        fence = after
+        rest = rest[cut:]
+        if fence is None:
+            rest = rest.lstrip("\n")
+    return parts
+
+
+class Outgoing:
+    __slots__ = ("text", "merge", "kwargs", "future")
+
+    def __init__(self, text: str, merge: bool, kwargs: dict, future: asyncio.Future):
+        self.text = text
+        self.merge = merge
+        self.kwargs = kwargs
+        self.future = future
+
+
+class OutboundDispatcher:
+    # All bot replies go through here. Each channel has a FIFO drained by one
+    # task, so replies land in order and never race. Queued mergeable replies
+    # are joined when they fit in one message, long ones are split with
+    # split_message(), and every send first takes a token from the channel
+    # bucket (per_channel per period) and a bot-wide one (global_per_second),
+    # so bursts are paced locally instead of bouncing off Discord's 429s.
+    # Under cluster.py the bot-wide bucket is the coordinator's: shared(rules)
+    # (ClusterClient.rate) acquires from it, so the cap holds across workers.
+    # A channel only ever lives in one worker, so its bucket stays local.
+
+    def __init__(self, limiter, per_channel: int = 5, period: float = 5.0, global_per_second: int = 45,
+                 limit: int = MAX_LEN, on_sent=None, shared=None):
+        self.limiter = limiter
+        self.shared = shared
+        self.per_channel = per_channel
+        self.period = period
+        self.global_per_second = global_per_second
+        self.limit = limit
+        self.on_sent = on_sent
+        self.queues: dict[int, deque] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.typing_refs: dict[int, int] = {}
+        self.typing_stops: dict[int, asyncio.Event] = {}
+        self.sent = 0
+        self.merged = 0
+        self.split = 0
+        self.paced = 0
+
+    async def send(self, channel, text: str, merge: bool = True, **kwargs) -> list:
+        # Returns every message posted for this text (more than one if it was
+        # split). kwargs go to the first part only (e.g. reference=).
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = deque()
+        queue.append(Outgoing(text, merge and not kwargs, kwargs, future))
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._drain(channel))
+        return await future
+
+    def _take(self, queue: deque) -> list[Outgoing]:
+        batch = [queue.popleft()]
+        size = len(batch[0].text)
+        while batch[0].merge and queue and queue[0].merge and size + 2 + len(queue[0].text) <= self.limit:
+            item = queue.popleft()
+            size += 2 + len(item.text)
+            batch.append(item)
+        return batch
+
+    async def _drain(self, channel):
+        queue = self.queues[channel.id]
+        try:
+            while queue:
+                batch = self._take(queue)
+                if len(batch) > 1:
+                    self.merged += len(batch) - 1
+                    METRICS.inc("outbound_merged_total", len(batch) - 1)
+                try:
+                    sent = await self._post(channel, "\n\n".join(item.text for item in batch), batch[0].kwargs)
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_result(sent)
+        finally:
+            self.tasks.pop(channel.id, None)
+            self.queues.pop(channel.id, None)
+
+    async def _post(self, channel, text: str, kwargs: dict) -> list:
+        parts = split_message(text, self.limit)
+        if len(parts) > 1:
+            self.split += 1
+            METRICS.inc("outbound_split_total")
+        sent = []
+        for i, part in enumerate(parts):
+            await self.pace(channel.id)
+            msg = await channel.send(part, **(kwargs if i == 0 else {}))
+            self.sent += 1
+            METRICS.inc("outbound_sent_total")
+            sent.append(msg)
+            if self.on_sent is not None:
+                self.on_sent(msg)
+        return sent
+
+    async def pace(self, channel_id: int):
+        channel_rule = ("send", channel_id, self.per_channel, self.period)
+        global_rule = ("send_global", 0, self.global_per_second, 1.0)
+        if self.shared is None:
+            await self._wait_for(self._local, [channel_rule, global_rule])
+        else:
+            await self._wait_for(self._local, [channel_rule])
+            await self._wait_for(self._global, [global_rule])
+
+    async def _local(self, rules) -> float:
+        return self.limiter.acquire(rules)
+
+    async def _global(self, rules) -> float:
+        try:
+            return await self.shared(rules)
+        except Exception as e:
+            print("Cluster send pacing failed:", e)
+            return self.limiter.acquire(rules)
+
+    async def _wait_for(self, acquire, rules):
+        while True:
+            wait = await acquire(rules)
+            if not wait:
+                return
+            self.paced += 1
+            METRICS.inc("outbound_paced_total")
+            await asyncio.sleep(wait)
+
+    # ---------------- TYPING --------------------
+
+    def typing(self, channel):
+        return _Typing(self, channel)
+
+    async def _type(self, channel, stop: asyncio.Event):
+        try:
+            async with channel.typing():
+                await stop.wait()
+        except Exception as e:
+            print("Typing indicator error:", e)
+
+
+class _Typing:
+    # Shows "Bot is typing..." while any generation for the channel is in
+    # flight; overlapping generations share one indicator.
+
+    def __init__(self, dispatcher: OutboundDispatcher, channel):
+        self.dispatcher = dispatcher
+        self.channel = channel
+
+    async def __aenter__(self):
+        d, cid = self.dispatcher, self.channel.id
+        d.typing_refs[cid] = d.typing_refs.get(cid, 0) + 1
+        if d.typing_refs[cid] == 1:
+            stop = d.typing_stops[cid] = asyncio.Event()
+            asyncio.create_task(d._type(self.channel, stop))
+        return self
+
+    async def __aexit__(self, *exc):
+        d, cid = self.dispatcher, self.channel.id
+        d.typing_refs[cid] -= 1
+        if d.typing_refs[cid] == 0:
+            del d.typing_refs[cid]
+            d.typing_stops.pop(cid).set()
+        return False
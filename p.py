@@ -1,33 +1,185 @@
 import os
 import discord
 from discord.ext import commands
-from collections import deque
-import aiohttp
 import asyncio
 import re
+import time
 from datetime import datetime, timedelta, timezone
+from memory import ChannelMemory
+from retrieval import RetrievalIndex
+from state_store import StateStore, PersistentDict, encode_datetime, decode_datetime
+from rate_limiter import RateLimiter, ShushTimer
+from member_index import get_member_index, drop_member_index, MemberTTLCache
+from sent_cache import SentMessageCache
+from coalescer import ChannelCoalescer
+from scheduler import LLMScheduler, QueueFull
+from llm_client import CACHE, LLMFailure, failure_message, register_provider, ProviderChain, use_shared_cache
+from metrics import METRICS, stage
+from prompt_budget import PromptAssembler
+from cluster import ClusterClient, shard_state_path
+from router import ModelRouter, Tier
+from outbound import OutboundDispatcher
+from trace_recorder import TraceRecorder
+from prompt_prefix import PrefixCache
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 HF_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Lean mode: no presences and no member chunking at startup; the members a
+# prompt needs are fetched on demand and held for MEMBER_TTL_SECONDS
+LEAN_INTENTS = os.getenv("LEAN_INTENTS", "0") == "1"
+MEMBER_TTL_SECONDS = float(os.getenv("MEMBER_TTL_SECONDS", 1800))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 20000))
+
+if LEAN_INTENTS:
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    bot_options = {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags.none()}
+else:
+    intents = discord.Intents.all()
+    bot_options = {}
+
+member_cache = MemberTTLCache(MEMBER_TTL_SECONDS, MEMBER_CACHE_SIZE)
+
+# Cluster mode: cluster.py starts each worker with its shards and the
+# coordinator socket (shared provider slots, rate limits and response cache)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0))
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s]
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET")
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None, **bot_options)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, **bot_options)
+
+cluster = ClusterClient(CLUSTER_SOCKET) if CLUSTER_SOCKET else None
+if cluster is not None:
+    use_shared_cache(cluster)
+
+HF_URL = os.getenv("HF_URL", "https://router.huggingface.co/v1/chat/completions")
+MODEL = os.getenv("MODEL", "meta-llama/Llama-3.2-3B-Instruct")
 
-HF_URL = "https://router.huggingface.co/v1/chat/completions"
-MODEL = "meta-llama/Llama-3.2-3B-Instruct"
+# pooled keep-alive connection to the HF router, shared across replies
+HF = register_provider("hf", HF_URL, HF_API_KEY)
+
+# Optional OpenRouter fallback used for hedging/failover when its key is set
+FALLBACK_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+FALLBACK_MODEL = "openai/gpt-3.5-turbo"
+FALLBACK = register_provider(
+    "openrouter", FALLBACK_URL, os.getenv("OPENROUTER_FALLBACK_KEY"),
+    {"HTTP-Referer": "https://discord.com", "X-Title": "Discord Bot"}
+)
+
+LLM_CHAIN = ProviderChain([(HF, MODEL), (FALLBACK, FALLBACK_MODEL)], hedge=os.getenv("LLM_HEDGE", "1") == "1")
+
+# Code and long questions go to a bigger model (see MODEL_ROUTER)
+STRONG_MODEL = os.getenv("STRONG_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
+STRONG_CHAIN = ProviderChain([(HF, STRONG_MODEL), (FALLBACK, FALLBACK_MODEL)], hedge=os.getenv("LLM_HEDGE", "1") == "1")
 
 CREATOR_ID = 1020353220641558598
 OWNER_IDS = {1020353220641558598, 1167443519070290051}
 
-# channel_id -> list of strings (chat memory)
-channel_memory = {}
-shushed_channels = {}
-server_modes = {}
+# channel_id -> ring buffer of MemoryEntry (chat memory), idle channels evicted LRU-first
+MEMORY_PER_CHANNEL = int(os.getenv("MEMORY_PER_CHANNEL", 40))
+MEMORY_GLOBAL_CAP = int(os.getenv("MEMORY_GLOBAL_CAP", 20000))
+MEMORY_IDLE_SECONDS = int(os.getenv("MEMORY_IDLE_SECONDS", 6 * 3600))
+MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", 12))
+
+# max members described in the prompt (author, mentions, recent speakers), and
+# max staff in the cached prompt prefix
+MEMBER_SLICE_LIMIT = int(os.getenv("MEMBER_SLICE_LIMIT", 40))
+
+# Input-side token budget per model; members and history are trimmed to fit
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1500))
+PROMPT_BUDGETS = {MODEL: PROMPT_TOKEN_BUDGET, STRONG_MODEL: PROMPT_TOKEN_BUDGET}
+PROMPT_USER_CAP = int(os.getenv("PROMPT_USER_CAP", 400))
+# Cap on the cached prefix (staff roster included), so it always fits next to
+# a full-length user message
+PROMPT_PREFIX_CAP = int(os.getenv("PROMPT_PREFIX_CAP", 400))
+PROMPT_RECENT_HISTORY = int(os.getenv("PROMPT_RECENT_HISTORY", 4))
+
+# Route each request to the fast or strong chain by a local complexity score,
+# adjusted by the models' recent latency and errors; MODEL_ROUTER=0 sends
+# everything to the fast chain (the old single model)
+MODEL_ROUTER = os.getenv("MODEL_ROUTER", "1") == "1"
+ROUTER_STRONG_SCORE = int(os.getenv("ROUTER_STRONG_SCORE", 3))
+ROUTER_BORDERLINE_P50 = float(os.getenv("ROUTER_BORDERLINE_P50", 6.0))
+
+router = ModelRouter(
+    Tier("fast", LLM_CHAIN, max_tokens=220),
+    Tier("strong", STRONG_CHAIN, max_tokens=400),
+    ROUTER_STRONG_SCORE,
+    ROUTER_BORDERLINE_P50,
+    enabled=MODEL_ROUTER,
+    default="fast"
+)
+
+# IDs of messages the bot sent, so reply detection rarely needs fetch_message
+SENT_CACHE_SIZE = int(os.getenv("SENT_CACHE_SIZE", 5000))
+BACKFILL_CHANNELS = int(os.getenv("BACKFILL_CHANNELS", 50))
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", 100))
+
+sent_cache = SentMessageCache(SENT_CACHE_SIZE)
+
+# Modes, shushes and memory survive restarts (lazy-loaded, write-behind)
+STATE_DB = os.getenv("STATE_DB", "p_state.db")
+if CLUSTER_SOCKET and SHARD_IDS:
+    # cluster worker: its own file for the guilds its shards own
+    STATE_DB = shard_state_path(STATE_DB, SHARD_IDS)
+state_store = StateStore(STATE_DB, float(os.getenv("STATE_FLUSH_SECONDS", 2.0)))
+
+# Long history per channel, searched (BM25) for messages related to the question;
+# the top hits from outside the live window go into the prompt. 0 turns it off
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 4))
+# sized against channel memory: twice MEMORY_GLOBAL_CAP in all, or the same
+# in lean mode, so the index can't outgrow the memory ceiling by default
+RETRIEVAL_PER_CHANNEL = int(os.getenv("RETRIEVAL_PER_CHANNEL", 200 if LEAN_INTENTS else 500))
+RETRIEVAL_GLOBAL_CAP = int(os.getenv("RETRIEVAL_GLOBAL_CAP", MEMORY_GLOBAL_CAP * (1 if LEAN_INTENTS else 2)))
+
+retrieval_index = RetrievalIndex(RETRIEVAL_PER_CHANNEL, RETRIEVAL_GLOBAL_CAP, MEMORY_IDLE_SECONDS, state_store)
+
+channel_memory = ChannelMemory(
+    MEMORY_PER_CHANNEL, MEMORY_GLOBAL_CAP, MEMORY_IDLE_SECONDS, state_store,
+    retrieval_index if RETRIEVAL_TOP_K else None
+)
+shushed_channels = PersistentDict(state_store, "shush", encode_datetime, decode_datetime)
+shush_timer = ShushTimer(shushed_channels)
+server_modes = PersistentDict(state_store, "mode")
 GLOBAL_DEFAULT_MODE = "serious"
 
 RATE_WINDOW_SECONDS = 60
 RATE_LIMITS = {"serious": 6, "funny": 6}
-rate_buckets = {}
+CHANNEL_RATE_LIMIT = int(os.getenv("CHANNEL_RATE_LIMIT", 6))
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", 4))
+RATE_MAX_WAIT = float(os.getenv("RATE_MAX_WAIT", 10))
+rate_limiter = RateLimiter()
+
+# Outgoing replies are queued per channel and paced to Discord's send buckets
+# (5 per 5s per channel, ~50/s per bot) so bursts never hit a 429
+OUTBOUND_CHANNEL_LIMIT = int(os.getenv("OUTBOUND_CHANNEL_LIMIT", 5))
+OUTBOUND_CHANNEL_PERIOD = float(os.getenv("OUTBOUND_CHANNEL_PERIOD", 5.0))
+OUTBOUND_GLOBAL_PER_SECOND = int(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", 45))
+
+outbound = OutboundDispatcher(
+    rate_limiter,
+    OUTBOUND_CHANNEL_LIMIT,
+    OUTBOUND_CHANNEL_PERIOD,
+    OUTBOUND_GLOBAL_PER_SECOND,
+    on_sent=lambda m: sent_cache.add(m.id),
+    # cluster mode: the bot-wide send bucket is shared by every worker
+    shared=cluster.rate if cluster is not None else None
+)
+
+# Local Prometheus endpoint, off unless METRICS_PORT is set
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_TOP_CHANNELS = int(os.getenv("METRICS_TOP_CHANNELS", 20))
+
+# Optional JSONL trace of incoming traffic and reply outcomes, for bench/replay.py
+TRACE_PATH = os.getenv("TRACE_PATH")
+trace = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+
 current_mode_global = GLOBAL_DEFAULT_MODE
 
 FUNNY_INSTRUCTIONS = (
@@ -67,69 +219,148 @@ def extract_time(text: str):
 def fix_user_mentions(text: str):
     return re.sub(r"<(\d{15,25})>", r"<@\1>", text)
 
-async def fetch_ai_response(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member):
-    headers = {"Authorization": f"Bearer {HF_API_KEY}", "Content-Type": "application/json"}
-    mem = channel_memory.get(channel.id, [])
-    history_msgs = []
-    for item in mem:
-        if item.startswith("assistant:"):
-            history_msgs.append({"role": "assistant", "content": item[len("assistant:"):].strip()})
-        else:
-            history_msgs.append({"role": "user", "content": item})
-
+async def load_prompt_members(guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=()):
+    # Lean mode: index the author and mentions from the message itself, and
+    # fetch any recent speakers that aren't held any more
+    for member in (author, *mentioned):
+        if hasattr(member, "roles"):
+            member_cache.touch(guild, member)
+    speakers = [e.author_id for e in channel_memory.window(channel.id, MEMORY_WINDOW) if e.role == "user"]
+    await member_cache.ensure(guild, speakers)
+
+def author_text(channel: discord.TextChannel, author: discord.Member, fallback: str) -> str:
+    # What the author actually said, without the roast instructions around it
+    mem = channel_memory.window(channel.id, MEMORY_WINDOW)
+    return next((e.text for e in reversed(mem) if e.author_id == author.id), fallback)
+
+async def fetch_ai_response(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=()):
+    tier = router.route(author_text(channel, author, user_msg), server_modes.get(guild.id, current_mode_global))
+    if LEAN_INTENTS:
+        with stage("member_load"):
+            await load_prompt_members(guild, channel, author, mentioned)
+    with stage("prompt_build"):
+        messages = build_messages(user_msg, guild, channel, author, mentioned, tier.model or MODEL)
+
+    with stage("llm"):
+        try:
+            return await tier.chain.complete(messages, max_tokens=tier.max_tokens)
+        except LLMFailure as e:
+            print("LLM call failed:", e)
+            return failure_message(e, "⚠️ AI failed to respond.")
+
+def build_prefix(guild: discord.Guild, mode: str) -> str:
+    # Same for every request in the guild until prefix_cache rebuilds it
+    personality_instructions = SERIOUS_INSTRUCTIONS if mode == "serious" else FUNNY_INSTRUCTIONS
     try:
-        member_info_list = [
-            {"id": m.id, "name": m.display_name, "roles": [r.name for r in m.roles if r.name != "@everyone"]}
-            for m in guild.members
-        ]
+        staff = get_member_index(guild).staff_roster(MEMBER_SLICE_LIMIT)
     except:
-        member_info_list = []
-
-    current_user_info = f"User speaking now: {author.display_name} (ID={author.id})"
-    mode = server_modes.get(guild.id, current_mode_global)
-    personality_instructions = SERIOUS_INSTRUCTIONS if mode == "serious" else FUNNY_INSTRUCTIONS
-
-    system_prompt = (
+        staff = []
+    head = (
         f"You are Ardunot-v2, a helpful Discord bot running in '{guild.name}'.\n\n"
-        f"Never roast Ardunot. Never reveal user IDs in text. Always be funny in funny mode. "
-        f"{current_user_info}\n"
-        f"Members metadata: {member_info_list}\n"
+        f"Never roast Ardunot. Never reveal user IDs in text. Always be funny in funny mode.\n"
         f"{personality_instructions}\n"
-        f"Talk also when chat is dead."
+        f"Talk also when chat is dead.\n"
+        f"Staff metadata: "
     )
-
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            *history_msgs,
-            {"role": "user", "content": user_msg}
-        ],
-        "max_tokens": 220
-    }
-
+    # the roster is cut by tokens, not just count, so it can't crowd out the user
+    prompt = PromptAssembler(PROMPT_PREFIX_CAP)
+    head = prompt.fixed("prefix", head)
+    staff = prompt.fill("staff", staff, separator_tokens=2)
+    return head + f"{staff}\n"
+
+prefix_cache = PrefixCache(build_prefix)
+
+def build_messages(user_msg: str, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member, mentioned=(), model: str = MODEL) -> list[dict]:
+    # The system message starts with the cached guild prefix, unchanged, so
+    # provider prompt caching can reuse it; the speaker, members and related
+    # messages follow. Budgeted in priority order: system text, the user's
+    # message, author and mentions, newest history, related older messages,
+    # other members, older history.
+    mem = channel_memory.window(channel.id, MEMORY_WINDOW)
+    newest_first = [
+        {"role": "assistant", "content": e.text} if e.role == "assistant"
+        else {"role": "user", "content": f"{e.name}: {e.text}"}
+        for e in reversed(mem)
+    ]
+    related = []
+    if RETRIEVAL_TOP_K:
+        query = author_text(channel, author, user_msg)
+        with stage("retrieval"):
+            related = [
+                f"BOT: {e.text}" if e.role == "assistant" else f"{e.name}: {e.text}"
+                for e in retrieval_index.search(channel.id, query, RETRIEVAL_TOP_K, mem[0].ts if mem else None)
+            ]
+
+    relevant_ids = [author.id, *(m.id for m in mentioned), *(e.author_id for e in reversed(mem) if e.role == "user")]
+    core_ids = {author.id, *(m.id for m in mentioned)}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(HF_URL, headers=headers, json=payload) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    content = data["choices"][0]["message"]["content"]
-                    return content
-                else:
-                    return "⚠️ AI failed to respond."
+        # staff in the prefix's roster are described there already
+        member_info_list = get_member_index(guild).relevant_slice(relevant_ids, MEMBER_SLICE_LIMIT, MEMBER_SLICE_LIMIT, core_ids)
     except:
-        return "⚠️ AI failed to respond."
-
-def can_send_in_guild(guild_id: int, mode: str, channel_id: int) -> bool:
-    now = datetime.now(timezone.utc)
-    bucket = rate_buckets.setdefault(guild_id, deque())
-    while bucket and (now - bucket[0]).total_seconds() > RATE_WINDOW_SECONDS:
-        bucket.popleft()
-    limit = RATE_LIMITS.get(mode, RATE_LIMITS["serious"])
-    if len(bucket) < limit:
-        bucket.append(now)
-        return True
-    return False
+        member_info_list = []
+
+    prefix = prefix_cache.get(guild, server_modes.get(guild.id, current_mode_global))
+    current_user_info = f"User speaking now: {author.display_name} (ID={author.id})"
+
+    def system_prompt(members, related=()):
+        return (
+            prefix
+            + f"\n{current_user_info}\n"
+            + f"Members metadata: {members}"
+            + ("\n\nEarlier messages that may be related:\n" + "\n".join(related) if related else "")
+        )
+
+    prompt = PromptAssembler(PROMPT_BUDGETS.get(model, PROMPT_TOKEN_BUDGET), model)
+    # The user's message (up to PROMPT_USER_CAP) is set aside before the
+    # system text is spent, so the prefix is what gets cut on a small budget
+    frame = system_prompt([])[len(prefix):]
+    reserve = min(PROMPT_USER_CAP, prompt.counter.count(user_msg, model)) + prompt.counter.count(frame, model)
+    prefix = prompt.fixed("system", prefix, max(0, prompt.left - reserve))
+    prompt.fixed("system", frame)
+    user_msg = prompt.fixed("user", user_msg, PROMPT_USER_CAP)
+
+    turn = lambda m: m["content"]
+    members = prompt.fill("members", [m for m in member_info_list if m["id"] in core_ids], separator_tokens=2)
+    history = prompt.fill("history", newest_first[:PROMPT_RECENT_HISTORY], turn, 4)
+    if related:
+        prompt.fixed("related", "\n\nEarlier messages that may be related:\n")
+        related = prompt.fill("related", related)
+    members += prompt.fill("members", [m for m in member_info_list if m["id"] not in core_ids], separator_tokens=2)
+    if len(history) == len(newest_first[:PROMPT_RECENT_HISTORY]):
+        history += prompt.fill("history", newest_first[PROMPT_RECENT_HISTORY:], turn, 4)
+    prompt.record()
+
+    return [
+        {"role": "system", "content": system_prompt(members, related)},
+        *reversed(history),
+        {"role": "user", "content": user_msg}
+    ]
+
+def rate_rules(guild_id: int, mode: str, channel_id: int, user_id: int | None = None):
+    rules = [
+        ("guild", guild_id, RATE_LIMITS.get(mode, RATE_LIMITS["serious"]), RATE_WINDOW_SECONDS),
+        ("channel", channel_id, CHANNEL_RATE_LIMIT, RATE_WINDOW_SECONDS),
+    ]
+    if user_id is not None:
+        rules.append(("user", user_id, USER_RATE_LIMIT, RATE_WINDOW_SECONDS))
+    return rules
+
+def rate_check(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> float:
+    # 0.0 when allowed (budget consumed), else seconds until there is room
+    return rate_limiter.acquire(rate_rules(guild_id, mode, channel_id, user_id))
+
+def can_send_in_guild(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> bool:
+    return rate_check(guild_id, mode, channel_id, user_id) == 0.0
+
+async def shared_rate_check(guild_id: int, mode: str, channel_id: int, user_id: int | None = None) -> float:
+    # In cluster mode the coordinator holds the buckets, so a user's budget is
+    # shared across shards; local buckets are the fallback
+    if cluster is not None:
+        try:
+            return await cluster.rate(rate_rules(guild_id, mode, channel_id, user_id))
+        except Exception as e:
+            print("Cluster rate check failed:", e)
+    return rate_check(guild_id, mode, channel_id, user_id)
 
 async def is_addressed(message: discord.Message) -> bool:
     try:
@@ -139,15 +370,124 @@ async def is_addressed(message: discord.Message) -> bool:
             ref = message.reference
             if isinstance(ref.resolved, discord.Message):
                 return ref.resolved.author.id == bot.user.id
+            if isinstance(ref.resolved, discord.DeletedReferencedMessage):
+                return False
+            known = sent_cache.lookup(ref.message_id, message.channel.id)
+            if known is not None:
+                return known
             try:
+                METRICS.inc("reference_fetches_total")
                 ref_msg = await message.channel.fetch_message(ref.message_id)
-                return ref_msg and ref_msg.author.id == bot.user.id
+                ours = ref_msg.author.id == bot.user.id
+                sent_cache.remember(ref.message_id, ours)
+                return ours
             except:
                 pass
         return False
     except:
         return False
 
+# Addressed messages landing in one channel within the window share one reply
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0.8))
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 3.0))
+
+# Shared LLM worker pool: guilds served round-robin, bounded queue per guild
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", 4))
+LLM_QUEUE_DEPTH = int(os.getenv("LLM_QUEUE_DEPTH", 8))
+LLM_QUEUE_POLICY = os.getenv("LLM_QUEUE_POLICY", "drop_oldest")
+
+llm_scheduler = LLMScheduler(LLM_WORKERS, LLM_QUEUE_DEPTH, LLM_QUEUE_POLICY)
+
+async def reply_to_batch(channel_id: int, batch: list[discord.Message]):
+    message = batch[-1]
+    mode = server_modes.get(message.guild.id, current_mode_global)
+
+    wait = await shared_rate_check(message.guild.id, mode, channel_id, message.author.id)
+    if 0 < wait <= RATE_MAX_WAIT:
+        METRICS.inc("rate_limited_total", outcome="delayed")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "rate_delayed")
+        with stage("rate_wait"):
+            await asyncio.sleep(wait)
+        wait = await shared_rate_check(message.guild.id, mode, channel_id, message.author.id)
+    if wait:
+        METRICS.inc("rate_limited_total", outcome="dropped")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "rate_dropped")
+        return
+
+    if len(batch) == 1:
+        clean = message.content.strip()
+    else:
+        clean = "Several messages arrived together. Answer all of them in one reply:\n" + "\n".join(
+            f"{m.author.display_name}: {m.content.strip()}" for m in batch
+        )
+
+    # Roast logic
+    mentioned = list({u.id: u for m in batch for u in m.mentions}.values())
+    mention_targets = [m for m in mentioned if m.id != bot.user.id]
+    user_msg = clean
+    if mention_targets:
+        mentions_text = " ".join(f"<@{m.id}>" for m in mention_targets)
+        roast_instruction = (
+            f"Roast ONLY the following user(s): {mentions_text}. "
+            "Give a humorous, very hard, non-hateful roast. Playfully insult their mom if safe. "
+            "Do NOT roast Ardunot (the bot)."
+        )
+        user_msg = roast_instruction + "\n\nUser said: " + clean
+
+    queued = time.perf_counter()
+
+    async def job():
+        METRICS.observe("stage_seconds", time.perf_counter() - queued, stage="queue_wait")
+        if cluster is None:
+            return await fetch_ai_response(user_msg, message.guild, message.channel, message.author, mentioned)
+        async with cluster.slot():
+            return await fetch_ai_response(user_msg, message.guild, message.channel, message.author, mentioned)
+
+    try:
+        async with outbound.typing(message.channel):
+            reply = await llm_scheduler.submit(message.guild.id, job)
+    except QueueFull:
+        METRICS.inc("queue_dropped_total")
+        if trace is not None:
+            for m in batch:
+                trace.outcome(m.id, "queue_dropped")
+        return
+    METRICS.inc("replies_total")
+    reply = fix_user_mentions(reply)
+
+    # Store assistant reply
+    channel_memory.append(channel_id, bot.user.id, bot.user.display_name, "assistant", reply)
+    with stage("send"):
+        await outbound.send(message.channel, reply)
+    if trace is not None:
+        for m in batch:
+            trace.outcome(m.id, "replied")
+
+coalescer = ChannelCoalescer(reply_to_batch, COALESCE_WINDOW, COALESCE_MAX_WAIT)
+
+def memory_by_channel():
+    # Largest channels only, to keep the series count bounded
+    top = sorted(channel_memory.channels.items(), key=lambda kv: len(kv[1]), reverse=True)[:METRICS_TOP_CHANNELS]
+    return {(("channel", channel_id),): len(buf) for channel_id, buf in top}
+
+METRICS.gauge("memory_entries", lambda: len(channel_memory), "Chat memory entries across all channels")
+METRICS.gauge("memory_channels", lambda: len(channel_memory.channels), "Channels with chat memory loaded")
+METRICS.gauge("memory_channel_entries", memory_by_channel, "Chat memory entries in the largest channels")
+METRICS.gauge("llm_queue_depth", lambda: llm_scheduler.depth(), "Jobs waiting for an LLM worker")
+METRICS.gauge("llm_running", lambda: llm_scheduler.running, "Jobs running on LLM workers")
+METRICS.gauge("response_cache_hit_rate", lambda: CACHE.stats()["hit_rate"], "Response cache hit rate")
+METRICS.gauge("sent_cache_hit_rate", lambda: sent_cache.stats()["hit_rate"], "Reply checks answered without fetch_message")
+METRICS.gauge("shushed_channels", lambda: len(shushed_channels), "Channels currently shushed")
+METRICS.gauge("member_cache_size", lambda: len(member_cache), "Members held by the lean-mode TTL cache")
+METRICS.gauge("retrieval_documents", lambda: len(retrieval_index), "Messages held by the retrieval index")
+METRICS.gauge("retrieval_hit_rate", lambda: retrieval_index.stats()["hit_rate"], "Retrieval searches that found a related message")
+METRICS.gauge("outbound_queued", lambda: sum(len(q) for q in outbound.queues.values()), "Replies waiting in per-channel send queues")
+METRICS.gauge("prompt_prefixes", lambda: len(prefix_cache), "Guilds with a cached prompt prefix")
+
 @bot.tree.command(name="members", description="Displays member count.")
 async def members_slash(interaction: discord.Interaction):
     await interaction.response.send_message(
@@ -179,8 +519,19 @@ async def shush_bot(ctx, *args):
         duration_display = args[0]
     resume_time = datetime.now(timezone.utc) + timedelta(seconds=duration_seconds)
     shushed_channels[ctx.channel.id] = resume_time
+    shush_timer.schedule(ctx.channel.id, resume_time)
     await ctx.send(f"🔇 Muted until {discord.utils.format_dt(resume_time, 'T')} ({duration_display}).")
 
+@bot.command(name='stats')
+@commands.check(check_if_admin)
+async def show_stats(ctx):
+    lines = METRICS.summary()
+    text = "\n".join(lines)
+    while len(text) > 1900:
+        lines.pop()
+        text = "\n".join(lines) + "\n..."
+    await ctx.send(f"```\n{text}\n```")
+
 @bot.command(name='rshush')
 async def resume_shush(ctx):
     if ctx.channel.id in shushed_channels:
@@ -189,18 +540,90 @@ async def resume_shush(ctx):
     else:
         await ctx.send("🤔 I wasn't muted.")
 
+async def backfill_sent_cache():
+    # Most active readable channels first; each one fetched is then covered
+    # down to its oldest message so older replies resolve locally too.
+    channels = [
+        ch for g in bot.guilds for ch in g.text_channels
+        if ch.permissions_for(g.me).read_message_history
+    ]
+    channels.sort(key=lambda ch: ch.last_message_id or 0, reverse=True)
+    for ch in channels[:BACKFILL_CHANNELS]:
+        oldest = None
+        try:
+            async for msg in ch.history(limit=BACKFILL_LIMIT):
+                oldest = msg.id
+                if msg.author.id == bot.user.id:
+                    sent_cache.add(msg.id)
+        except Exception as e:
+            print(f"Backfill skipped {ch.id}:", e)
+            continue
+        if oldest is not None:
+            sent_cache.mark_backfilled(ch.id, oldest)
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user}")
+    state_store.start()
+    rate_limiter.start()
+    # shushes from before a restart expire on time too, not on the next message
+    shushed_channels.load_all()
+    for channel_id, resume in list(shushed_channels.items()):
+        shush_timer.schedule(channel_id, resume)
+    shush_timer.start()
+    if METRICS_PORT:
+        try:
+            await METRICS.serve(METRICS_PORT, METRICS_HOST)
+        except Exception as e:
+            print("Metrics server error:", e)
+    if not sent_cache.horizons:
+        asyncio.create_task(backfill_sent_cache())
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} commands.")
     except Exception as e:
         print("Sync error:", e)
 
+@bot.event
+async def on_member_join(member):
+    if not LEAN_INTENTS:
+        get_member_index(member.guild).upsert_member(member)
+
+@bot.event
+async def on_member_remove(member):
+    get_member_index(member.guild).remove_member(member.id)
+    member_cache.forget(member.guild.id, member.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if LEAN_INTENTS:
+        member_cache.refresh(after)
+    else:
+        get_member_index(after.guild).upsert_member(after)
+
+@bot.event
+async def on_guild_role_create(role):
+    get_member_index(role.guild).upsert_role(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    get_member_index(after.guild).upsert_role(after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    get_member_index(role.guild).remove_role(role.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    drop_member_index(guild.id)
+    prefix_cache.invalidate(guild.id)
+
 @bot.event
 async def on_message(message):
+    if trace is not None:
+        trace.message(message, bot.user)
     if message.author == bot.user:
+        sent_cache.add(message.id)
         return
     await bot.process_commands(message)
     if message.content.startswith('/'):
@@ -213,55 +636,43 @@ async def on_message(message):
     if bot.user.mentioned_in(message) and any(w in clean.lower() for w in ["stop", "plz stop"]):
         resume = datetime.now(timezone.utc) + timedelta(seconds=180)
         shushed_channels[channel_id] = resume
-        return await message.channel.send(
-            f"🤐 Ok, quiet for 3 min (until {discord.utils.format_dt(resume, 'T')})."
+        shush_timer.schedule(channel_id, resume)
+        await outbound.send(
+            message.channel,
+            f"🤐 Ok, quiet for 3 min (until {discord.utils.format_dt(resume, 'T')}).",
+            merge=False
         )
+        return
 
     if channel_id in shushed_channels:
         if datetime.now(timezone.utc) < shushed_channels[channel_id]:
+            METRICS.inc("shush_suppressed_total")
+            if trace is not None:
+                trace.outcome(message.id, "shushed")
             return
         del shushed_channels[channel_id]
 
-    if channel_id not in channel_memory:
-        channel_memory[channel_id] = []
-
-    store_user_msg = await is_addressed(message)
+    with stage("is_addressed"):
+        store_user_msg = await is_addressed(message)
     if re.search(r"<\d{15,25}>", clean):
         store_user_msg = True
 
     # Only store messages from real users, not bot
     if store_user_msg and message.author != bot.user:
-        channel_memory[channel_id].append(f"{message.author.display_name}: {clean}")
+        channel_memory.append(channel_id, message.author.id, message.author.display_name, "user", clean)
 
     should_reply = store_user_msg
+    if trace is not None:
+        trace.outcome(message.id, "addressed" if should_reply else "ignored")
     if not should_reply:
         return
 
-    mode = server_modes.get(message.guild.id, current_mode_global)
-
-    if not can_send_in_guild(message.guild.id, mode, channel_id):
-        return
-
-    # Roast logic
-    mention_targets = [m for m in message.mentions if m.id != bot.user.id]
-    user_msg = clean
-    if mention_targets:
-        mentions_text = " ".join(f"<@{m.id}>" for m in mention_targets)
-        roast_instruction = (
-            f"Roast ONLY the following user(s): {mentions_text}. "
-            "Give a humorous, very hard, non-hateful roast. Playfully insult their mom if safe. "
-            "Do NOT roast Ardunot (the bot)."
-        )
-        user_msg = roast_instruction + "\n\nUser said: " + clean
-
-    reply = await fetch_ai_response(user_msg, message.guild, message.channel, message.author)
-    reply = fix_user_mentions(reply)
-
-    # Store assistant reply
-    channel_memory[channel_id].append(f"assistant: {reply}")
-    await message.channel.send(reply)
+    coalescer.submit(channel_id, message)
 
 if TOKEN:
     bot.run(TOKEN)
-else:
+    state_store.flush_sync()
+    if trace is not None:
+        trace.close()
+elif __name__ == "__main__":
     print("Error: DISCORD_TOKEN not set.")
@@ -0,0 +1,166 @@
+import re
+
+from metrics import METRICS
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# per-message framing the chat APIs add on top of the content tokens
+MESSAGE_OVERHEAD = 4
+
+# roughly the pre-tokenizer GPT-style BPEs use: contractions, words with
+# their leading space, short digit groups, punctuation runs, whitespace
+PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    # Offline estimate: common words are one token, long words split every
+    # ~6 letters, symbol runs every ~3 chars, non-ASCII text costs by UTF-8
+    # bytes. Close to cl100k on English chat text; TokenCounter.calibrate()
+    # corrects the rest per model.
+    total = 0
+    for piece in PIECES.findall(text):
+        core = piece.strip()
+        if not core:
+            total += 1
+        elif not core.isascii():
+            total += max(1, len(core.encode("utf-8")) // 2)
+        elif core[0].isalpha():
+            total += 1 + (len(core) - 1) // 6
+        else:
+            total += 1 + (len(core) - 1) // 3
+    return total
+
+
+class TokenCounter:
+    # Counts with tiktoken when it's installed, otherwise estimate_tokens().
+    # Either way the raw count is scaled per model by a factor learned from
+    # the prompt_tokens the provider reports back, since non-OpenAI models
+    # (llama etc.) don't tokenize like cl100k.
+
+    def __init__(self, memo_size: int = 8192):
+        self.encoders = {}
+        self.scale: dict[str, float] = {}
+        self.samples: dict[str, int] = {}
+        # system text, member entries and history lines repeat on every
+        # prompt, so raw counts are memoised (cleared wholesale when full)
+        self.memo: dict[tuple[str, str], int] = {}
+        self.memo_size = memo_size
+
+    def _encoder(self, model: str):
+        if tiktoken is None:
+            return None
+        enc = self.encoders.get(model)
+        if enc is None:
+            try:
+                enc = tiktoken.encoding_for_model(model.split("/")[-1])
+            except KeyError:
+                enc = tiktoken.get_encoding("cl100k_base")
+            self.encoders[model] = enc
+        return enc
+
+    def raw(self, text: str, model: str = "") -> int:
+        key = (model, text)
+        n = self.memo.get(key)
+        if n is None:
+            enc = self._encoder(model)
+            n = len(enc.encode(text, disallowed_special=())) if enc is not None else estimate_tokens(text)
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            self.memo[key] = n
+        return n
+
+    def count(self, text: str, model: str = "") -> int:
+        if not text:
+            return 0
+        return round(self.raw(text, model) * self.scale.get(model, 1.0))
+
+    def count_messages(self, messages: list[dict], model: str = "") -> int:
+        return sum(self.count(m.get("content") or "", model) + MESSAGE_OVERHEAD for m in messages)
+
+    def calibrate(self, model: str, messages: list[dict], actual: int):
+        # EWMA of actual/estimated, clamped so one odd response can't skew it
+        raw = sum(self.raw(m.get("content") or "", model) + MESSAGE_OVERHEAD for m in messages)
+        if raw <= 0 or actual <= 0:
+            return
+        ratio = min(2.0, max(0.5, actual / raw))
+        n = self.samples.get(model, 0)
+        weight = 1.0 / (n + 1) if n < 10 else 0.1
+        self.scale[model] = self.scale.get(model, 1.0) * (1 - weight) + ratio * weight
+        self.samples[model] = n + 1
+
+
+TOKENS = TokenCounter()
+
+
+def truncate_tokens(text: str, limit: int, model: str = "", counter: TokenCounter = TOKENS) -> str:
+    # keeps the head of text within limit tokens (binary search on length)
+    if counter.count(text, model) <= limit:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if counter.count(text[:mid], model) + 1 <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + "…"
+
+
+class PromptAssembler:
+    # Spends a token budget section by section in the order they're added
+    # (callers add them highest priority first). fixed() sections are always
+    # kept, truncated if need be; fill() sections keep items in the order
+    # given until the next one doesn't fit. report() gives tokens per section.
+
+    def __init__(self, budget: int, model: str = "", counter: TokenCounter = TOKENS):
+        self.budget = budget
+        self.model = model
+        self.counter = counter
+        self.used = 0
+        self.sections: dict[str, int] = {}
+        self.dropped: dict[str, int] = {}
+
+    @property
+    def left(self) -> int:
+        return max(0, self.budget - self.used)
+
+    def _spend(self, name: str, tokens: int):
+        self.used += tokens
+        self.sections[name] = self.sections.get(name, 0) + tokens
+
+    def fixed(self, name: str, text: str, cap: int | None = None) -> str:
+        limit = self.left if cap is None else min(cap, self.left)
+        text = truncate_tokens(text, limit, self.model, self.counter)
+        self._spend(name, self.counter.count(text, self.model))
+        return text
+
+    def fill(self, name: str, items, render=str, separator_tokens: int = 1) -> list:
+        kept = []
+        items = list(items)
+        for i, item in enumerate(items):
+            tokens = self.counter.count(render(item), self.model) + separator_tokens
+            if tokens > self.left:
+                self.dropped[name] = self.dropped.get(name, 0) + len(items) - i
+                break
+            self._spend(name, tokens)
+            kept.append(item)
+        self.sections.setdefault(name, 0)
+        return kept
+
+    def record(self):
+        METRICS.inc("prompts_total")
+        for name, tokens in self.sections.items():
+            METRICS.inc("prompt_tokens_total", tokens, section=name)
+        for name, count in self.dropped.items():
+            METRICS.inc("prompt_items_dropped_total", count, section=name)
+
+    def report(self) -> dict:
+        return {
+            "budget": self.budget,
+            "used": self.used,
+            "sections": dict(self.sections),
+            "dropped": dict(self.dropped),
+        }
@@ -0,0 +1,41 @@
+from member_index import get_member_index
+from metrics import METRICS
+
+
+class PrefixCache:
+    # The static head of each guild's system prompt (guild name, personality
+    # for its mode, staff roster), built once by build(guild, mode) and then
+    # reused as the same string. Providers cache prompts by prefix, so
+    # everything per-request goes after it. An entry is only rebuilt when
+    # what it was built from changes: the mode (!si/!fi), the guild name, or
+    # the member index's staff_version (member and role events).
+
+    def __init__(self, build):
+        self.build = build
+        self.entries: dict[int, tuple[tuple, str]] = {}
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, guild, mode: str) -> str:
+        try:
+            version = get_member_index(guild).staff_version
+        except:
+            version = None
+        key = (mode, guild.name, version)
+        entry = self.entries.get(guild.id)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            METRICS.inc("prompt_prefix_total", result="hit")
+            return entry[1]
+
+        text = self.build(guild, mode)
+        self.entries[guild.id] = (key, text)
+        self.builds += 1
+        METRICS.inc("prompt_prefix_total", result="build")
+        return text
+
+    def invalidate(self, guild_id: int):
+        self.entries.pop(guild_id, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import time
+
+
+class RateLimiter:
+    # GCRA (virtual-scheduling token bucket) on the monotonic clock. Each
+    # (tier, key) costs one float: its theoretical arrival time. A rule is
+    # (tier, key, limit, period): up to `limit` events per `period`, bursting
+    # up to `limit`. acquire() only consumes when every rule passes.
+
+    def __init__(self):
+        self.tat: dict[tuple[str, int], float] = {}
+        self.allowed = 0
+        self.denied = 0
+        self.swept = 0
+        self.task: asyncio.Task | None = None
+
+    @staticmethod
+    def _params(limit: int, period: float) -> tuple[float, float]:
+        interval = period / limit
+        return interval, period - interval
+
+    def retry_after(self, tier: str, key: int, limit: int, period: float, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        interval, tolerance = self._params(limit, period)
+        tat = max(self.tat.get((tier, key), now), now)
+        return max(0.0, tat - now - tolerance)
+
+    def remaining(self, tier: str, key: int, limit: int, period: float, now: float | None = None) -> int:
+        now = time.monotonic() if now is None else now
+        interval, tolerance = self._params(limit, period)
+        tat = max(self.tat.get((tier, key), now), now)
+        return max(0, min(limit, int((tolerance - (tat - now)) / interval + 1e-9) + 1))
+
+    def acquire(self, rules) -> float:
+        # Returns 0.0 when allowed (budget consumed on every rule), otherwise
+        # the seconds until all rules would pass.
+        now = time.monotonic()
+        wait = max(self.retry_after(tier, key, limit, period, now) for tier, key, limit, period in rules)
+        if wait > 0:
+            self.denied += 1
+            return wait
+
+        for tier, key, limit, period in rules:
+            interval, _ = self._params(limit, period)
+            self.tat[(tier, key)] = max(self.tat.get((tier, key), now), now) + interval
+        self.allowed += 1
+        return 0.0
+
+    def sweep(self):
+        # a bucket whose TAT has passed is full again, same as a missing one
+        now = time.monotonic()
+        idle = [k for k, tat in self.tat.items() if tat <= now]
+        for k in idle:
+            del self.tat[k]
+        self.swept += len(idle)
+
+    async def _sweep_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def start(self, interval: float = 60.0):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._sweep_forever(interval))
+
+
+class ScopedRateLimiter:
+    # One user's view of a shared RateLimiter (a host.py persona): same table
+    # and sweeper, but tiers are prefixed with `scope`, so each view keeps
+    # its own buckets.
+
+    def __init__(self, limiter: RateLimiter, scope: str):
+        self.limiter = limiter
+        self.scope = scope
+
+    def _rules(self, rules):
+        return [(f"{self.scope}:{tier}", key, limit, period) for tier, key, limit, period in rules]
+
+    def retry_after(self, tier: str, key: int, limit: int, period: float, now: float | None = None) -> float:
+        return self.limiter.retry_after(f"{self.scope}:{tier}", key, limit, period, now)
+
+    def remaining(self, tier: str, key: int, limit: int, period: float, now: float | None = None) -> int:
+        return self.limiter.remaining(f"{self.scope}:{tier}", key, limit, period, now)
+
+    def acquire(self, rules) -> float:
+        return self.limiter.acquire(self._rules(rules))
+
+    def start(self, interval: float = 60.0):
+        self.limiter.start(interval)
+
+
+class ShushTimer:
+    # Min-heap of (resume_timestamp, channel_id) that removes expired shushes
+    # from `shushed` as soon as they end. Re-shushing just pushes a new entry;
+    # stale ones are skipped when they no longer match the stored time.
+
+    def __init__(self, shushed):
+        self.shushed = shushed
+        self.heap: list[tuple[float, int]] = []
+        self.wakeup: asyncio.Event | None = None
+        self.task: asyncio.Task | None = None
+
+    def schedule(self, channel_id: int, resume):
+        heapq.heappush(self.heap, (resume.timestamp(), channel_id))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def expire(self, now: float | None = None):
+        now = time.time() if now is None else now
+        while self.heap and self.heap[0][0] <= now:
+            ts, channel_id = heapq.heappop(self.heap)
+            resume = self.shushed.get(channel_id)
+            if resume is not None and resume.timestamp() <= ts:
+                del self.shushed[channel_id]
+
+    async def _run(self):
+        while True:
+            self.expire()
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
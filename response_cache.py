@@ -0,0 +1,90 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+
+_WS = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _WS.sub(" ", text).strip().casefold()
+
+
+def make_key(messages: list[dict], model: str, temperature: float) -> str:
+    norm = [[m.get("role", "user"), normalize(m.get("content", ""))] for m in messages]
+    raw = json.dumps([model, round(temperature, 3), norm], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # In-memory LRU with a per-entry TTL, optionally backed by a SQLite file
+    # so hits survive restarts. max_entries=0 turns the cache off.
+
+    def __init__(self, max_entries: int = 512, ttl: float = 600, path: str | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path and max_entries > 0:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, value TEXT)")
+            self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self.db.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT expires, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and row[0] > now:
+                self._remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return row[1]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: str, ttl: float | None = None):
+        if not self.enabled:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, expires, value)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, expires, value))
+            self.db.commit()
+
+    def _remember(self, key: str, expires: float, value: str):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
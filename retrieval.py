@@ -0,0 +1,203 @@
+import heapq
+import math
+import re
+import time
+from collections import OrderedDict
+
+from memory import MemoryEntry
+
+WORDS = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being but by can could
+did do does doing don't for from had has have having he her here hers him his how i i'm if in into is
+it it's its just let's me more most my no nor not now of off on once only or other our ours out over
+own same she should so some such than that that's the their theirs them then there these they this
+those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself lol lmao ok okay yeah yes pls plz please bot ardunot
+""".split())
+
+# segment size for persistence; only the newest segment is rewritten on append
+SEGMENT = 200
+
+
+def tokenize(text: str) -> list[str]:
+    return [w for w in WORDS.findall(text.lower()) if len(w) > 1 and w not in STOPWORDS]
+
+
+class ChannelIndex:
+    # BM25 over one channel's messages. Documents get sequential ids, so the
+    # oldest is always first in `docs` and is the one dropped at capacity.
+
+    def __init__(self, first_id: int = 0):
+        self.docs: "OrderedDict[int, MemoryEntry]" = OrderedDict()
+        self.terms: dict[int, dict[str, int]] = {}
+        self.lengths: dict[int, int] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.total_len = 0
+        self.next_id = first_id
+
+    def add(self, entry: MemoryEntry, doc_id: int | None = None) -> int:
+        doc_id = self.next_id if doc_id is None else doc_id
+        self.next_id = doc_id + 1
+        tf: dict[str, int] = {}
+        for term in tokenize(entry.text):
+            tf[term] = tf.get(term, 0) + 1
+        self.docs[doc_id] = entry
+        self.terms[doc_id] = tf
+        self.lengths[doc_id] = sum(tf.values())
+        self.total_len += self.lengths[doc_id]
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[doc_id] = n
+        return doc_id
+
+    def pop_oldest(self) -> int:
+        doc_id, _ = self.docs.popitem(last=False)
+        tf = self.terms.pop(doc_id)
+        self.total_len -= self.lengths.pop(doc_id)
+        for term in tf:
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+        return doc_id
+
+    @property
+    def first_id(self) -> int:
+        return next(iter(self.docs), self.next_id)
+
+    def search(self, query: str, k: int, before: float | None = None, k1: float = 1.2, b: float = 0.75):
+        # Only the query terms' postings are touched, so cost tracks how
+        # common the words are rather than how long the channel is.
+        n = len(self.docs)
+        if not n or k <= 0:
+            return []
+        avg_len = self.total_len / n or 1.0
+        lengths = self.lengths
+        base, slope = k1 * (1 - b), k1 * b / avg_len
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            weight = idf * (k1 + 1)
+            for doc_id, tf in posting.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + base + slope * lengths[doc_id])
+        if before is not None:
+            scores = {d: s for d, s in scores.items() if self.docs[d].ts < before}
+        # higher score first, newer first on ties
+        best = heapq.nlargest(k, scores.items(), key=lambda kv: (kv[1], kv[0]))
+        return [(self.docs[d], s) for d, s in best]
+
+
+class RetrievalIndex:
+    # Long-horizon history next to ChannelMemory: up to per_channel messages
+    # per channel (far past the live window), searchable with BM25. Channels
+    # are kept in LRU order and dropped from RAM when idle or when the total
+    # goes over global_cap; with a StateStore attached they're written behind
+    # in SEGMENT-sized chunks and rebuilt lazily on the next touch.
+
+    def __init__(self, per_channel: int = 500, global_cap: int = 40000, idle_seconds: int = 6 * 3600, store=None):
+        self.per_channel = per_channel
+        self.global_cap = global_cap
+        self.idle_seconds = idle_seconds
+        self.store = store
+        self.channels: "OrderedDict[int, ChannelIndex]" = OrderedDict()
+        self.total = 0
+        self.searches = 0
+        self.hits = 0
+
+    def _load(self, channel_id: int):
+        if self.store is None or channel_id in self.channels:
+            return
+        meta = self.store.get("retrieval", f"{channel_id}:meta")
+        if not meta:
+            return
+        first_id, next_id = meta
+        index = ChannelIndex(first_id)
+        for seg in range(first_id // SEGMENT, (next_id - 1) // SEGMENT + 1):
+            start, rows = self.store.get("retrieval", f"{channel_id}:{seg}", [0, []])
+            for i, row in enumerate(rows):
+                if start + i >= first_id:
+                    index.add(MemoryEntry(*row), start + i)
+        index.next_id = max(index.next_id, next_id)
+        self.channels[channel_id] = index
+        self.total += len(index.docs)
+
+    def _persist(self, channel_id: int, index: ChannelIndex, doc_id: int):
+        if self.store is None:
+            return
+        seg = doc_id // SEGMENT
+
+        def rows():
+            # [first doc id, rows]; the head of the oldest segment may be gone
+            start = max(seg * SEGMENT, index.first_id)
+            return [start, [
+                [e.author_id, e.name, e.role, e.text, e.ts]
+                for e in (index.docs[d] for d in range(start, min(index.next_id, (seg + 1) * SEGMENT)))
+            ]]
+
+        self.store.mark("retrieval", f"{channel_id}:{seg}", rows)
+        self.store.mark("retrieval", f"{channel_id}:meta", lambda: [index.first_id, index.next_id])
+
+    def add(self, channel_id: int, entry: MemoryEntry):
+        self._load(channel_id)
+        index = self.channels.get(channel_id)
+        if index is None:
+            index = self.channels[channel_id] = ChannelIndex()
+        else:
+            self.channels.move_to_end(channel_id)
+
+        doc_id = index.add(entry)
+        self.total += 1
+        while len(index.docs) > self.per_channel:
+            old = index.pop_oldest()
+            self.total -= 1
+            if self.store is not None and (old + 1) % SEGMENT == 0:
+                self.store.delete("retrieval", f"{channel_id}:{old // SEGMENT}")
+        self._persist(channel_id, index, doc_id)
+
+        self.evict(entry.ts, keep=channel_id)
+
+    def search(self, channel_id: int, query: str, k: int, before: float | None = None) -> list[MemoryEntry]:
+        # top-k messages for query, oldest first; before= skips messages the
+        # caller already has (the live window)
+        self._load(channel_id)
+        index = self.channels.get(channel_id)
+        self.searches += 1
+        if index is None:
+            return []
+        found = index.search(query, k, before)
+        if found:
+            self.hits += 1
+        return sorted((e for e, _ in found), key=lambda e: e.ts)
+
+    def evict(self, now: float | None = None, keep: int | None = None):
+        now = time.time() if now is None else now
+        cutoff = now - self.idle_seconds
+        while self.channels:
+            channel_id, index = next(iter(self.channels.items()))
+            if channel_id == keep:
+                break
+            last = next(reversed(index.docs.values()), None)
+            idle = last is None or last.ts < cutoff
+            if not idle and self.total <= self.global_cap:
+                break
+            self.drop(channel_id)
+
+    def drop(self, channel_id: int):
+        index = self.channels.pop(channel_id, None)
+        if index is not None:
+            self.total -= len(index.docs)
+
+    def __len__(self) -> int:
+        return self.total
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "documents": self.total,
+            "searches": self.searches,
+            "hit_rate": self.hits / self.searches if self.searches else 0.0,
+        }
@@ -0,0 +1,139 @@
+import re
+
+from llm_client import ProviderChain, model_stats
+from metrics import METRICS
+from prompt_budget import estimate_tokens
+
+CODE_FENCE = re.compile(r"```")
+CODE_HINTS = re.compile(
+    r"`[^`\n]+`|\b(?:def|class|import|return|void|int|const|let|var|function|#include|Serial\.\w+|pinMode|digitalWrite)\b"
+    r"|[{};]\s*$|==|!=|->|=>|\w+\(\)|Traceback|\berror\b|\bexception\b",
+    re.IGNORECASE | re.MULTILINE
+)
+HARD_ASKS = re.compile(
+    r"\b(?:explain|why|how (?:do|does|can|to|would|should)|debug|fix|compare|difference|step[- ]by[- ]step"
+    r"|write|implement|calculate|derive|prove|optimi[sz]e|design|review|summari[sz]e|translate)\b",
+    re.IGNORECASE
+)
+SMALL_TALK = re.compile(
+    r"^\W*(?:hi|hey|hello|yo|sup|gm|gn|thanks|thank you|ty|lol|lmao|ok|okay|nice|cool|bruh|wb|bye)\b",
+    re.IGNORECASE
+)
+
+
+def classify(text: str, mode: str = "serious") -> tuple[int, list[str]]:
+    # Cheap local score: positive leans to the strong tier, zero or below to
+    # the fast one. Returns the score and the features that produced it.
+    score, why = 0, []
+    tokens = estimate_tokens(text)
+    if CODE_FENCE.search(text):
+        score += 3
+        why.append("code_block")
+    elif len(CODE_HINTS.findall(text)) >= 2:
+        score += 2
+        why.append("code")
+    if tokens >= 120:
+        score += 2
+        why.append("long")
+    elif tokens >= 40:
+        score += 1
+        why.append("medium")
+    elif tokens <= 8:
+        score -= 1
+        why.append("short")
+    asks = len(HARD_ASKS.findall(text))
+    if asks:
+        score += min(asks, 2)
+        why.append("hard_ask")
+    if text.count("?") >= 2:
+        score += 1
+        why.append("multi_question")
+    if SMALL_TALK.match(text) and tokens <= 20:
+        score -= 2
+        why.append("small_talk")
+    if mode == "funny":
+        score -= 1
+        why.append("funny")
+    return score, why
+
+
+class Tier:
+    __slots__ = ("name", "chain", "max_tokens")
+
+    def __init__(self, name: str, chain: ProviderChain, max_tokens: int | None = None):
+        self.name = name
+        self.chain = chain
+        self.max_tokens = max_tokens
+
+    @property
+    def model(self) -> str | None:
+        # primary model, used for token counting and budgets
+        return self.chain.entries[0][1] if self.chain.entries else None
+
+    def health(self) -> tuple[float, float | None]:
+        # best error rate and p50 over the tier's models
+        error_rate, p50 = 1.0, None
+        for _, model in self.chain.entries:
+            stats = model_stats(model)
+            error_rate = min(error_rate, stats.error_rate)
+            latency = stats.percentile(0.5)
+            if latency is not None and (p50 is None or latency < p50):
+                p50 = latency
+        return error_rate, p50
+
+
+class ModelRouter:
+    # Sends each request to the fast or the strong tier. Clear cases follow
+    # classify(); borderline ones (0 < score < strong_score) only go strong
+    # while its recent p50 is under borderline_p50. A tier whose models are
+    # all failing (error rate over max_error_rate) hands its traffic to the
+    # other one; every probe_every-th of those still goes through, so the
+    # tier's stats can recover.
+
+    def __init__(self, fast: Tier, strong: Tier, strong_score: int = 3, borderline_p50: float = 6.0,
+                 max_error_rate: float = 0.5, probe_every: int = 20, enabled: bool = True, default: str = "strong"):
+        self.fast = fast
+        self.strong = strong
+        self.strong_score = strong_score
+        self.borderline_p50 = borderline_p50
+        self.max_error_rate = max_error_rate
+        self.probe_every = probe_every
+        self.failovers = 0
+        self.enabled = enabled
+        # the tier everything goes to while routing is off
+        self.default = default
+        self.routed = {"fast": 0, "strong": 0}
+
+    def route(self, text: str, mode: str = "serious") -> Tier:
+        if not self.enabled:
+            return self._pick(self.fast if self.default == "fast" else self.strong, "disabled")
+        if not self.fast.chain.entries:
+            return self._pick(self.strong, "disabled")
+        if not self.strong.chain.entries:
+            return self._pick(self.fast, "disabled")
+
+        score, _ = classify(text, mode)
+        if score >= self.strong_score:
+            tier, reason = self.strong, "complex"
+        elif score <= 0:
+            tier, reason = self.fast, "simple"
+        else:
+            _, p50 = self.strong.health()
+            if p50 is None or p50 <= self.borderline_p50:
+                tier, reason = self.strong, "borderline"
+            else:
+                tier, reason = self.fast, "borderline_slow"
+
+        other = self.fast if tier is self.strong else self.strong
+        if tier.health()[0] > self.max_error_rate and other.health()[0] <= self.max_error_rate:
+            self.failovers += 1
+            if self.failovers % self.probe_every:
+                tier, reason = other, "failover"
+            else:
+                reason = "probe"
+        return self._pick(tier, reason)
+
+    def _pick(self, tier: Tier, reason: str) -> Tier:
+        self.routed[tier.name] = self.routed.get(tier.name, 0) + 1
+        METRICS.inc("router_routes_total", tier=tier.name, reason=reason)
+        return tier
@@ -0,0 +1,147 @@
+import asyncio
+import time
+from collections import deque
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    __slots__ = ("factory", "future", "enqueued")
+
+    def __init__(self, factory, future):
+        self.factory = factory
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class LLMScheduler:
+    # Fixed pool of workers in front of the provider. Each guild has its own
+    # queue; workers serve guilds round-robin, taking up to weights[guild]
+    # jobs per turn, so one busy guild can't starve the rest. A full guild
+    # queue either drops its oldest job ("drop_oldest") or refuses the new
+    # one ("reject"); either way the loser's submit() raises QueueFull.
+
+    def __init__(self, workers: int = 4, max_depth: int = 8, policy: str = "drop_oldest", weights: dict | None = None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.policy = policy
+        self.weights = weights or {}
+        self.queues: dict[int, deque] = {}
+        self.ring: deque = deque()
+        self.turn_left = 0
+        self.wakeup: asyncio.Event | None = None
+        self.tasks: list[asyncio.Task] = []
+        self.running = 0
+        self.waits: deque = deque(maxlen=1000)
+        self.completed = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def _start(self):
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, guild_id: int, factory):
+        # factory is a zero-arg callable returning the coroutine to run
+        self._start()
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = deque()
+        if len(queue) >= self.max_depth:
+            if self.policy == "reject":
+                self.rejected += 1
+                raise QueueFull(f"guild {guild_id} queue full")
+            old = queue.popleft()
+            self.dropped += 1
+            if not old.future.done():
+                old.future.set_exception(QueueFull(f"guild {guild_id} dropped oldest"))
+
+        job = Job(factory, asyncio.get_running_loop().create_future())
+        queue.append(job)
+        if guild_id not in self.ring:
+            self.ring.append(guild_id)
+        self.wakeup.set()
+        return await job.future
+
+    def _next_job(self) -> Job | None:
+        while self.ring:
+            guild_id = self.ring[0]
+            queue = self.queues.get(guild_id)
+            if not queue:
+                self.ring.popleft()
+                self.queues.pop(guild_id, None)
+                self.turn_left = 0
+                continue
+            if self.turn_left <= 0:
+                self.turn_left = self.weights.get(guild_id, 1)
+            job = queue.popleft()
+            self.turn_left -= 1
+            if self.turn_left <= 0 or not queue:
+                self.ring.rotate(-1)
+                self.turn_left = 0
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if job.future.done():
+                continue
+
+            self.waits.append(time.monotonic() - job.enqueued)
+            self.running += 1
+            try:
+                await self._run(job)
+            finally:
+                self.running -= 1
+                self.completed += 1
+
+    async def _run(self, job: Job):
+        # The job runs as its own task: asyncio.wait() only raises if this
+        # worker is cancelled, so a job that gets cancelled (or raises
+        # CancelledError itself) fails its submitter and the worker carries on.
+        task = asyncio.create_task(job.factory())
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            if not job.future.done():
+                job.future.cancel()
+            raise
+        error = None if task.cancelled() else task.exception()
+        if job.future.done():
+            return
+        if task.cancelled():
+            job.future.cancel()
+        elif error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(task.result())
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+
+        def pct(p):
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "depth": self.depth(),
+            "running": self.running,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "wait_p50": pct(0.50),
+            "wait_p95": pct(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
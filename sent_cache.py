@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def snowflake_now() -> int:
+    return (int(time.time() * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+class SentMessageCache:
+    # IDs of messages the bot itself sent. Every bot message created after
+    # `started` is recorded (via on_message and send results), and channels
+    # back-filled from history are covered down to their oldest fetched ID,
+    # so any reference newer than a channel's horizon can be answered
+    # locally: in the set means ours, not in the set means someone else's.
+    # Evicting an ID raises the floor, since we no longer know about it.
+
+    def __init__(self, capacity: int = 5000, negative_capacity: int = 5000):
+        self.capacity = capacity
+        self.negative_capacity = negative_capacity
+        self.started = snowflake_now()
+        self.ids: "OrderedDict[int, None]" = OrderedDict()
+        self.not_ours: "OrderedDict[int, None]" = OrderedDict()
+        self.horizons: dict[int, int] = {}
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, message_id: int):
+        self.ids[message_id] = None
+        self.ids.move_to_end(message_id)
+        while len(self.ids) > self.capacity:
+            evicted, _ = self.ids.popitem(last=False)
+            self.floor = max(self.floor, evicted)
+
+    def mark_backfilled(self, channel_id: int, oldest_id: int):
+        self.horizons[channel_id] = min(self.horizons.get(channel_id, self.started), oldest_id)
+
+    def horizon(self, channel_id: int) -> int:
+        return max(self.floor, self.horizons.get(channel_id, self.started))
+
+    def lookup(self, message_id: int, channel_id: int) -> bool | None:
+        # True/False when known locally, None when the caller has to fetch
+        if message_id in self.ids:
+            self.hits += 1
+            return True
+        if message_id in self.not_ours or message_id > self.horizon(channel_id):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return None
+
+    def remember(self, message_id: int, ours: bool):
+        # result of a fetch for an ID older than the horizon
+        if ours:
+            self.add(message_id)
+            return
+        self.not_ours[message_id] = None
+        while len(self.not_ours) > self.negative_capacity:
+            self.not_ours.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "ids": len(self.ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class StateStore:
+    # SQLite (WAL) key/value store with write-behind batching. Mutations only
+    # mark a key dirty; every flush_interval the dirty values are snapshotted
+    # on the event loop and written in one transaction on a worker thread.
+    # Until that transaction commits, reads are served from the snapshot
+    # (inflight). Reads are lazy point lookups, so nothing is loaded at startup.
+
+    def __init__(self, path: str, flush_interval: float = 2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending: dict[tuple[str, str], object] = {}
+        # snapshotted but not yet committed: key -> JSON text (None = delete)
+        self.inflight: dict[tuple[str, str], str | None] = {}
+        self.reader = self._connect()
+        self.reader.execute(
+            "CREATE TABLE IF NOT EXISTS state (ns TEXT, key TEXT, value TEXT, PRIMARY KEY (ns, key))"
+        )
+        self.reader.commit()
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.task: asyncio.Task | None = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # ---------------- READS ---------------------
+
+    def get(self, ns: str, key, default=None):
+        k = (ns, str(key))
+        if k in self.pending:
+            value = self.pending[k]
+            value = value() if callable(value) else value
+            return default if value is None else value
+        if k in self.inflight:
+            raw = self.inflight[k]
+            return default if raw is None else json.loads(raw)
+        row = self.reader.execute("SELECT value FROM state WHERE ns = ? AND key = ?", k).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def items(self, ns: str) -> list[tuple[str, object]]:
+        # whole namespace, unflushed writes included; only for small ones
+        values = {key: json.loads(raw) for key, raw in self.reader.execute("SELECT key, value FROM state WHERE ns = ?", (ns,))}
+        for (n, key), raw in self.inflight.items():
+            if n == ns:
+                values[key] = None if raw is None else json.loads(raw)
+        for (n, key), value in self.pending.items():
+            if n == ns:
+                values[key] = value() if callable(value) else value
+        return [(key, value) for key, value in values.items() if value is not None]
+
+    # ---------------- WRITES --------------------
+
+    def set(self, ns: str, key, value):
+        # value must be JSON-serialisable, or None to delete
+        self.pending[(ns, str(key))] = value
+
+    def mark(self, ns: str, key, producer):
+        # producer() is called at flush time, so repeated mutations of the
+        # same key between flushes cost a single write
+        self.pending[(ns, str(key))] = producer
+
+    def delete(self, ns: str, key):
+        self.pending[(ns, str(key))] = None
+
+    def _snapshot(self) -> list[tuple[str, str, str | None]]:
+        batch = []
+        for (ns, key), value in self.pending.items():
+            if callable(value):
+                value = value()
+            raw = None if value is None else json.dumps(value, separators=(",", ":"))
+            batch.append((ns, key, raw))
+            self.inflight[(ns, key)] = raw
+        self.pending.clear()
+        return batch
+
+    def _settle(self, batch, written: bool):
+        # drop the batch from inflight unless a later snapshot replaced a key;
+        # a failed batch goes back to pending (where nothing newer is queued)
+        for ns, key, raw in batch:
+            k = (ns, key)
+            if k in self.inflight and self.inflight[k] is raw:
+                del self.inflight[k]
+                if not written and k not in self.pending:
+                    self.pending[k] = None if raw is None else json.loads(raw)
+
+    def _write(self, batch):
+        with self.write_lock:
+            if self.writer is None:
+                self.writer = self._connect()
+            with self.writer:
+                for ns, key, value in batch:
+                    if value is None:
+                        self.writer.execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key))
+                    else:
+                        self.writer.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", (ns, key, value))
+            self.flushes += 1
+            self.rows_written += len(batch)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch = self._snapshot()
+        written = False
+        try:
+            await asyncio.to_thread(self._write, batch)
+            written = True
+        finally:
+            self._settle(batch, written)
+
+    def flush_sync(self):
+        if not self.pending:
+            return
+        batch = self._snapshot()
+        written = False
+        try:
+            self._write(batch)
+            written = True
+        finally:
+            self._settle(batch, written)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("State flush error:", e)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+
+class PersistentDict:
+    # Dict-like view over one namespace of a StateStore. Keys are loaded the
+    # first time they're touched; writes go through the store's write-behind.
+
+    def __init__(self, store: StateStore | None, ns: str, encode=None, decode=None):
+        self.store = store
+        self.ns = ns
+        self.encode = encode or (lambda v: v)
+        self.decode = decode or (lambda v: v)
+        self.data = {}
+        self.loaded = set()
+
+    def _load(self, key):
+        if key in self.loaded or self.store is None:
+            return
+        self.loaded.add(key)
+        raw = self.store.get(self.ns, key)
+        if raw is not None:
+            self.data[key] = self.decode(raw)
+
+    def load_all(self, key=int):
+        # reads the whole namespace in (keys come back as strings, hence key=)
+        if self.store is None:
+            return
+        for raw_key, raw in self.store.items(self.ns):
+            k = key(raw_key)
+            if k not in self.loaded:
+                self.loaded.add(k)
+                self.data[k] = self.decode(raw)
+
+    def __contains__(self, key) -> bool:
+        self._load(key)
+        return key in self.data
+
+    def __getitem__(self, key):
+        self._load(key)
+        return self.data[key]
+
+    def get(self, key, default=None):
+        self._load(key)
+        return self.data.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.loaded.add(key)
+        self.data[key] = value
+        self.mark(key)
+
+    def setdefault(self, key, default):
+        self._load(key)
+        if key not in self.data:
+            self[key] = default
+        return self.data[key]
+
+    def __delitem__(self, key):
+        self._load(key)
+        del self.data[key]
+        if self.store is not None:
+            self.store.delete(self.ns, key)
+
+    def pop(self, key, default=None):
+        if key in self:
+            value = self.data[key]
+            del self[key]
+            return value
+        return default
+
+    def mark(self, key):
+        # call after mutating a stored value in place
+        if self.store is not None and key in self.data:
+            self.store.mark(self.ns, key, lambda: self.encode(self.data[key]) if key in self.data else None)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def items(self):
+        return self.data.items()
+
+
+# ---------------- CODECS ------------------------
+
+def encode_datetime(dt: datetime) -> float:
+    return dt.timestamp()
+
+
+def decode_datetime(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc)
+
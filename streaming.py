@@ -0,0 +1,73 @@
+import time
+
+from metrics import METRICS
+from outbound import split_message
+
+# Discord allows 5 message edits per 5 seconds per channel; stay under it.
+EDIT_INTERVAL = 1.2
+PLACEHOLDER = "✍️ ..."
+MAX_LEN = 2000
+
+
+# appended to a reply that broke off mid-stream and couldn't be finished
+TRUNCATED = "\n… *(reply cut off)*"
+
+
+async def relay_stream(channel, chunks, fallback, send=None, failed=None) -> tuple[str, bool]:
+    # Posts a placeholder, edits it as chunks arrive (throttled), then writes
+    # the final text. If the stream fails (or an edit does) after some text
+    # arrived, that text is kept and marked as cut off; fallback() (the
+    # non-streaming call) only runs when nothing arrived, and if it raises
+    # too, failed(error) is posted. chunks is always closed, so a failed
+    # edit doesn't leave the provider's response open.
+    # send(channel, text) -> [messages] (the outbound dispatcher) posts the
+    # placeholder and any parts past the 2000-char limit, in order.
+    # Returns (text, complete); complete is False for cut-off or error
+    # text, which callers shouldn't keep as a finished reply.
+
+    if send is None:
+        message = await channel.send(PLACEHOLDER)
+    else:
+        message = (await send(channel, PLACEHOLDER, merge=False))[0]
+    text = ""
+    shown = PLACEHOLDER
+    last_edit = started = time.monotonic()
+    complete = True
+
+    try:
+        async for chunk in chunks:
+            if not text:
+                METRICS.observe("stage_seconds", time.monotonic() - started, stage="first_token")
+            text += chunk
+            now = time.monotonic()
+            if now - last_edit >= EDIT_INTERVAL and text.strip():
+                shown = text[:MAX_LEN]
+                await message.edit(content=shown)
+                last_edit = now
+    except Exception as e:
+        stage = "mid_stream" if text.strip() else "before_first_token"
+        METRICS.inc("stream_failures_total", stage=stage)
+        print(f"Stream failed ({stage}):", e)
+        complete = False
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+    if text.strip() and not complete:
+        text = text.rstrip() + TRUNCATED
+    elif not text.strip():
+        try:
+            text = await fallback()
+            complete = True
+        except Exception as e:
+            print("Stream fallback failed:", e)
+            text = failed(e) if failed is not None else "⚠️ I'm having trouble responding right now."
+            complete = False
+
+    parts = split_message(text, MAX_LEN) if send is not None else [text[:MAX_LEN]]
+    if parts[0] != shown:
+        await message.edit(content=parts[0])
+    for part in parts[1:]:
+        await send(channel, part, merge=False)
+
+    return text, complete
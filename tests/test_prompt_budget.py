@@ -0,0 +1,45 @@
+import argparse
+
+import pytest
+
+from bench.fakes import FakeGuild
+from bench.run import load_bot
+from prompt_budget import TOKENS
+
+QUESTION = "how do I wire a servo to pin 9 on an uno and keep it from jittering?"
+
+
+@pytest.fixture(scope="module", params=["bot", "p"])
+def bot(request):
+    args = argparse.Namespace(bot=request.param, stream=False, lean=False, cache=False,
+                              coalesce_window=None, keep_rate_limits=True)
+    mod, _, bot_user = load_bot(args, "http://127.0.0.1:9")
+    # 20.5k members, every 500th one staff: 41 staff, one more than the roster holds
+    guild = FakeGuild(30_000, "big-staff", 20_500, 1, bot_user)
+    return mod, guild
+
+
+def test_small_budget_keeps_user_message(bot):
+    mod, guild = bot
+    channel = guild.text_channels[0]
+    author = guild.all_members[7]
+    model = "tiny-model"
+    mod.PROMPT_BUDGETS[model] = 900
+
+    if hasattr(mod, "build_prompt"):
+        text = mod.build_prompt(QUESTION, guild, channel, author, model=model)
+        assert text.endswith(QUESTION)
+        used = TOKENS.count(text, model)
+    else:
+        messages = mod.build_messages(QUESTION, guild, channel, author, model=model)
+        assert messages[-1] == {"role": "user", "content": QUESTION}
+        used = TOKENS.count_messages(messages, model) - 4 * len(messages)
+    assert used <= 900
+
+
+def test_prefix_within_cap(bot):
+    mod, guild = bot
+    prefix = mod.build_prefix(guild, "serious")
+    assert TOKENS.count(prefix) <= mod.PROMPT_PREFIX_CAP + 1
+    # trimmed by whole entries, so the roster is still a complete list
+    assert prefix.endswith("]\n") and "Moderator" in prefix
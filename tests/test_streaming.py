@@ -0,0 +1,91 @@
+import asyncio
+
+import streaming
+from streaming import TRUNCATED, relay_stream
+
+
+class Message:
+    def __init__(self, content, fail_edits=False):
+        self.content = content
+        self.fail_edits = fail_edits
+
+    async def edit(self, content):
+        if self.fail_edits:
+            raise RuntimeError("429 Too Many Requests")
+        self.content = content
+
+
+class Channel:
+    def __init__(self, fail_edits=False):
+        self.sent = []
+        self.fail_edits = fail_edits
+
+    async def send(self, content):
+        message = Message(content, self.fail_edits)
+        self.sent.append(message)
+        return message
+
+
+class Chunks:
+    # async iterator standing in for stream_openrouter(); records aclose()
+    def __init__(self, parts, error=None):
+        self.parts = list(parts)
+        self.error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.parts:
+            return self.parts.pop(0)
+        if self.error is not None:
+            raise self.error
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        self.closed = True
+
+
+def relay(channel, chunks, fallback_text="from fallback"):
+    calls = []
+
+    async def fallback():
+        calls.append(1)
+        return fallback_text
+
+    text, complete = asyncio.run(relay_stream(channel, chunks, fallback))
+    return text, complete, len(calls)
+
+
+def test_finished_stream():
+    channel, chunks = Channel(), Chunks(["Hello", " there"])
+    assert relay(channel, chunks) == ("Hello there", True, 0)
+    assert channel.sent[0].content == "Hello there"
+    assert chunks.closed
+
+
+def test_mid_stream_failure_keeps_partial_text():
+    channel, chunks = Channel(), Chunks(["Half an ans"], ConnectionError("reset"))
+    text, complete, fallbacks = relay(channel, chunks)
+    assert (text, complete, fallbacks) == ("Half an ans" + TRUNCATED, False, 0)
+    assert channel.sent[0].content == text
+    assert chunks.closed
+
+
+def test_failure_before_first_token_falls_back():
+    channel, chunks = Channel(), Chunks([], ConnectionError("refused"))
+    assert relay(channel, chunks) == ("from fallback", True, 1)
+    assert channel.sent[0].content == "from fallback"
+    assert chunks.closed
+
+
+def test_failed_edit_closes_stream(monkeypatch):
+    monkeypatch.setattr(streaming, "EDIT_INTERVAL", 0)
+    channel, chunks = Channel(fail_edits=True), Chunks(["partial", " more"])
+    try:
+        relay(channel, chunks)
+    except RuntimeError:
+        pass  # the final edit fails too; the stream must be closed regardless
+    assert chunks.closed
+    assert chunks.parts == [" more"]
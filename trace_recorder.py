@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+# Compact JSONL trace of gateway traffic for bench/replay.py. No content,
+# names or real IDs are written: IDs become a keyed hash with a fresh key per
+# recorder (stable within a trace, unlinkable across traces, no lookup table
+# to grow) and a message is reduced to the shape the pipeline reacts to.
+#
+#   {"t": 1.25, "ev": "msg", "id": 80513, "g": 1107, "c": 2231, "a": 5902,
+#    "bot": false, "len": 42, "mb": true, "mn": 1, "ref": 3318, "q": true,
+#    "code": false, "raw": false, "stop": false, "cmd": null}
+#   {"t": 2.91, "ev": "out", "id": 80513, "o": "replied", "ms": 1660}
+#
+# mb: mentions the bot, mn: mention count, ref: replied-to message, raw: has
+# a bare <id> ping, stop: a shush request, cmd: prefix command name only.
+# Outcomes: addressed, ignored, shushed, rate_delayed, rate_dropped,
+# queue_dropped, replied.
+
+RAW_PING = re.compile(r"<\d{15,25}>")
+
+
+class TraceRecorder:
+    # Lines are buffered and flushed every flush_every events and on close().
+
+    def __init__(self, path: str, flush_every: int = 200, max_pending: int = 10000):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        self.started = time.monotonic()
+        self.key = os.urandom(16)
+        # arrival time per recorded message, for the outcome latency
+        self.arrivals: "OrderedDict[int, float]" = OrderedDict()
+        self.max_pending = max_pending
+        self.flush_every = flush_every
+        self.unflushed = 0
+        self.events = 0
+
+    def _id(self, real: int | None) -> int | None:
+        # 48 bits: collisions are negligible at trace sizes and the value
+        # stays an exact number for any JSON reader
+        if real is None:
+            return None
+        digest = hashlib.blake2b(real.to_bytes(8, "big"), digest_size=6, key=self.key).digest()
+        return int.from_bytes(digest, "big")
+
+    def _write(self, event: dict):
+        self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+        self.events += 1
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def message(self, message, bot_user):
+        now = time.monotonic()
+        content = message.content or ""
+        ref = getattr(message, "reference", None)
+        is_bot = message.author.id == bot_user.id
+        cmd = content.split()[0][:32] if content.startswith("!") and content.strip() else None
+        mentions_bot = any(m.id == bot_user.id for m in message.mentions)
+        self._write({
+            "t": round(now - self.started, 4),
+            "ev": "msg",
+            "id": self._id(message.id),
+            "g": self._id(message.guild.id) if message.guild else None,
+            "c": self._id(message.channel.id),
+            "a": self._id(message.author.id),
+            "bot": is_bot,
+            "len": len(content),
+            "mb": mentions_bot,
+            "mn": len(message.mentions),
+            "ref": self._id(ref.message_id) if ref is not None else None,
+            "q": "?" in content,
+            "code": "```" in content,
+            "raw": bool(RAW_PING.search(content)),
+            "stop": mentions_bot and "stop" in content.lower(),
+            "cmd": cmd,
+        })
+        if not is_bot:
+            self.arrivals[message.id] = now
+            if len(self.arrivals) > self.max_pending:
+                self.arrivals.popitem(last=False)
+
+    def outcome(self, message_id: int, outcome: str):
+        now = time.monotonic()
+        event = {"t": round(now - self.started, 4), "ev": "out", "id": self._id(message_id), "o": outcome}
+        arrived = self.arrivals.get(message_id)
+        if arrived is not None:
+            event["ms"] = round((now - arrived) * 1000, 1)
+            if outcome in ("replied", "rate_dropped", "queue_dropped", "ignored", "shushed"):
+                del self.arrivals[message_id]
+        self._write(event)
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            self.file.close()